@@ -0,0 +1,294 @@
+import argparse
+import concurrent.futures
+import glob
+import gzip
+import os
+import sys
+import time
+from collections import deque
+
+import bgzf
+import generate_output_bed
+from generate_output_bed import format_batch, get_output_filepath, get_skip_reason, header_line, init_worker, load_metadata
+from manifest import BuildManifest, sha256_text
+from metrics import Metrics, MetricsLog, Progress, run_measured, task_metrics
+from motif_score import ProcessedIntervals, UnsortedInputError, get_header_line, score_records, write_scored_records
+from parquet_output import get_partition_directory, import_pyarrow, write_parquet
+from sequence_utils import get_fasta_path
+from tabix import TabixIndex, replace_indexed
+
+# Single-pass alternative to download.py's split followed by generate_output_bed.py:
+# the raw genome-wide HOMER BED is read once, in batches of lines that the worker
+# processes annotate (one sorted sequence fetch per batch for every motif in it,
+# plus PWM scoring of the ambiguous names), and the annotated lines are only fanned
+# out into the per-motif outputs at the end, in the same format, order and
+# directory layout as generate_output_bed.py. No per-motif input files are written.
+
+raw_files_dir = "raw_files_download"
+
+# Batches of raw lines being annotated at once, per worker
+batches_per_worker = 2
+
+def find_raw_bed(genome_build):
+    # The BED download.py saved for the build, e.g. homer.KnownMotifs.hg19.191020.bed.gz
+    paths = sorted(glob.glob(os.path.join(raw_files_dir, f"homer.KnownMotifs.{genome_build}.*bed.gz")))
+    if len(paths) != 1:
+        raise IOError(f"Expected one homer.KnownMotifs.{genome_build} BED in {raw_files_dir}, found {len(paths)}; pass it with --bed")
+    return paths[0]
+
+def annotate_raw_batch(lines, genome_build):
+    # Annotate a batch of raw BED lines of any motifs -> (motif names in order of
+    # first appearance, output text by name, (records, sequences, scores) by
+    # ambiguous name). Names with a single motif are annotated here completely;
+    # the scored records of ambiguous names still need to be deduplicated in
+    # order, which only the writing process can do.
+    load_metadata()
+    ambiguous_motifs = generate_output_bed.ambiguous_motifs
+    names = {}
+    batch = []
+    ambiguous_records = {}
+    records_read = 0
+    skipped = {}
+    for line in lines:
+        if line.startswith("#"):  # Skip comment lines
+            continue
+
+        records_read += 1
+        columns = line.strip().split("\t")
+        motif_name = columns[3]
+        names.setdefault(motif_name, None)
+
+        if motif_name in ambiguous_motifs:
+            if int(columns[2]) - int(columns[1]) + 1 == ambiguous_motifs[motif_name].motif_length:
+                ambiguous_records.setdefault(motif_name, []).append(columns)
+            else:
+                skipped["length_mismatch"] = skipped.get("length_mismatch", 0) + 1
+            continue
+
+        skip_reason = get_skip_reason(columns)
+        if skip_reason is not None:
+            skipped[skip_reason] = skipped.get(skip_reason, 0) + 1
+            continue
+        batch.append(columns)
+
+    output_lines = {}
+    for columns, output_line in zip(batch, format_batch(batch, genome_build)):
+        output_lines.setdefault(columns[3], []).append(output_line)
+    texts = {motif_name: "".join(motif_lines) for motif_name, motif_lines in output_lines.items()}
+
+    scored = {}
+    for motif_name, records in ambiguous_records.items():
+        sequences, scores = score_records(records, genome_build, ambiguous_motifs[motif_name])
+        scored[motif_name] = (records, sequences, scores)
+
+    metrics = task_metrics()
+    metrics.count("records_read", records_read)
+    metrics.count("records_kept", records_read - sum(skipped.values()))
+    for skip_reason, count in skipped.items():
+        metrics.count("skipped_" + skip_reason, count)
+    return list(names), texts, scored
+
+def read_batches(bed_file, batch_lines):
+    batch = []
+    for line in bed_file:
+        batch.append(line)
+        if len(batch) >= batch_lines:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+class OutputSet:
+    # The per-motif outputs of a run, written as temp files that replace the
+    # outputs only once the whole input was read. All writers compress on one
+    # shared thread pool.
+    def __init__(self, output_directory, compress_executor):
+        self.output_directory = output_directory
+        self.compress_executor = compress_executor
+        self.writers = {}
+        self.processed_intervals = {}
+        self.failures = {}
+
+    def get_writer(self, motif_name):
+        writer = self.writers.get(motif_name)
+        if writer is None:
+            tmp_filepath = get_output_filepath(f"{motif_name}.bed.gz", self.output_directory) + ".gz.tmp"
+            ambiguous_motif = generate_output_bed.ambiguous_motifs.get(motif_name)
+            if ambiguous_motif is None:
+                writer = bgzf.BgzfWriter(tmp_filepath, index=TabixIndex(), executor=self.compress_executor, metrics=task_metrics())
+                writer.write(header_line)
+            else:
+                # chromStart stays 1-based in the outputs of ambiguous names, as in motif_score.py
+                writer = bgzf.BgzfWriter(tmp_filepath, index=TabixIndex(zero_based=False), executor=self.compress_executor, metrics=task_metrics())
+                writer.write(get_header_line(ambiguous_motif.motif_numbers))
+                self.processed_intervals[motif_name] = ProcessedIntervals(ambiguous_motif.motif_numbers)
+            self.writers[motif_name] = writer
+        return writer
+
+    def write(self, names, texts, scored):
+        for motif_name in names:
+            if motif_name in self.failures:
+                continue
+            writer = self.get_writer(motif_name)
+            if motif_name in texts:
+                writer.write(texts[motif_name])
+            elif motif_name in scored:
+                records, sequences, scores = scored[motif_name]
+                try:
+                    write_scored_records(records, sequences, scores, writer, self.processed_intervals[motif_name],
+                                         generate_output_bed.ambiguous_motifs[motif_name], generate_output_bed.parsed_dict)
+                except UnsortedInputError as error:
+                    # Only the split files can be rescored from the start
+                    self.failures[motif_name] = str(error)
+                    writer.close()
+                    os.remove(writer.path)
+
+    def finish(self):
+        # Move the finished outputs into place -> [(name, output .gz path)]
+        outputs = []
+        for motif_name, writer in self.writers.items():
+            if motif_name in self.failures:
+                continue
+            writer.close()
+            output_filepath = writer.path[:-len(".tmp")]
+            replace_indexed(writer.path, output_filepath, writer.index)
+            outputs.append((motif_name, output_filepath))
+        return outputs
+
+    def discard(self):
+        for writer in self.writers.values():
+            writer.close()
+            if os.path.exists(writer.path):
+                os.remove(writer.path)
+
+def annotate_raw_bed(bed_filepath, output_directory, genome_build, workers=None, compress_threads=None, batch_lines=generate_output_bed.batch_size,
+                     metrics_path=None, progress_interval=5.0, parquet_directory=None):
+    # Annotate every record of the raw BED into per-motif outputs; returns the
+    # names that could not be written (ambiguous names whose records are not
+    # sorted, which need the split files and generate_output_bed.py)
+    load_metadata()
+    if parquet_directory is not None:
+        import_pyarrow()
+    os.makedirs(output_directory, exist_ok=True)
+    workers = workers or os.cpu_count()
+
+    manifest = BuildManifest(os.path.join(output_directory, "manifest.json"))
+    fasta_path = get_fasta_path(genome_build)
+    genome_inputs = {"build": genome_build, "fasta": manifest.file_digest(fasta_path), "index": manifest.file_digest(fasta_path + ".fai")}
+    raw_bed_digest = manifest.file_digest(bed_filepath)
+
+    metrics_log = MetricsLog(metrics_path)
+    writer_metrics = Metrics()
+    run_start = time.perf_counter()
+    progress = Progress(1, os.path.getsize(bed_filepath), progress_interval)
+
+    compress_executor = concurrent.futures.ThreadPoolExecutor(compress_threads or workers)
+    outputs = OutputSet(output_directory, compress_executor)
+    try:
+        with open(bed_filepath, "rb") as raw_file, gzip.open(raw_file, "rt", encoding="utf-8") as bed_file, \
+                concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+            # Batches are annotated in parallel but written in input order
+            # Progress is measured by the compressed bytes read up to each written batch
+            pending = deque()
+            position = 0
+            for batch in read_batches(bed_file, batch_lines):
+                pending.append((executor.submit(run_measured, annotate_raw_batch, batch, genome_build), raw_file.tell()))
+                while len(pending) >= workers * batches_per_worker:
+                    future, batch_position = pending.popleft()
+                    write_result(future, outputs, writer_metrics, metrics_log)
+                    progress.update(nbytes=batch_position - position)
+                    position = batch_position
+            while pending:
+                future, batch_position = pending.popleft()
+                write_result(future, outputs, writer_metrics, metrics_log)
+                progress.update(nbytes=batch_position - position)
+                position = batch_position
+
+            # Closing the outputs compresses and writes their last blocks, counted here
+            writer_task_metrics = task_metrics()
+            writer_task_metrics.reset()
+            with writer_metrics.timer("merge"):
+                finished = outputs.finish()
+            writer_metrics.merge(writer_task_metrics)
+
+            # Parquet copies are converted on the pool too
+            if parquet_directory is not None:
+                parquet_futures = []
+                for motif_name, output_filepath in finished:
+                    ambiguous_motif = generate_output_bed.ambiguous_motifs.get(motif_name)
+                    parquet_filepath = os.path.join(get_partition_directory(parquet_directory, motif_name), "part-0.parquet")
+                    if ambiguous_motif is None:
+                        parquet_futures.append(executor.submit(write_parquet, output_filepath, parquet_filepath, None, 1))
+                    else:
+                        parquet_futures.append(executor.submit(write_parquet, output_filepath, parquet_filepath, ambiguous_motif.motif_numbers, 1, True))
+                for future in parquet_futures:
+                    future.result()
+    except BaseException:
+        outputs.discard()
+        raise
+    finally:
+        compress_executor.shutdown()
+    progress.update(files=1)
+    progress.finish()
+
+    # Recorded with the raw BED as input, so generate_output_bed.py rebuilds these outputs from the split files
+    for motif_name, output_filepath in finished:
+        ambiguous_motif = generate_output_bed.ambiguous_motifs.get(motif_name)
+        pwms = {}
+        if ambiguous_motif is not None:
+            for pwm in ambiguous_motif.pwms:
+                pwms[pwm.motif_number] = manifest.file_digest(os.path.join("motif_files", f"{pwm.motif_number}.motif"))
+        manifest.outputs[os.path.basename(output_filepath)] = {
+            "raw_bed": raw_bed_digest,
+            "metadata": sha256_text(generate_output_bed.metadata_rows.get(motif_name, "")),
+            "pwms": pwms,
+            "genome": genome_inputs,
+        }
+        print(f"Output written to {output_filepath}")
+    manifest.save()
+
+    metrics_log.totals.merge(writer_metrics)
+    metrics_log.summary(time.perf_counter() - run_start, file_count=len(finished))
+    for motif_name, error in outputs.failures.items():
+        print(f"{motif_name} is not sorted ({error}), annotate it from the split files with generate_output_bed.py", file=sys.stderr)
+    return sorted(outputs.failures)
+
+def write_result(future, outputs, writer_metrics, metrics_log):
+    # Write one annotated batch into the outputs. Waiting for the batch means the
+    # workers are what holds the writer back.
+    with writer_metrics.timer("annotate_wait"):
+        (names, texts, scored), metrics = future.result()
+    metrics_log.totals.merge(Metrics(metrics["counters"], metrics["stages"]))
+    metrics_log.write(dict({"event": "batch"}, **metrics))
+
+    # The ambiguous names are deduplicated and counted here, in the writing process
+    writer_task_metrics = task_metrics()
+    writer_task_metrics.reset()
+    with writer_metrics.timer("fan_out"):
+        outputs.write(names, texts, scored)
+    writer_metrics.merge(writer_task_metrics)
+
+def main():
+    parser = argparse.ArgumentParser(description="Annotate the raw HOMER known motifs BED in a single pass, without splitting it first")
+    parser.add_argument("genome_build", help="hg19 or hg38")
+    parser.add_argument("--bed", help="raw HOMER BED (default: the homer.KnownMotifs BED of the build in raw_files_download/)")
+    parser.add_argument("--output-dir", help="output directory (default: the processed_bed directory of the genome build)")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--compress-threads", type=int, default=None, help="threads compressing the outputs (default: number of workers)")
+    parser.add_argument("--batch-lines", type=int, default=generate_output_bed.batch_size, help="raw BED lines per batch")
+    parser.add_argument("--metrics", help="write per-batch counters and stage timings to this JSON-lines file")
+    parser.add_argument("--progress-interval", type=float, default=5.0, help="seconds between progress lines (0 to turn them off)")
+    parser.add_argument("--parquet-dir", help="also write every output as Parquet, partitioned by motif name, into this directory")
+    args = parser.parse_args()
+
+    bed_filepath = args.bed or find_raw_bed(args.genome_build)
+    output_directory = args.output_dir or os.path.join(generate_output_bed.output_root, args.genome_build)
+    failures = annotate_raw_bed(bed_filepath, output_directory, args.genome_build, args.workers, args.compress_threads, args.batch_lines,
+                                args.metrics, args.progress_interval, args.parquet_dir)
+
+    if failures:
+        print(f"{len(failures)} motif names failed: {', '.join(failures)}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
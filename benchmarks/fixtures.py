@@ -0,0 +1,146 @@
+import gzip
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pwm import PWM, encode_sequences, score_sequences
+from sequence_utils import get_reverse_complement
+
+# Synthetic inputs for the pipeline benchmarks: a parsed_subheadings.txt with the
+# matching motif_files/*.motif matrices, a reference FASTA with its .fai and a
+# HOMER-style genome-wide BED of motif sites planted in it. Everything is
+# derived from a seed, so the same scale and seed always give the same files.
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LINE_BASES = 60
+
+
+def select_motif_rows(motif_count):
+    # Rows of the repository's parsed_subheadings.txt: every motif whose name and
+    # length it shares with another one (so PWM disambiguation is exercised),
+    # then others up to motif_count
+    with open(os.path.join(REPO_DIRECTORY, "parsed_subheadings.txt"), "r") as parsed_file:
+        header = next(parsed_file)
+        rows = [line.rstrip("\n").split("\t") for line in parsed_file]
+
+    groups = {}
+    for columns in rows:
+        groups.setdefault((columns[1], columns[10]), []).append(columns)
+    selected = [columns for group in groups.values() if len(group) > 1 for columns in group]
+    for columns in rows:
+        if len(selected) >= motif_count:
+            break
+        if len(groups[(columns[1], columns[10])]) == 1:
+            selected.append(columns)
+    return header, selected
+
+
+def write_motifs(directory, motif_count, rng):
+    # parsed_subheadings.txt and one random matrix per motif -> [(columns, PWM)]
+    header, rows = select_motif_rows(motif_count)
+    os.makedirs(os.path.join(directory, "motif_files"), exist_ok=True)
+    with open(os.path.join(directory, "parsed_subheadings.txt"), "w") as parsed_file:
+        parsed_file.write(header)
+        for columns in rows:
+            parsed_file.write("\t".join(columns) + "\n")
+
+    motifs = []
+    for columns in rows:
+        length = int(columns[10])
+        probabilities = np.round(rng.dirichlet([0.4] * 4, length), 3)
+        probabilities = np.maximum(probabilities, 0.001)
+        probabilities = np.round(probabilities / probabilities.sum(axis=1, keepdims=True), 3).tolist()
+        pwm = PWM(columns[0], probabilities, columns[9], columns[1])
+
+        # Threshold at 60% of the best possible score, like a typical HOMER cutoff
+        pwm.threshold = round(0.6 * float(pwm.log_odds[:, :4].max(axis=1).sum()), 6)
+        with open(os.path.join(directory, "motif_files", f"{columns[0]}.motif"), "w") as motif_file:
+            motif_file.write(f">{columns[9]}\t{columns[1]}\t{pwm.threshold}\n")
+            for row in probabilities:
+                motif_file.write("\t".join(f"{probability:.3f}" for probability in row) + "\n")
+        motifs.append((columns, pwm))
+    return motifs
+
+
+def write_genome(fasta_path, bed_path, genome_size, chromosomes, motifs, record_count, rng):
+    # Random reference with soft-masked stretches and runs of N, into which
+    # record_count sites sampled from the motif matrices are planted; plus the
+    # HOMER-style BED of those sites (1-based start, inclusive end, sorted,
+    # gzip-compressed). Scores are the rounded log-odds score of the site on its
+    # strand, as in HOMER's BED. Returns the number of bases.
+    length = max(genome_size // chromosomes, 1000)
+    bases = np.frombuffer(b"ACGT", dtype=np.uint8)
+    complement = np.frombuffer(b"TGCA", dtype=np.uint8)
+    records_per_chromosome = np.bincount(rng.integers(0, chromosomes, record_count), minlength=chromosomes)
+
+    with open(fasta_path, "wb") as fasta_file, open(fasta_path + ".fai", "w") as index_file, gzip.open(bed_path, "wt", compresslevel=1) as bed_file:
+        for number in range(chromosomes):
+            chrom = f"chr{number + 1}"
+            sequence = bases[rng.integers(0, 4, length)].copy()
+
+            # Plant the sites, each sampled from its motif's probabilities
+            sites = []
+            motif_indexes = rng.integers(0, len(motifs), records_per_chromosome[number])
+            for motif_index in np.unique(motif_indexes):
+                columns, pwm = motifs[motif_index]
+                count = int(np.sum(motif_indexes == motif_index))
+                cumulative = np.cumsum(pwm.probabilities, axis=1)
+                codes = (rng.random((count, len(pwm)))[:, :, None] > cumulative[None, :, :3]).sum(axis=2)
+                starts = rng.integers(0, length - len(pwm), count)
+                strands = rng.integers(0, 2, count)
+                for site_codes, start, strand in zip(codes, starts, strands):
+                    planted = complement[site_codes[::-1]] if strand else bases[site_codes]
+                    sequence[start:start + len(pwm)] = planted
+                    sites.append((int(start), motif_index, int(strand)))
+
+            for _ in range(max(length // 100000, 1)):
+                start = int(rng.integers(0, length - 500))
+                sequence[start:start + 500] |= 0x20  # lowercase
+                start = int(rng.integers(0, length - 100))
+                sequence[start:start + 100] = ord("N")
+
+            # Score the sites as they ended up, after any overlapping site was planted
+            text = sequence.tobytes().decode("ascii").lower()
+            lines = []
+            for motif_index in np.unique(motif_indexes):
+                columns, pwm = motifs[motif_index]
+                motif_sites = [(start, strand) for start, site_motif, strand in sites if site_motif == motif_index]
+                sequences = [text[start:start + len(pwm)] for start, _ in motif_sites]
+                sequences = [get_reverse_complement(site) if strand else site for site, (_, strand) in zip(sequences, motif_sites)]
+                scores = score_sequences(encode_sequences(sequences, len(pwm)), pwm.log_odds)
+                for (start, strand), score in zip(motif_sites, scores):
+                    lines.append((start, motif_index, f"{chrom}\t{start + 1}\t{start + len(pwm)}\t{columns[1]}\t{round(float(score))}\t{'-' if strand else '+'}\n"))
+            lines.sort()
+            bed_file.write("".join(line for _, _, line in lines))
+
+            header = f">{chrom}\n".encode("ascii")
+            offset = fasta_file.tell() + len(header)
+            fasta_file.write(header)
+            raw = sequence.tobytes()
+            for line_start in range(0, length, LINE_BASES):
+                fasta_file.write(raw[line_start:line_start + LINE_BASES] + b"\n")
+            index_file.write(f"{chrom}\t{length}\t{offset}\t{LINE_BASES}\t{LINE_BASES + 1}\n")
+    return length * chromosomes
+
+
+def generate(directory, genome_size, record_count, motif_count, chromosomes=4, seed=0):
+    # Write all fixtures into directory; the reference is named hg19.fa so the
+    # pipeline can be run with genome build hg19 from that directory
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    fasta_path = os.path.join(directory, "hg19.fa")
+    bed_path = os.path.join(directory, "homer.KnownMotifs.hg19.bed.gz")
+    motifs = write_motifs(directory, motif_count, rng)
+    genome_size = write_genome(fasta_path, bed_path, genome_size, chromosomes, motifs, record_count, rng)
+    return {"fasta": fasta_path, "bed": bed_path, "motifs": len(motifs), "genome_size": genome_size, "records": record_count}
+
+
+if __name__ == "__main__":
+    # python benchmarks/fixtures.py <directory> [genome_size] [records] [motifs]
+    arguments = sys.argv[1:]
+    print(generate(arguments[0], *[int(argument) for argument in arguments[1:4]]))
@@ -0,0 +1,261 @@
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fixtures import generate
+
+# Benchmark of the processing pipeline on synthetic fixtures (see fixtures.py):
+# every stage is timed in a forked process of its own, so its peak RSS can be
+# measured too, and the results are written as JSON. Compare two runs with
+# --baseline to catch regressions.
+# Usage: python benchmarks/pipeline.py [--scale small|medium|large] [--output results.json]
+
+SCALES = {
+    "small": {"genome_size": 5 * 10 ** 6, "records": 200000, "motifs": 40},
+    "medium": {"genome_size": 50 * 10 ** 6, "records": 2 * 10 ** 6, "motifs": 120},
+    "large": {"genome_size": 500 * 10 ** 6, "records": 20 * 10 ** 6, "motifs": 436},
+}
+
+
+def read_split_records(split_directory):
+    # Records of every split motif file -> {path: [columns]}
+    records = {}
+    for filename in sorted(os.listdir(split_directory)):
+        if filename.endswith(".bed.gz"):
+            path = os.path.join(split_directory, filename)
+            with gzip.open(path, "rt") as bed_file:
+                records[path] = [line.rstrip("\n").split("\t") for line in bed_file]
+    return records
+
+
+def stage_split(directory, workers):
+    from download import process_bed_file
+    bed_path = os.path.join(directory, "homer.KnownMotifs.hg19.bed.gz")
+    start_time = time.perf_counter()
+    process_bed_file(bed_path, os.path.join(directory, "split", "hg19"))
+    seconds = time.perf_counter() - start_time
+    with gzip.open(bed_path, "rb") as bed_file:
+        records = sum(1 for _ in bed_file)
+    return records, os.path.getsize(bed_path), seconds
+
+
+def stage_catalog_build(directory, workers):
+    from motif_catalog import build_catalog
+    catalog = build_catalog()
+    return len(catalog.motifs), os.path.getsize("motif_catalog.npy")
+
+
+def stage_metadata_load(directory, workers):
+    import generate_output_bed
+    generate_output_bed.load_metadata()
+    return len(generate_output_bed.column_mapping), 0
+
+
+def stage_sequence_fetch(directory, workers):
+    from generate_output_bed import batch_size
+    from sequence_utils import get_binding_sequences
+    records, bases = 0, 0
+    for rows in read_split_records(os.path.join(directory, "split", "hg19")).values():
+        for batch_start in range(0, len(rows), batch_size):
+            batch = rows[batch_start:batch_start + batch_size]
+            intervals = [(columns[0], int(columns[1]) - 1, int(columns[2])) for columns in batch]
+            sequences = get_binding_sequences("hg19", intervals, [columns[5] for columns in batch])
+            records += len(sequences)
+            bases += sum(len(sequence) for sequence in sequences)
+    return records, bases
+
+
+def stage_scoring(directory, workers):
+    from motif_catalog import load_catalog
+    from motif_score import load_ambiguous_motifs, score_records
+    ambiguous_motifs = load_ambiguous_motifs(load_catalog())
+    sites = 0
+    for path, rows in read_split_records(os.path.join(directory, "split", "hg19")).items():
+        name = os.path.basename(path).replace(".bed.gz", "")
+        if name in ambiguous_motifs:
+            score_records(rows, "hg19", ambiguous_motifs[name])
+            sites += len(rows) * len(ambiguous_motifs[name].pwms)
+    return sites, 0
+
+
+def stage_annotate(directory, workers):
+    # End to end: generate_output_bed.process_files over every split file
+    from generate_output_bed import process_files
+    split_directory = os.path.join(directory, "split", "hg19")
+    input_files = [os.path.join(split_directory, filename) for filename in sorted(os.listdir(split_directory)) if filename.endswith(".bed.gz")]
+    start_time = time.perf_counter()
+    failures = process_files(input_files, os.path.join(directory, "processed", "hg19"), "hg19", workers)
+    seconds = time.perf_counter() - start_time
+    if failures:
+        raise RuntimeError(f"{len(failures)} motif files failed")
+    records = 0
+    for path in input_files:
+        with gzip.open(path, "rb") as bed_file:
+            records += sum(1 for _ in bed_file)
+    return records, sum(os.path.getsize(path) for path in input_files), seconds
+
+
+def read_outputs(directory):
+    processed_directory = os.path.join(directory, "processed", "hg19")
+    data = []
+    for filename in sorted(os.listdir(processed_directory)):
+        if filename.endswith(".processed.bed.gz"):
+            with gzip.open(os.path.join(processed_directory, filename), "rb") as output_file:
+                data.append(output_file.read())
+    return b"".join(data)
+
+
+def stage_write(directory, workers):
+    # Writing the annotated lines uncompressed, as the pipeline did before BGZF
+    data = read_outputs(directory)
+    start_time = time.perf_counter()
+    with open(os.path.join(directory, "write.bed"), "wb") as output_file:
+        for line in data.splitlines(keepends=True):
+            output_file.write(line)
+    os.remove(os.path.join(directory, "write.bed"))
+    return data.count(b"\n"), len(data), time.perf_counter() - start_time
+
+
+def stage_compress(directory, workers):
+    # BGZF compression and tabix indexing of the annotated lines
+    import bgzf
+    from tabix import TabixIndex
+    data = read_outputs(directory)
+    start_time = time.perf_counter()
+    with bgzf.BgzfWriter(os.path.join(directory, "compress.bed.gz"), threads=workers or 1, index=TabixIndex()) as output_file:
+        for line in data.splitlines(keepends=True):
+            output_file.write(line)
+    os.remove(os.path.join(directory, "compress.bed.gz"))
+    return data.count(b"\n"), len(data), time.perf_counter() - start_time
+
+
+STAGES = [
+    ("split", stage_split),
+    ("catalog_build", stage_catalog_build),
+    ("metadata_load", stage_metadata_load),
+    ("sequence_fetch", stage_sequence_fetch),
+    ("scoring", stage_scoring),
+    ("annotate", stage_annotate),
+    ("write", stage_write),
+    ("compress", stage_compress),
+]
+
+
+def run_stage(function, directory, workers, connection):
+    # Runs in the forked process; stage output goes to /dev/null to keep stdout for the JSON
+    os.chdir(directory)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        start_time = time.perf_counter()
+        result = function(directory, workers)
+        # Stages that prepare or check data outside the timed part return their own time
+        seconds = result[2] if len(result) > 2 else time.perf_counter() - start_time
+        # ru_maxrss is in KB on Linux; worker processes count too
+        peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        connection.send({"seconds": seconds, "items": result[0], "bytes": result[1], "peak_rss_mb": peak_rss / 1024})
+    except Exception as error:
+        connection.send({"error": f"{type(error).__name__}: {error}"})
+
+
+def run_benchmark(directory, workers, stages):
+    results = {}
+    context = multiprocessing.get_context("fork")
+    for name, function in STAGES:
+        if stages and name not in stages:
+            continue
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=run_stage, args=(function, directory, workers, sender))
+        process.start()
+        result = receiver.recv()
+        process.join()
+        if "error" in result:
+            raise RuntimeError(f"Stage {name} failed: {result['error']}")
+
+        result["items_per_second"] = result["items"] / result["seconds"] if result["seconds"] else None
+        result["mb_per_second"] = result["bytes"] / 1e6 / result["seconds"] if result["seconds"] and result["bytes"] else None
+        results[name] = result
+        print(f"{name:15s} {result['seconds']:8.3f}s {result['items']:>12} items  peak RSS {result['peak_rss_mb']:.0f} MB", file=sys.stderr)
+    return results
+
+
+def compare(results, baseline, max_slowdown):
+    # Stages slower than max_slowdown times the baseline
+    regressions = []
+    for name, result in results["stages"].items():
+        if name in baseline["stages"] and baseline["stages"][name]["seconds"] > 0:
+            ratio = result["seconds"] / baseline["stages"][name]["seconds"]
+            print(f"{name:15s} {ratio:6.2f}x baseline", file=sys.stderr)
+            if ratio > max_slowdown:
+                regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the motif processing pipeline on synthetic data")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+    parser.add_argument("--genome-size", type=int, help="bases in the synthetic genome (overrides --scale)")
+    parser.add_argument("--records", type=int, help="motif sites in the synthetic BED (overrides --scale)")
+    parser.add_argument("--motifs", type=int, help="number of motifs (overrides --scale)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes for the annotate stage")
+    parser.add_argument("--stages", nargs="+", choices=[name for name, _ in STAGES], help="only run these stages (and the stages writing their input files)")
+    parser.add_argument("--workdir", help="directory for the fixtures and outputs (default: a temporary directory, removed afterwards)")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--max-slowdown", type=float, default=1.25, help="with --baseline, exit 1 if a stage is this many times slower")
+    args = parser.parse_args()
+
+    config = dict(SCALES[args.scale])
+    for key in ("genome_size", "records", "motifs"):
+        if getattr(args, key) is not None:
+            config[key] = getattr(args, key)
+
+    directory = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="homer_benchmark_")
+    try:
+        start_time = time.perf_counter()
+        fixtures = generate(directory, config["genome_size"], config["records"], config["motifs"], seed=args.seed)
+        print(f"Fixtures generated in {time.perf_counter() - start_time:.1f}s in {directory}", file=sys.stderr)
+
+        # Stages reading the split or annotated files need the stages writing them
+        stages = set(args.stages or [])
+        if stages:
+            stages.add("split")
+        if stages & {"write", "compress"}:
+            stages.add("annotate")
+        results = {
+            "config": dict(config, scale=args.scale, seed=args.seed, workers=args.workers or os.cpu_count()),
+            "fixtures": {"genome_size": fixtures["genome_size"], "records": fixtures["records"], "motifs": fixtures["motifs"]},
+            "platform": {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count()},
+            "stages": run_benchmark(directory, args.workers, stages),
+        }
+    finally:
+        if not args.workdir:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, "r") as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.max_slowdown)
+        if regressions:
+            print(f"Slower than {args.max_slowdown}x the baseline: {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sequence_utils import get_reverse_complement
+
+# Microbenchmark: reverse complement of 10^6 motif sites with the old per-base
+# string concatenation against the str.translate version.
+# Usage: python benchmarks/reverse_complement.py [number_of_sites] [site_length]
+
+
+def get_reverse_complement_loop(sequence):
+    # The implementation previously copied into both processing scripts
+    complement = {'a': 't', 'c': 'g', 'g': 'c', 't': 'a'}
+    reverse_complement = ''
+    sequence = sequence.lower()  # Convert to lowercase
+    for base in reversed(sequence):
+        if base in complement:
+            reverse_complement += complement[base]
+        else:
+            reverse_complement += base
+    return reverse_complement
+
+
+def time_it(function, sequences):
+    start_time = time.perf_counter()
+    results = [function(sequence) for sequence in sequences]
+    return time.perf_counter() - start_time, results
+
+
+def main():
+    number_of_sites = int(sys.argv[1]) if len(sys.argv) > 1 else 10 ** 6
+    site_length = int(sys.argv[2]) if len(sys.argv) > 2 else 12
+
+    random.seed(0)
+    sequences = ["".join(random.choices("acgtnACGT", k=site_length)) for _ in range(number_of_sites)]
+
+    loop_time, loop_results = time_it(get_reverse_complement_loop, sequences)
+    translate_time, translate_results = time_it(get_reverse_complement, sequences)
+    if loop_results != translate_results:
+        raise AssertionError("str.translate reverse complement differs from the per-base loop")
+
+    print(f"{number_of_sites} sites of {site_length} bp")
+    print(f"per-base loop:   {loop_time:.3f}s")
+    print(f"str.translate:   {translate_time:.3f}s ({loop_time / translate_time:.1f}x faster)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,442 @@
+import contextlib
+import gzip
+import struct
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+# BGZF is a series of gzip members of at most 64 KiB each, with the compressed
+# block size stored in a "BC" extra field, terminated by an empty EOF block.
+# Files written here are readable by gzip, bgzip, tabix and htslib.
+
+# Uncompressed bytes per block, same as htslib
+BLOCK_SIZE = 0xff00
+MAX_BLOCK_SIZE = 0x10000
+
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+# Threads decompressing the blocks read by read_line_batches(), unless given
+read_threads = 2
+
+# Blocks decompressed together by one thread, about 1 MB of uncompressed lines
+BLOCKS_PER_BATCH = 16
+
+
+def wait_timer(metrics, stage):
+    # metrics.timer(stage), or nothing without metrics
+    return metrics.timer(stage) if metrics is not None else contextlib.nullcontext()
+
+
+def compress_block(data, compresslevel=6):
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    if len(compressed) + 26 > MAX_BLOCK_SIZE:
+        # Incompressible data, store it instead
+        compressor = zlib.compressobj(0, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+
+    header = struct.pack("<4BI2BH2BHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord("B"), ord("C"), 2, len(compressed) + 25)
+    footer = struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+    return header + compressed + footer
+
+
+class BgzfWriter:
+    # Compresses as it writes. With threads > 1 blocks are compressed on a thread
+    # pool (zlib releases the GIL) and written out in order; at most 4 * threads
+    # blocks are queued, then writing waits for compression. With a TabixIndex as
+    # index, every line written is indexed; its offsets are final once the writer
+    # is closed. Writers can share the thread pool of an executor instead, which
+    # is left running when they close. With metrics (an object with count() and
+    # timer(), like metrics.Metrics) the queue depth and waits are counted there.
+    def __init__(self, path, mode="wb", compresslevel=6, threads=1, index=None, executor=None, metrics=None):
+        self.path = path
+        self.metrics = metrics
+        self.compresslevel = compresslevel
+        self.index = index
+        self._file = open(path, mode)
+        self._file.seek(0, 2)
+        self._buffer = bytearray()
+        self._line = bytearray()
+        self._blocks = 0
+        self._block_offsets = []
+        self._block_sizes = []
+        self._indexed = []
+        self._pending = deque()
+        self._own_executor = executor is None and threads > 1
+        self._executor = ThreadPoolExecutor(threads) if self._own_executor else executor
+        self._max_pending = 4 * threads
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if self.index is not None:
+            self._write_lines(data)
+            return
+        self._buffer += data
+        self._cut_blocks()
+
+    def _write_lines(self, data):
+        # Add complete lines one at a time to know where each starts and ends. Offsets
+        # are block number << 16 | offset in block until the block offsets are known.
+        self._line += data
+        start = 0
+        while True:
+            newline = self._line.find(b"\n", start)
+            if newline < 0:
+                break
+            self._add_line(bytes(self._line[start:newline + 1]))
+            start = newline + 1
+        del self._line[:start]
+
+    def _add_line(self, line):
+        start_offset = self._blocks << 16 | len(self._buffer)
+        self._buffer += line
+        self._cut_blocks()
+        self._indexed.append((line, start_offset, self._blocks << 16 | len(self._buffer)))
+        if len(self._indexed) >= 4096:
+            self._index_lines()
+
+    def _index_lines(self):
+        try:
+            for line, start_offset, end_offset in self._indexed:
+                self.index.add(line, start_offset, end_offset)
+        except ValueError as error:
+            print(f"Not indexing {self.path}: {error}")
+            self.index = None
+        self._indexed.clear()
+
+    def _cut_blocks(self):
+        while len(self._buffer) >= BLOCK_SIZE:
+            self._write_block(bytes(self._buffer[:BLOCK_SIZE]))
+            del self._buffer[:BLOCK_SIZE]
+
+    def _write_block(self, data):
+        self._blocks += 1
+        if self.index is not None:
+            self._block_sizes.append(len(data))
+        if self._executor is None:
+            self._write_compressed(compress_block(data, self.compresslevel))
+            return
+        self._pending.append(self._executor.submit(compress_block, data, self.compresslevel))
+        # Blocks waiting to be written, compressed or not; time spent waiting for a
+        # full queue to drain means compression is what holds the writer back
+        if self.metrics is not None:
+            self.metrics.count("compress_queue_blocks")
+            self.metrics.count("compress_queue_depth", len(self._pending))
+        if len(self._pending) > self._max_pending:
+            with wait_timer(self.metrics, "compress_wait"):
+                while len(self._pending) > self._max_pending:
+                    self._write_compressed(self._pending.popleft().result())
+
+    def _write_compressed(self, block):
+        self._block_offsets.append(self._file.tell())
+        self._file.write(block)
+
+    def flush(self):
+        if self._line:
+            self._add_line(bytes(self._line))
+            self._line.clear()
+        if self._buffer:
+            self._write_block(bytes(self._buffer))
+            self._buffer.clear()
+        while self._pending:
+            self._write_compressed(self._pending.popleft().result())
+        self._file.flush()
+
+    def close(self, write_eof=True):
+        # write_eof=False leaves the file open for appending more blocks later
+        if self._file.closed:
+            return
+        self.flush()
+        if self._own_executor:
+            self._executor.shutdown()
+
+        if self.index is not None:
+            self._index_lines()
+        if self.index is not None:
+            # Offsets past the last block point at the end of the file
+            block_offsets = self._block_offsets + [self._file.tell()]
+            self.index.map_offsets(lambda offset: self._map_offset(block_offsets, offset))
+
+        if write_eof:
+            self._file.write(BGZF_EOF)
+        self._file.close()
+
+    def _map_offset(self, block_offsets, offset):
+        # Block number << 16 | offset in block -> virtual offset. The end of a block
+        # is the start of the next one, as htslib reads it.
+        block, block_offset = offset >> 16, offset & 0xffff
+        if block < len(self._block_sizes) and block_offset == self._block_sizes[block]:
+            block, block_offset = block + 1, 0
+        return block_offsets[block] << 16 | block_offset
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class BgzfWriterPool:
+    # Writes to many BGZF files at once while keeping at most max_open_files of
+    # them open. Data is collected in a per-key buffer and only handed to a writer
+    # once buffer_size bytes have accumulated; writers are evicted least recently
+    # used first and reopened in append mode when their key comes back.
+    def __init__(self, path_for_key, max_open_files=128, buffer_size=BLOCK_SIZE, compresslevel=6):
+        if max_open_files < 1:
+            raise ValueError("max_open_files must be at least 1")
+
+        self.path_for_key = path_for_key
+        self.max_open_files = max_open_files
+        self.buffer_size = buffer_size
+        self.compresslevel = compresslevel
+        self._writers = OrderedDict()
+        self._buffers = {}
+        self._buffered_bytes = {}
+        self.paths = {}
+
+    def write(self, key, data):
+        buffer = self._buffers.get(key)
+        if buffer is None:
+            buffer = self._buffers[key] = []
+            self._buffered_bytes[key] = 0
+        buffer.append(data)
+        self._buffered_bytes[key] += len(data)
+        if self._buffered_bytes[key] >= self.buffer_size:
+            self._flush_key(key)
+
+    def _flush_key(self, key):
+        buffer = self._buffers[key]
+        if not buffer:
+            return
+        self._get_writer(key).write(b"".join(buffer))
+        buffer.clear()
+        self._buffered_bytes[key] = 0
+
+    def _get_writer(self, key):
+        writer = self._writers.get(key)
+        if writer is not None:
+            self._writers.move_to_end(key)
+            return writer
+
+        if len(self._writers) >= self.max_open_files:
+            _, evicted = self._writers.popitem(last=False)
+            evicted.close(write_eof=False)
+
+        # Truncate on first use in this run, append when reopening after eviction
+        if key in self.paths:
+            writer = BgzfWriter(self.paths[key], "ab", self.compresslevel)
+        else:
+            path = self.path_for_key(key)
+            self.paths[key] = path
+            writer = BgzfWriter(path, "wb", self.compresslevel)
+        self._writers[key] = writer
+        return writer
+
+    def close(self):
+        for key in list(self._buffers):
+            self._flush_key(key)
+        for writer in self._writers.values():
+            writer.close()
+        closed_early = set(self.paths) - set(self._writers)
+        self._writers.clear()
+
+        # Files evicted along the way still need their EOF marker
+        for key in closed_early:
+            with open(self.paths[key], "ab") as output_file:
+                output_file.write(BGZF_EOF)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_block(input_file):
+    # Decompress the BGZF block at the current position; None at end of file
+    header = input_file.read(18)
+    if len(header) < 18:
+        return None
+    block_size = struct.unpack("<H", header[16:18])[0] + 1
+    data = input_file.read(block_size - 18)
+    return zlib.decompress(data[:-8], -15)
+
+
+def read_range(input_file, start_offset, end_offset):
+    # Uncompressed bytes between two virtual offsets (compressed block offset << 16
+    # | offset within the block) of an open BGZF file
+    input_file.seek(start_offset >> 16)
+    data = []
+    while True:
+        block_offset = input_file.tell()
+        if block_offset > end_offset >> 16:
+            break
+        block = read_block(input_file)
+        if block is None:
+            break
+        if block_offset == end_offset >> 16:
+            block = block[:end_offset & 0xffff]
+        if block_offset == start_offset >> 16:
+            block = block[start_offset & 0xffff:]
+        data.append(block)
+    return b"".join(data)
+
+
+def read_block_offsets(path):
+    # Compressed offset of every block, found by hopping from header to header
+    # without decompressing anything. None if the file is not BGZF.
+    offsets = []
+    with open(path, "rb") as input_file:
+        while True:
+            header = input_file.read(18)
+            if not header:
+                break
+            if len(header) < 18 or header[:4] != b"\x1f\x8b\x08\x04" or header[12:16] != b"BC\x02\x00":
+                return None
+            offsets.append(input_file.tell() - 18)
+            block_size = struct.unpack("<H", header[16:18])[0] + 1
+            input_file.seek(block_size - 18, 1)
+    return offsets
+
+
+def read_lines(path, block_offsets, first_block, last_block):
+    # Lines that start in blocks [first_block, last_block) of a BGZF file. The line
+    # running into first_block belongs to the previous range, and the last line is
+    # completed from the blocks that follow, so adjacent ranges split the file's
+    # lines between them exactly once.
+    with open(path, "rb") as input_file:
+        skip_partial = False
+        for previous_block in range(first_block - 1, -1, -1):
+            input_file.seek(block_offsets[previous_block])
+            previous = read_block(input_file)
+            if previous:
+                skip_partial = not previous.endswith(b"\n")
+                break
+
+        input_file.seek(block_offsets[first_block])
+        pending = b""
+        for _ in range(first_block, last_block):
+            pending += read_block(input_file)
+            lines = pending.split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                if skip_partial:
+                    skip_partial = False
+                    continue
+                yield line + b"\n"
+
+        if skip_partial or not pending:
+            return
+
+        while True:
+            data = read_block(input_file)
+            if data is None:
+                yield pending
+                return
+            pending += data
+            if b"\n" in pending:
+                yield pending[:pending.index(b"\n") + 1]
+                return
+
+
+def is_bgzf_header(header):
+    return len(header) >= 18 and header[:4] == b"\x1f\x8b\x08\x04" and header[12:16] == b"BC\x02\x00"
+
+
+def read_compressed_blocks(input_file, count):
+    # Up to count whole compressed blocks from the current position, without decompressing them
+    blocks = []
+    while len(blocks) < count:
+        header = input_file.read(18)
+        if not header:
+            break
+        if not is_bgzf_header(header):
+            raise ValueError(f"Not a BGZF block at offset {input_file.tell() - len(header)} of {input_file.name}")
+        block_size = struct.unpack("<H", header[16:18])[0] + 1
+        block = header + input_file.read(block_size - 18)
+        if len(block) < block_size:
+            raise ValueError(f"Truncated BGZF block at the end of {input_file.name}")
+        blocks.append(block)
+    return blocks
+
+
+def inflate_blocks(blocks):
+    # Decompress and check blocks read by read_compressed_blocks(); zlib releases
+    # the GIL, so this runs in parallel on a thread pool
+    data = []
+    for block in blocks:
+        inflated = zlib.decompress(block[18:-8], -15)
+        crc, size = struct.unpack("<II", block[-8:])
+        if len(inflated) != size or zlib.crc32(inflated) & 0xffffffff != crc:
+            raise ValueError("BGZF block failed its CRC check")
+        data.append(inflated)
+    return b"".join(data)
+
+
+def read_inflated_chunks(path, threads, metrics=None):
+    # Uncompressed data of a BGZF file in order, BLOCKS_PER_BATCH blocks at a time,
+    # with up to 2 * threads groups of blocks decompressed ahead on the thread
+    # pool; a slow reader stops the read-ahead, so memory stays bounded however
+    # large the file. Files that are not BGZF (plain gzip) can't be split into
+    # blocks and are decompressed on the calling thread. With metrics the
+    # read-ahead depth and waits are counted there, as in BgzfWriter.
+    with open(path, "rb") as input_file:
+        if not is_bgzf_header(input_file.read(18)):
+            input_file.seek(0)
+            with gzip.open(input_file, "rb") as gz_file:
+                for chunk in iter(lambda: gz_file.read(BLOCK_SIZE * BLOCKS_PER_BATCH), b""):
+                    yield chunk
+            return
+
+        input_file.seek(0)
+        executor = ThreadPoolExecutor(threads)
+        try:
+            pending = deque()
+            while True:
+                blocks = read_compressed_blocks(input_file, BLOCKS_PER_BATCH)
+                if blocks:
+                    pending.append(executor.submit(inflate_blocks, blocks))
+                while pending and (not blocks or len(pending) > 2 * threads):
+                    # Groups of blocks already decompressed ahead of the reader; waiting
+                    # for the next one means decompression is what holds the reader back
+                    if metrics is not None:
+                        metrics.count("read_ahead_batches")
+                        metrics.count("read_ahead_depth", sum(future.done() for future in pending))
+                    with wait_timer(metrics, "read_wait"):
+                        chunk = pending.popleft().result()
+                    yield chunk
+                if not blocks:
+                    return
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+
+def read_line_batches(path, threads=None, decode=False, metrics=None):
+    # Lines of a gzip or BGZF file, newline included, in batches of about 1 MB,
+    # decompressed on threads (default read_threads) for BGZF. Lines are bytes,
+    # or str with decode=True; splitting them into columns is up to the caller,
+    # for the lines it needs.
+    newline = "\n" if decode else b"\n"
+    pending = b""
+    for chunk in read_inflated_chunks(path, threads or read_threads, metrics):
+        data = pending + chunk
+        end = data.rfind(b"\n") + 1
+        pending = data[end:]
+        if end:
+            lines = (data[:end].decode("utf-8") if decode else data[:end]).split(newline)
+            lines.pop()  # Empty, after the last newline
+            yield [line + newline for line in lines]
+
+    if pending:
+        yield [pending.decode("utf-8") if decode else pending]
+
+
+def read_file_lines(path, threads=None, decode=False, metrics=None):
+    # The lines of read_line_batches() one at a time, like iterating over gzip.open()
+    for batch in read_line_batches(path, threads, decode, metrics):
+        yield from batch
+
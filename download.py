@@ -1,48 +1,214 @@
+import argparse
+import hashlib
 import os
 import requests
-import gzip
 import sys
-
-def download_bed_file(url, output_dir):
+import time
+import zlib
+
+from bgzf import BgzfWriterPool, read_file_lines
+from http_cache import HttpCache
+
+def replay_file(file_path, chunk_size=1 << 16):
+    with open(file_path, "rb") as input_file:
+        for chunk in iter(lambda: input_file.read(chunk_size), b""):
+            yield chunk
+
+def check_cached_checksum(url, entry, expected_sha256):
+    if expected_sha256 and entry["sha256"] != expected_sha256.lower():
+        raise IOError(f"Checksum mismatch for cached {url}: expected {expected_sha256}, got {entry['sha256']}")
+
+def get_resume_validator(response_headers):
+    # Validator for If-Range: a strong ETag, else Last-Modified, else None
+    etag = response_headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response_headers.get("Last-Modified")
+
+def read_resume_validator(validator_path):
+    if not os.path.exists(validator_path):
+        return None
+    with open(validator_path, "r") as validator_file:
+        return validator_file.read().strip() or None
+
+def write_resume_validator(validator_path, validator):
+    if validator is None:
+        if os.path.exists(validator_path):
+            os.remove(validator_path)
+        return
+    with open(validator_path + ".tmp", "w") as validator_file:
+        validator_file.write(validator + "\n")
+    os.replace(validator_path + ".tmp", validator_path)
+
+def stream_bed_file(url, file_path, expected_sha256=None, chunk_size=1 << 16, cache=None):
+    # Yield the file chunk by chunk while it downloads to file_path + ".part".
+    # If an earlier run left a partial download behind, its bytes are replayed from
+    # disk first and only the remainder is requested with an HTTP Range header.
+    # The range is conditional on the ETag/Last-Modified of the response the
+    # partial file came from (saved in file_path + ".part.validator"), so a file
+    # that changed on the server since is downloaded again from the start.
+    # With a cache, an unchanged file is revalidated and replayed from the cache.
+    part_path = file_path + ".part"
+    validator_path = part_path + ".validator"
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    validator = read_resume_validator(validator_path)
+    if offset and validator is None:
+        # Nothing to tell whether the partial file still belongs to the server's file
+        print(f"Can't check that {part_path} is still current, downloading {url} from the start")
+        os.remove(part_path)
+        offset = 0
+
+    entry = cache.lookup(url) if cache is not None else None
+    if cache is not None and cache.offline:
+        if entry is None:
+            raise IOError(f"{url} is not cached, cannot download it in offline mode")
+        check_cached_checksum(url, entry, expected_sha256)
+        cache.restore_file(entry, file_path)
+        yield from replay_file(file_path, chunk_size)
+        return
+
+    if offset:
+        headers = {"Range": f"bytes={offset}-", "If-Range": validator}
+    elif cache is not None:
+        headers = cache.conditional_headers(entry)
+    else:
+        headers = {}
+    response = requests.get(url, headers=headers, stream=True, timeout=60)
+    try:
+        if response.status_code == 304 and entry is not None:
+            # Not modified since it was cached
+            check_cached_checksum(url, entry, expected_sha256)
+            cache.restore_file(entry, file_path)
+            remaining = None
+        elif response.status_code == 416:
+            # Range not satisfiable: the partial file already holds everything
+            expected_size = int(response.headers.get("Content-Range", "*/-1").split("/")[-1])
+            remaining = response
+        else:
+            response.raise_for_status()
+            if response.status_code != 206:
+                # The file changed since the partial download (or the server ignored
+                # the Range header), start over
+                offset = 0
+                write_resume_validator(validator_path, get_resume_validator(response.headers))
+            if "Content-Range" in response.headers:
+                expected_size = int(response.headers["Content-Range"].split("/")[-1])
+            elif "Content-Length" in response.headers:
+                expected_size = offset + int(response.headers["Content-Length"])
+            else:
+                expected_size = -1
+            remaining = response
+
+        if remaining is None:
+            yield from replay_file(file_path, chunk_size)
+            return
+
+        checksum = hashlib.sha256()
+        size = 0
+        with open(part_path, "r+b" if offset else "wb") as part_file:
+            while size < offset:
+                chunk = part_file.read(min(chunk_size, offset - size))
+                if not chunk:
+                    break
+                checksum.update(chunk)
+                size += len(chunk)
+                yield chunk
+
+            part_file.seek(size)
+            part_file.truncate()
+            if response.status_code != 416:
+                for chunk in response.iter_content(chunk_size):
+                    part_file.write(chunk)
+                    checksum.update(chunk)
+                    size += len(chunk)
+                    yield chunk
+    finally:
+        response.close()
+
+    # A short read keeps the partial file so the next run can resume it
+    if expected_size >= 0 and size != expected_size:
+        raise IOError(f"Incomplete download of {url}: got {size} of {expected_size} bytes")
+
+    if expected_sha256 and checksum.hexdigest() != expected_sha256.lower():
+        os.remove(part_path)
+        write_resume_validator(validator_path, None)
+        raise IOError(f"Checksum mismatch for {url}: expected {expected_sha256}, got {checksum.hexdigest()}")
+
+    os.replace(part_path, file_path)
+    write_resume_validator(validator_path, None)
+    if cache is not None:
+        cache.store_file(url, file_path, checksum.hexdigest(), response.headers)
+
+def download_bed_file(url, output_dir, expected_sha256=None, cache=None):
     os.makedirs(output_dir, exist_ok=True)
 
-    response = requests.get(url)
     file_name = os.path.basename(url)
     file_path = os.path.join(output_dir, file_name)
 
-    with open(file_path, "wb") as output_file:
-        output_file.write(response.content)
+    for _ in stream_bed_file(url, file_path, expected_sha256, cache=cache):
+        pass
 
     return file_path
 
-def process_bed_file(input_path, output_dir):
+def gunzip_lines(chunks):
+    # Decompress a stream of gzip chunks (single or multi-member) into lines
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)
+    pending = b""
+    for chunk in chunks:
+        while chunk:
+            pending += decompressor.decompress(chunk)
+            if decompressor.eof:
+                # Start of the next gzip member
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)
+            else:
+                chunk = b""
+
+            lines = pending.split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                yield line + b"\n"
+
+    if pending:
+        yield pending
+
+def split_bed_lines(lines, output_dir, max_open_files=128):
+    # Split BED lines into one BGZF-compressed file per motif name in a single
+    # pass, keeping at most max_open_files output files open at a time
     os.makedirs(output_dir, exist_ok=True)
 
-    with gzip.open(input_path, "rt", encoding="utf-8") as gz_file:
-        for line in gz_file:
-            if line.startswith("#"):
+    start_time = time.time()
+    records = 0
+
+    with BgzfWriterPool(lambda name: os.path.join(output_dir, f"{name}.bed.gz"), max_open_files) as writers:
+        for line in lines:
+            if line.startswith(b"#"):
                 continue
 
-            columns = line.strip().split("\t")
+            columns = line.strip().split(b"\t")
             if len(columns) >= 4:
-                fourth_column_value = columns[3]
-                output_file_name = os.path.join(output_dir, f"{fourth_column_value}.bed")
+                fourth_column_value = columns[3].decode("utf-8")
+                writers.write(fourth_column_value, line)
+                records += 1
 
-                with open(output_file_name, "a") as output_file:
-                    output_file.write(line)
+    elapsed = time.time() - start_time
+    print(f"Split {records} records into {len(writers)} files in {elapsed:.1f}s ({records / max(elapsed, 1e-9):.0f} records/s)")
 
-def compress_bed_files(output_dir):
-    for bed_file in os.listdir(output_dir):
-        if bed_file.endswith(".bed"):
-            bed_file_path = os.path.join(output_dir, bed_file)
-            os.system(f"bgzip {bed_file_path}")
+def process_bed_file(input_path, output_dir, max_open_files=128):
+    # BGZF input is decompressed on a thread pool
+    split_bed_lines(read_file_lines(input_path), output_dir, max_open_files)
 
 def main():
-    if len(sys.argv) != 2:
-        print("Usage: python download_bed_files.py <genome_build>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Download and split HOMER known motifs by motif name")
+    parser.add_argument("genome_build", help="hg19 or hg38")
+    parser.add_argument("--max-open-files", type=int, default=128, help="maximum number of split output files kept open at once")
+    parser.add_argument("--url", help="download from this URL instead of the HOMER server")
+    parser.add_argument("--sha256", help="expected SHA-256 checksum of the downloaded file")
+    parser.add_argument("--cache-dir", default=".http_cache", help="directory of the local HTTP cache")
+    parser.add_argument("--offline", action="store_true", help="use the cached download instead of contacting the server")
+    args = parser.parse_args()
 
-    genome_build = sys.argv[1]
+    genome_build = args.genome_build
 
     raw_files_dir = "raw_files_download"
     hg19_url = "http://homer.ucsd.edu/homer/data/motifs/homer.KnownMotifs.hg19.191020.bed.gz"
@@ -56,11 +222,30 @@ def main():
         print("Invalid genome build. Supported values: hg19, hg38")
         sys.exit(1)
 
-    original_bed_path = download_bed_file(download_url, raw_files_dir)
+    if args.url:
+        download_url = args.url
 
+    cache = HttpCache(args.cache_dir, offline=args.offline)
     output_dir = f"split_by_motifName/{genome_build}"
-    process_bed_file(original_bed_path, output_dir)
-    compress_bed_files(output_dir)
+
+    # Nothing to do if the file is unchanged and was already split
+    entry = cache.validate(download_url)
+    source_stamp = os.path.join(output_dir, ".source.sha256")
+    if entry is not None and os.path.exists(source_stamp):
+        with open(source_stamp, "r") as stamp_file:
+            if stamp_file.read().strip() == entry["sha256"]:
+                print(f"{download_url} is unchanged and already split into {output_dir}. Skipping.")
+                return
+
+    # Split while downloading: chunks go through the gzip decoder into the splitter
+    os.makedirs(raw_files_dir, exist_ok=True)
+    original_bed_path = os.path.join(raw_files_dir, os.path.basename(download_url))
+    chunks = stream_bed_file(download_url, original_bed_path, args.sha256, cache=cache)
+
+    split_bed_lines(gunzip_lines(chunks), output_dir, args.max_open_files)
+
+    with open(source_stamp, "w") as stamp_file:
+        stamp_file.write(cache.lookup(download_url)["sha256"] + "\n")
 
     print("All BED files created and compressed.")
 
@@ -0,0 +1,114 @@
+import mmap
+import os
+
+# In-process replacement for `samtools faidx`: the .fai index gives, for every
+# sequence, its length, the byte offset of its first base, the number of bases
+# per line and the number of bytes per line (bases + newline). From those the
+# byte range of any region can be computed and sliced out of a memory-mapped
+# FASTA file without spawning a subprocess.
+
+
+def read_fai(index_path):
+    index = {}
+    with open(index_path, "r") as index_file:
+        for line in index_file:
+            columns = line.rstrip("\n").split("\t")
+            if len(columns) < 5:
+                continue
+            # name, length, offset, line bases, line width
+            index[columns[0]] = (int(columns[1]), int(columns[2]), int(columns[3]), int(columns[4]))
+    return index
+
+
+class IndexedFasta:
+    def __init__(self, fasta_path, index_path=None):
+        if index_path is None:
+            index_path = fasta_path + ".fai"
+        if not os.path.exists(index_path):
+            raise FileNotFoundError(f"FASTA index {index_path} not found, create it with `samtools faidx {fasta_path}`")
+
+        self.fasta_path = fasta_path
+        self.index = read_fai(index_path)
+        self._file = open(fasta_path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _byte_offset(self, entry, position):
+        length, offset, line_bases, line_width = entry
+        return offset + (position // line_bases) * line_width + position % line_bases
+
+    def fetch_bytes(self, chrom, start, end):
+        # 0-based, half-open coordinates; clamped to the sequence like samtools
+        if chrom not in self.index:
+            raise KeyError(f"Sequence {chrom} not found in {self.fasta_path}")
+
+        entry = self.index[chrom]
+        length = entry[0]
+        start = max(start, 0)
+        end = min(end, length)
+        if start >= end:
+            return b""
+
+        raw = self._mmap[self._byte_offset(entry, start):self._byte_offset(entry, end - 1) + 1]
+        return raw.replace(b"\n", b"").replace(b"\r", b"")
+
+    def fetch(self, chrom, start, end):
+        return self.fetch_bytes(chrom, start, end).decode("ascii")
+
+    def fetch_many(self, intervals, max_gap=0):
+        # Batch extraction of (chrom, start, end) intervals, 0-based half-open.
+        # Intervals are sorted by chromosome and start, and runs of overlapping or
+        # adjacent intervals (closer than max_gap) are read once as a single slice
+        # that every member is cut from. Sequences are returned in input order.
+        sequences = [None] * len(intervals)
+        order = sorted(range(len(intervals)), key=lambda i: (intervals[i][0], intervals[i][1]))
+
+        cluster = []
+        cluster_chrom, cluster_start, cluster_end = None, 0, 0
+        for i in order:
+            chrom, start, end = intervals[i]
+            if cluster and chrom == cluster_chrom and start <= cluster_end + max_gap:
+                cluster.append(i)
+                cluster_end = max(cluster_end, end)
+                continue
+
+            if cluster:
+                self._slice_cluster(intervals, cluster, cluster_chrom, cluster_start, cluster_end, sequences)
+            cluster = [i]
+            cluster_chrom, cluster_start, cluster_end = chrom, max(start, 0), end
+
+        if cluster:
+            self._slice_cluster(intervals, cluster, cluster_chrom, cluster_start, cluster_end, sequences)
+
+        return sequences
+
+    def _slice_cluster(self, intervals, cluster, chrom, cluster_start, cluster_end, sequences):
+        buffer = self.fetch(chrom, cluster_start, cluster_end)
+        for i in cluster:
+            start, end = intervals[i][1], intervals[i][2]
+            start = max(start, cluster_start)
+            if start >= end:
+                sequences[i] = ""
+            else:
+                sequences[i] = buffer[start - cluster_start:end - cluster_start]
+
+
+# One handle per FASTA path and process, so every lookup reuses the same mapping
+_open_fastas = {}
+
+
+def open_fasta(fasta_path):
+    fasta = _open_fastas.get(fasta_path)
+    if fasta is None:
+        fasta = IndexedFasta(fasta_path)
+        _open_fastas[fasta_path] = fasta
+    return fasta
@@ -1,28 +1,35 @@
-import gzip
-import subprocess
+import argparse
+import shutil
 import os
 import concurrent.futures
 import sys
+import time
+import traceback
 
-genome_build = sys.argv[1]
+import bgzf
+from fasta_reader import open_fasta
+from manifest import BuildManifest, sha256_text
+from metrics import Metrics, MetricsLog, Progress, run_measured, start_profiler, task_metrics
+from motif_catalog import load_catalog
+from motif_score import load_ambiguous_motifs, score_motif_file
+from parquet_output import get_partition_directory, import_pyarrow, write_parquet
+from regions import load_region_set
+from sequence_utils import get_binding_sequences, get_fasta_path
+from tabix import TabixIndex, index_bgzf_file, merge_chunks, read_index, replace_indexed
 
-input_directory = f"/mnt/ebs/jackal/FILER2/FILER2-production/Homer/motif/split_by_motifName/{genome_build}/"
-output_directory = f"/mnt/ebs/jackal/FILER2/FILER2-production/Homer/motif/processed_bed/{genome_build}/"
-#output_directory = f"/mnt/ebs/jackal/FILER2/FILER2-production/Homer/motif/"
+input_root = "/mnt/ebs/jackal/FILER2/FILER2-production/Homer/motif/split_by_motifName"
+output_root = "/mnt/ebs/jackal/FILER2/FILER2-production/Homer/motif/processed_bed"
+#output_root = "/mnt/ebs/jackal/FILER2/FILER2-production/Homer/motif"
 
-def get_reference(genome_build, sequenceID):
-    if genome_build == "hg19":
-        fa = "hg19.fa"
-    elif genome_build == "hg38":
-        fa = "hg38.fa"
-    else:
-        raise ValueError("Invalid genome build specified")
+# Number of BED records whose sequences are extracted together in one sorted pass
+batch_size = 200000
+
+# Motif files larger than this many compressed bytes are split into chunks of
+# about this size, processed in parallel and merged back in order
+chunk_size = 32 * 1024 * 1024
 
-    output = subprocess.check_output(["samtools", "faidx", fa, sequenceID]).decode("utf-8")
-    lines = output.split('\n')
-    ref_sequence = ''.join(lines[1:])
-    ref_sequence = ref_sequence.lower() # Convert to lowercase
-    return ref_sequence
+#header_line = "#chrom\tchromStart\tchromEnd\tname\tscore\tstrand\tmotif_length\tmotifID\tDNA_binding_domain\tcell_type\tbinding_sequence\tconsensus_length\treverse_strand\n"
+header_line = "#chrom\tchromStart\tchromEnd\tname\tscore\tstrand\tmotifID\tDNA_binding_domain\tcell_type\tbinding_sequence\tconsensus_sequence\n"
 
 def get_cellandmotif(name, length, column_mapping):
     key_with_length = (name, length)  # Create the key using name and length
@@ -45,97 +52,488 @@ def get_cellandmotif(name, length, column_mapping):
 
     return motif_id, cell_type, DNA_binding, consensus_length
 
-def get_reverse_complement(sequence):
-    complement = {'a': 't', 'c': 'g', 'g': 'c', 't': 'a'}
-    reverse_complement = ''
-    sequence = sequence.lower()  # Convert to lowercase
-    for base in reversed(sequence):
-        if base in complement:
-            reverse_complement += complement[base]
-        else:
-            reverse_complement += base
-    return reverse_complement
+# Motif metadata, loaded once per process from the compiled motif catalog by
+# load_metadata(): the data dictionary, the motif names that map to several
+# motifs with their PWMs, the per-motif metadata used to annotate those and the
+# raw metadata rows of every name
+column_mapping = None
+ambiguous_motifs = None
+parsed_dict = None
+metadata_rows = None
+
+def load_metadata():
+    global column_mapping, ambiguous_motifs, parsed_dict, metadata_rows
+    if column_mapping is None:
+        catalog = load_catalog()
+        column_mapping = catalog.column_mapping
+        ambiguous_motifs = load_ambiguous_motifs(catalog)
+        parsed_dict = catalog.parsed_dict
+        metadata_rows = catalog.metadata_rows
+
+def init_worker(profile_directory=None, read_threads=None, genome_builds=()):
+    # Pool initializer: load the metadata, open the FASTA of every genome build
+    # the worker will read, set the input decompression threads and, if asked,
+    # sample the worker's stacks
+    load_metadata()
+    for genome_build in genome_builds:
+        open_fasta(get_fasta_path(genome_build))
+    if read_threads is not None:
+        bgzf.read_threads = read_threads
+    if profile_directory is not None:
+        start_profiler(profile_directory)
+
+def format_batch(batch, genome_build):
+    # Output lines of a batch of records. The sequences of all records in the
+    # batch are fetched at once, on their strand; the 1-based BED start becomes a
+    # 0-based start for the half-open interval.
+    metrics = task_metrics()
+    intervals = [(columns[0], int(columns[1]) - 1, int(columns[2])) for columns in batch]
+    with metrics.timer("sequence_fetch"):
+        binding_sequences = get_binding_sequences(genome_build, intervals, [columns[5] for columns in batch])
+
+    output_lines = []
+    with metrics.timer("write"):
+        for columns, binding_sequence in zip(batch, binding_sequences):
+            motif_length = int(columns[2]) - int(columns[1]) + 1
 
-# Load the data dictionary from parsed_subheadings.txt
-column_mapping = {}
+            motif_id, cell_type, DNA_binding, consensus_sequence = get_cellandmotif(columns[3], str(motif_length), column_mapping)
 
-with open("parsed_subheadings.txt", "r") as parsed_file:
-    next(parsed_file)  # Skip the header line
-    for line in parsed_file:
+            output_line = "\t".join([columns[0], str(int(columns[1]) - 1), columns[2], columns[3], columns[4], columns[5]] + [ motif_id, DNA_binding, cell_type, binding_sequence, consensus_sequence])
+            output_lines.append(output_line + "\n")
+    metrics.count("records_written", len(batch))
+    return output_lines
+
+def write_batch(batch, output_file, genome_build):
+    output_lines = format_batch(batch, genome_build)
+    with task_metrics().timer("write"):
+        output_file.write("".join(output_lines))
+
+def get_skip_reason(columns):
+    # Why a record of a motif name with a single motif is not annotated, or None
+    motif_length = int(columns[2]) - int(columns[1]) + 1  # Calculate motif_length, 1-based coordinate system
+    key = (columns[3], str(motif_length))
+    if key not in column_mapping:
+        return "unknown_motif"
+    # Skip the record if motif_length doesn't match the consensus_sequence length
+    if motif_length != len(column_mapping[key][3]):
+        return "length_mismatch"
+    return None
+
+def annotate_lines(lines, output_file, genome_build):
+    # Process lines on-the-fly, extracting sequences batch by batch. Skipped
+    # records are counted by reason in the task metrics.
+    batch = []
+    records_read = 0
+    skipped = {}
+    for line in lines:
+        if line.startswith("#"):  # Skip comment lines
+            continue
+
+        records_read += 1
         columns = line.strip().split("\t")
-        # Extract the keys (columns[1] and columns[12]) and value (columns 0 and 4) from the current line
-        key = (columns[1], columns[10])
-        value = [columns[0], columns[4], columns[3], columns[9]]
-        # Add the key-value pair to the dictionary
-        column_mapping[key] = value
+        skip_reason = get_skip_reason(columns)
+        if skip_reason is not None:
+            skipped[skip_reason] = skipped.get(skip_reason, 0) + 1
+            continue
 
-# Create the output directory if it doesn't exist
-os.makedirs(output_directory, exist_ok=True)
+        batch.append(columns)
+        if len(batch) >= batch_size:
+            write_batch(batch, output_file, genome_build)
+            batch = []
 
-def process_file(input_filepath):
-    input_filename = os.path.basename(input_filepath)  # Extract the input filename
-    output_filename = input_filename.replace(".bed.gz", ".processed.bed")
-    output_filepath = os.path.join(output_directory, output_filename)
+    if batch:
+        write_batch(batch, output_file, genome_build)
 
-    # Check if the output file (with .gz extension) exists in the output directory
-    if os.path.exists(output_filepath + ".gz"):
-        print(f"Output file {output_filepath}.gz already exists. Skipping.")
+    metrics = task_metrics()
+    metrics.count("records_read", records_read)
+    metrics.count("records_kept", records_read - sum(skipped.values()))
+    for skip_reason in ("unknown_motif", "length_mismatch"):
+        metrics.count("skipped_" + skip_reason, skipped.get(skip_reason, 0))
+
+def plan_chunks(input_filepath, max_chunk_size=chunk_size):
+    # Block ranges (block_offsets, first_block, last_block) of about max_chunk_size
+    # compressed bytes each, or [None] to process the file in one piece
+    if os.path.getsize(input_filepath) <= max_chunk_size:
+        return [None]
+    block_offsets = bgzf.read_block_offsets(input_filepath)
+    if block_offsets is None:
+        return [None]
+
+    block_ranges = []
+    first_block = 0
+    for index, offset in enumerate(block_offsets):
+        if offset - block_offsets[first_block] >= max_chunk_size:
+            block_ranges.append((block_offsets, first_block, index))
+            first_block = index
+    block_ranges.append((block_offsets, first_block, len(block_offsets)))
+    return block_ranges
+
+def process_chunk(input_filepath, shard_path, genome_build, block_range, write_header=True, compress_threads=1, lines=None, parquet_path=None):
+    # Annotate one chunk of a motif file (or all of it, or the given lines) into a
+    # BGZF shard, without EOF marker so the shards can be concatenated. Returns the
+    # shard's tabix index (None if its records can't be indexed), with offsets
+    # relative to the shard. With parquet_path the shard is also written there as
+    # one Parquet part file.
+    load_metadata()
+    with bgzf.BgzfWriter(shard_path, threads=compress_threads, index=TabixIndex(), metrics=task_metrics()) as output_file:
+        if write_header:
+            output_file.write(header_line)
+        if lines is not None:
+            annotate_lines(lines, output_file, genome_build)
+        elif block_range is None:
+            annotate_lines(bgzf.read_file_lines(input_filepath, decode=True, metrics=task_metrics()), output_file, genome_build)
+        else:
+            block_offsets, first_block, last_block = block_range
+            lines = (line.decode("utf-8") for line in bgzf.read_lines(input_filepath, block_offsets, first_block, last_block))
+            annotate_lines(lines, output_file, genome_build)
+        output_file.close(write_eof=False)
+
+    if parquet_path is not None:
+        with task_metrics().timer("parquet"):
+            write_parquet(shard_path, parquet_path, skip_rows=1 if write_header else 0)
+    return output_file.index
+
+def process_ambiguous_file(input_filepath, output_directory, genome_build, compress_threads=1, parquet_path=None):
+    #  Names shared by several motifs of the same length are disambiguated by PWM score
+    load_metadata()
+    motif_name = os.path.basename(input_filepath).replace(".bed.gz", "")
+    print(f"Scoring {os.path.basename(input_filepath)} against {', '.join(ambiguous_motifs[motif_name].motif_numbers)}")
+    score_motif_file(input_filepath, output_directory, genome_build, ambiguous_motifs[motif_name], parsed_dict, compress_threads, parquet_path=parquet_path)
+
+def get_input_index(input_filepath, index_directory):
+    # Tabix index of a split motif file, built on first use and cached as
+    # <index_directory>/<motif>.bed.gz.tbi, so the input tree can be read-only;
+    # None if the file is not BGZF or not sorted. Starts are 1-based in these files.
+    index_path = os.path.join(index_directory, os.path.basename(input_filepath) + ".tbi")
+    if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(input_filepath):
+        return read_index(index_path)
+    if bgzf.read_block_offsets(input_filepath) is None:
+        return None
+
+    try:
+        index = index_bgzf_file(input_filepath, TabixIndex(zero_based=False))
+    except ValueError as error:
+        print(f"Can't index {input_filepath}: {error}")
+        return None
+    try:
+        os.makedirs(index_directory, exist_ok=True)
+        index.write(index_path + ".tmp")
+        os.replace(index_path + ".tmp", index_path)
+    except OSError as error:
+        # Still usable for this run
+        print(f"Can't save the index of {input_filepath}: {error}")
+    return index
+
+def query_lines(input_filepath, region_set, index_directory):
+    # Records of a motif file overlapping the regions, in file order. Only the
+    # parts of the file the index points to for the regions are decompressed.
+    index = get_input_index(input_filepath, index_directory)
+    if index is None:
+        # Filter the whole file instead
+        for line in bgzf.read_file_lines(input_filepath, decode=True, metrics=task_metrics()):
+            columns = line.split("\t", 3)
+            if not line.startswith("#") and region_set.overlaps(columns[0], int(columns[1]) - 1, int(columns[2])):
+                yield line
         return
 
-    #  Check if the current file matches the three specified filenames
-    if input_filename in ["FOXA1(Forkhead).bed.gz", "Nr5a2(NR).bed.gz", "OCT:OCT(POU,Homeobox).bed.gz"]:
-        print(f"Running motif_score.py for {input_filename}")
-        subprocess.run(["python3", "motif_score.py", input_filepath, output_directory, genome_build])
+    chunks = []
+    for chrom, intervals in region_set.regions.items():
+        for start, end in intervals:
+            chunks.extend(index.query_chunks(chrom.encode(), start, end))
+
+    with open(input_filepath, "rb") as input_file:
+        for start_offset, end_offset in merge_chunks(chunks):
+            for line in bgzf.read_range(input_file, start_offset, end_offset).decode("utf-8").splitlines(keepends=True):
+                columns = line.split("\t", 3)
+                # Chunks can hold records next to the regions too
+                if not line.startswith("#") and region_set.overlaps(columns[0], int(columns[1]) - 1, int(columns[2])):
+                    yield line
+
+# Region sets by path, loaded once per process
+region_sets = {}
+
+def process_query(input_filepath, output_directory, genome_build, regions_path, compress_threads=1, parquet_path=None):
+    # Annotate only the records of a motif file overlapping the regions of a BED file
+    load_metadata()
+    if regions_path not in region_sets:
+        region_sets[regions_path] = load_region_set(regions_path)
+    region_set = region_sets[regions_path]
+    index_directory = os.path.join(output_directory, ".input_index")
+
+    motif_name = os.path.basename(input_filepath).replace(".bed.gz", "")
+    if motif_name in ambiguous_motifs:
+        # Queried again for a second pass if they turn out not to be sorted
+        score_motif_file(input_filepath, output_directory, genome_build, ambiguous_motifs[motif_name], parsed_dict, compress_threads, lambda: query_lines(input_filepath, region_set, index_directory), parquet_path)
         return
 
-    # Open the output file for writing
-    with open(output_filepath, "w", encoding="utf-8") as output_file:
-#        output_file.write("#chrom\tchromStart\tchromEnd\tname\tscore\tstrand\tmotif_length\tmotifID\tDNA_binding_domain\tcell_type\tbinding_sequence\tconsensus_length\treverse_strand\n")
-        output_file.write("#chrom\tchromStart\tchromEnd\tname\tscore\tstrand\tmotifID\tDNA_binding_domain\tcell_type\tbinding_sequence\tconsensus_sequence\n")
-        # Open the bed file and process lines on-the-fly
-        with gzip.open(input_filepath, "rt", encoding="utf-8") as bed_file:
-            for line in bed_file:
-                if line.startswith("#"):  # Skip comment lines
-                    continue
+    output_filepath = get_output_filepath(input_filepath, output_directory)
+    shard_path = output_filepath + ".shard0"
+    merge_shards(output_filepath, [shard_path], [process_chunk(input_filepath, shard_path, genome_build, None, True, compress_threads, query_lines(input_filepath, region_set, index_directory), parquet_path)])
+
+def merge_shards(output_filepath, shard_paths, shard_indexes):
+    # Concatenate the compressed shards in order and append the EOF marker; their
+    # tabix indexes are shifted to where each shard lands and merged. Everything
+    # goes through temp files that only replace the output once it is complete.
+    tmp_filepath = output_filepath + ".tmp"
+    index = TabixIndex()
+    with open(tmp_filepath, "wb") as output_file:
+        for shard_path, shard_index in zip(shard_paths, shard_indexes):
+            if index is not None and shard_index is not None:
+                try:
+                    index.extend(shard_index, output_file.tell())
+                except ValueError as error:
+                    print(f"Not indexing {output_filepath}.gz: {error}")
+                    index = None
+            else:
+                index = None
+            with open(shard_path, "rb") as shard_file:
+                shutil.copyfileobj(shard_file, output_file)
+            os.remove(shard_path)
+        output_file.write(bgzf.BGZF_EOF)
+
+    replace_indexed(tmp_filepath, output_filepath + ".gz", index)
+
+    print(f"Output written to {output_filepath}.gz")
+
+def get_output_filepath(input_filepath, output_directory):
+    input_filename = os.path.basename(input_filepath)  # Extract the input filename
+    output_filename = input_filename.replace(".bed.gz", ".processed.bed")
+    return os.path.join(output_directory, output_filename)
+
+def get_part_path(partition_directory, part_number):
+    # Parquet part file of a chunk, or None without Parquet output
+    if partition_directory is None:
+        return None
+    return os.path.join(partition_directory, f"part-{part_number}.parquet")
+
+def get_build_inputs(input_filepath, genome_build, manifest, regions_path=None):
+    # Digests of everything an output depends on: its input BED, the metadata rows
+    # of its motif name, the PWMs used to disambiguate it, the genome build and
+    # the regions it was restricted to
+    motif_name = os.path.basename(input_filepath).replace(".bed.gz", "")
+    fasta_path = get_fasta_path(genome_build)
+
+    pwms = {}
+    if motif_name in ambiguous_motifs:
+        for pwm in ambiguous_motifs[motif_name].pwms:
+            pwms[pwm.motif_number] = manifest.file_digest(os.path.join("motif_files", f"{pwm.motif_number}.motif"))
+
+    inputs = {
+        "bed": manifest.file_digest(input_filepath),
+        "metadata": sha256_text(metadata_rows.get(motif_name, "")),
+        "pwms": pwms,
+        "genome": {"build": genome_build, "fasta": manifest.file_digest(fasta_path), "index": manifest.file_digest(fasta_path + ".fai")},
+    }
+    if regions_path is not None:
+        inputs["regions"] = manifest.file_digest(regions_path)
+    return inputs
+
+def get_task_bytes(input_filepath, block_range):
+    # Compressed input bytes a task covers, to measure progress by
+    if block_range is None:
+        return os.path.getsize(input_filepath)
+    block_offsets, first_block, last_block = block_range
+    end_offset = block_offsets[last_block] if last_block < len(block_offsets) else os.path.getsize(input_filepath)
+    return end_offset - block_offsets[first_block]
+
+def process_files(input_files, output_directory, genome_build, workers=None, executor_type="process", max_chunk_size=chunk_size, compress_threads=1, regions_path=None,
+                  metrics_path=None, profile_directory=None, progress_interval=5.0, parquet_directory=None, read_threads=None):
+    # Run every motif file of one genome build, see process_builds()
+    return process_builds([(genome_build, input_files, output_directory, parquet_directory)], workers, executor_type, max_chunk_size, compress_threads, regions_path,
+                          metrics_path, profile_directory, progress_interval, read_threads)
+
+def process_builds(builds, workers=None, executor_type="process", max_chunk_size=chunk_size, compress_threads=1, regions_path=None,
+                   metrics_path=None, profile_directory=None, progress_interval=5.0, read_threads=None):
+    # Run every motif file of one or more genome builds, given as (genome_build,
+    # input_files, output_directory, parquet_directory) tuples, split into chunks
+    # when large, on one shared pool of worker processes (or threads); with
+    # regions_path only the records overlapping its regions. The metadata is loaded
+    # once per worker, and each worker keeps one memory-mapped FASTA per build.
+    # Tasks are submitted largest first, so that no build's biggest files are left
+    # for the end of the run. Only outputs whose inputs changed since the manifest
+    # in their output directory recorded them are rebuilt. Errors are reported per
+    # file instead of being lost, and the input files that failed are returned.
+    # Each task's counters and stage timers are summed per output file, written to
+    # metrics_path as JSON lines and summarized at the end; progress is reported
+    # every progress_interval seconds (0 for never). With profile_directory every
+    # worker process saves its sampled stacks there.
+    # With a parquet_directory every output of that build is also written as
+    # Parquet, into the partition of its motif name (see parquet_output.py).
+    # read_threads threads decompress the input of each task.
+    load_metadata()
+    if any(parquet_directory is not None for genome_build, input_files, output_directory, parquet_directory in builds):
+        import_pyarrow()
+
+    if executor_type == "process":
+        executor_class = concurrent.futures.ProcessPoolExecutor
+    else:
+        executor_class = concurrent.futures.ThreadPoolExecutor
+        if profile_directory is not None:
+            raise ValueError("The sampling profiler needs worker processes, not threads")
+
+    tasks = []
+    futures = {}
+    task_bytes = {}
+    manifests = {}
+    build_inputs = {}
+    shards = {}
+    shard_indexes = {}
+    remaining = {}
+    failures = {}
+    file_metrics = {}
+    start_times = {}
+    partitions = {}
+    metrics_log = MetricsLog(metrics_path)
+    run_start = time.perf_counter()
+
+    for genome_build, input_files, output_directory, parquet_directory in builds:
+        os.makedirs(output_directory, exist_ok=True)
+        manifest = BuildManifest(os.path.join(output_directory, "manifest.json"))
+        for input_filepath in input_files:
+            output_filepath = get_output_filepath(input_filepath, output_directory)
+            motif_name = os.path.basename(input_filepath).replace(".bed.gz", "")
+            partition_directory = None
+            if parquet_directory is not None:
+                partition_directory = get_partition_directory(parquet_directory, motif_name)
+
+            inputs = get_build_inputs(input_filepath, genome_build, manifest, regions_path)
+            if manifest.is_current(output_filepath + ".gz", inputs) and (partition_directory is None or os.path.isdir(partition_directory)):
+                print(f"Output file {output_filepath}.gz is up to date. Skipping.")
+                continue
+            build_inputs[output_filepath] = inputs
+            manifests[output_filepath] = manifest
+
+            # Part files of an earlier run may not line up with this run's chunks
+            if partition_directory is not None:
+                shutil.rmtree(partition_directory, ignore_errors=True)
+                partitions[output_filepath] = partition_directory
+            file_metrics[output_filepath] = Metrics()
+
+            # Tasks as (input bytes, function, arguments, (input file, output file, shard number))
+            if regions_path is not None:
+                remaining[output_filepath] = 1
+                tasks.append((get_task_bytes(input_filepath, None), process_query, (input_filepath, output_directory, genome_build, regions_path, compress_threads, get_part_path(partition_directory, 0)),
+                              (input_filepath, output_filepath, None)))
+                continue
+
+            if motif_name in ambiguous_motifs:
+                remaining[output_filepath] = 1
+                tasks.append((get_task_bytes(input_filepath, None), process_ambiguous_file, (input_filepath, output_directory, genome_build, compress_threads, get_part_path(partition_directory, 0)),
+                              (input_filepath, output_filepath, None)))
+                continue
+
+            block_ranges = plan_chunks(input_filepath, max_chunk_size)
+            shards[output_filepath] = [f"{output_filepath}.shard{index}" for index in range(len(block_ranges))]
+            shard_indexes[output_filepath] = [None] * len(block_ranges)
+            remaining[output_filepath] = len(block_ranges)
+            for shard_number, (shard_path, block_range) in enumerate(zip(shards[output_filepath], block_ranges)):
+                tasks.append((get_task_bytes(input_filepath, block_range), process_chunk,
+                              (input_filepath, shard_path, genome_build, block_range, shard_number == 0, compress_threads, None, get_part_path(partition_directory, shard_number)),
+                              (input_filepath, output_filepath, shard_number)))
+
+        # Save the digests computed for the input files
+        manifest.save()
+
+    # Largest first; the sort is stable, so equal sizes keep their order
+    tasks.sort(key=lambda task: task[0], reverse=True)
+    genome_builds = sorted({genome_build for genome_build, input_files, output_directory, parquet_directory in builds})
 
-                columns = line.strip().split("\t")
-                motif_name = columns[3]  # Extract motif name
+    with executor_class(max_workers=workers, initializer=init_worker, initargs=(profile_directory, read_threads, genome_builds)) as executor:
+        for nbytes, function, args, task in tasks:
+            future = executor.submit(run_measured, function, *args)
+            futures[future] = task
+            task_bytes[future] = nbytes
+            output_filepath = task[1]
+            start_times.setdefault(output_filepath, time.perf_counter())
 
-                start = int(columns[1])
-                end = int(columns[2])
-                motif_length = end - start + 1  # Calculate motif_length, 1-based coordinate system
-                strand = columns[5]
-                sequenceID = f"{columns[0]}:{columns[1]}-{columns[2]}"
+        progress = Progress(len(file_metrics), sum(task_bytes.values()), progress_interval)
+        for future in concurrent.futures.as_completed(futures):
+            input_filepath, output_filepath, shard_number = futures[future]
+            try:
+                result, metrics = future.result()
+            except Exception:
+                print(f"Error processing {input_filepath}:\n{traceback.format_exc()}", file=sys.stderr)
+                if input_filepath not in failures:
+                    failures[input_filepath] = output_filepath
+                    metrics_log.record_file(input_filepath, output_filepath, file_metrics[output_filepath], time.perf_counter() - start_times[output_filepath], "failed")
+                    progress.update(files=1)
+                progress.update(nbytes=task_bytes[future])
+                continue
 
-                key = (columns[3], str(motif_length))
+            progress.update(nbytes=task_bytes[future])
+            if input_filepath in failures:
+                continue
+            file_metrics[output_filepath].merge(Metrics(metrics["counters"], metrics["stages"]))
+            if shard_number is not None:
+                shard_indexes[output_filepath][shard_number] = result
+            remaining[output_filepath] -= 1
+            if remaining[output_filepath] == 0:
+                if output_filepath in shards:
+                    with file_metrics[output_filepath].timer("merge"):
+                        merge_shards(output_filepath, shards[output_filepath], shard_indexes[output_filepath])
+                manifests[output_filepath].record(output_filepath + ".gz", build_inputs[output_filepath])
+                metrics_log.record_file(input_filepath, output_filepath, file_metrics[output_filepath], time.perf_counter() - start_times[output_filepath])
+                progress.update(files=1)
+        progress.finish()
 
-                if key in column_mapping:
-                    consensus_sequence = column_mapping[key][3]
-                    if motif_length != len(consensus_sequence):
-                        print(motif_length, "!=", consensus_sequence)
-                        # Skip this line as motif_length doesn't match consensus_sequence length
-                        continue
+    # Drop the shards and Parquet parts of files that failed part way
+    for output_filepath in failures.values():
+        for shard_path in shards.get(output_filepath, []):
+            if os.path.exists(shard_path):
+                os.remove(shard_path)
+        if output_filepath in partitions:
+            shutil.rmtree(partitions[output_filepath], ignore_errors=True)
 
-                    motif_id, cell_type, DNA_binding, consensus_sequence = get_cellandmotif(columns[3], str(motif_length), column_mapping)
+    metrics_log.summary(time.perf_counter() - run_start)
+    return list(failures)
 
-                    if strand == '+':
-                        binding_sequence = get_reference(genome_build, sequenceID)
-                    elif strand == '-':
-                        ref_sequence = get_reference(genome_build, sequenceID)
-                        binding_sequence = get_reverse_complement(ref_sequence)
+def main():
+    parser = argparse.ArgumentParser(description="Annotate the split HOMER motif BED files")
+    parser.add_argument("genome_builds", nargs="+", choices=["hg19", "hg38"], metavar="genome_build", help="hg19 and/or hg38; several builds run on one shared worker pool")
+    parser.add_argument("--input-root", default=input_root, help="directory holding the split motif files of each build, <root>/<build>/<motif>.bed.gz")
+    parser.add_argument("--output-root", default=output_root, help="directory holding the outputs of each build, <root>/<build>")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--executor", choices=["process", "thread"], default="process", help="run the workers as processes or threads")
+    parser.add_argument("--chunk-mb", type=int, default=chunk_size // (1024 * 1024), help="split motif files larger than this many compressed MB into chunks")
+    parser.add_argument("--compress-threads", type=int, default=1, help="threads compressing the output blocks of each worker")
+    parser.add_argument("--read-threads", type=int, default=bgzf.read_threads, help="threads decompressing the input blocks of each worker")
+    parser.add_argument("--regions", help="only annotate the records overlapping the regions of this BED file, e.g. peaks (needs --output-dir)")
+    parser.add_argument("--output-dir", help="output directory of a single build (default: <output root>/<build>)")
+    parser.add_argument("--metrics", help="write per-file counters and stage timings to this JSON-lines file")
+    parser.add_argument("--progress-interval", type=float, default=5.0, help="seconds between progress lines (0 to turn them off)")
+    parser.add_argument("--parquet-dir", help="also write every output as Parquet, partitioned by motif name (and build, with several builds), into this directory")
+    parser.add_argument("--profile-dir", help="sample the stacks of every worker process into <pid>.folded files in this directory")
+    args = parser.parse_args()
+    if args.profile_dir and args.executor != "process":
+        parser.error("--profile-dir needs --executor process")
 
-                    output_line = "\t".join([columns[0], str(int(columns[1]) - 1), columns[2], columns[3], columns[4], columns[5]] + [ motif_id, DNA_binding, cell_type, binding_sequence, consensus_sequence])
-                    output_file.write(output_line + "\n")
+    genome_builds = list(dict.fromkeys(args.genome_builds))
+    if len(genome_builds) > 1 and args.output_dir:
+        parser.error("--output-dir takes a single genome build, use --output-root for several")
+    if len(genome_builds) > 1 and args.regions:
+        parser.error("--regions takes a single genome build, region coordinates differ between builds")
+    if args.regions and not args.output_dir:
+        # The default directory holds the genome-wide outputs
+        parser.error("--regions needs --output-dir, a directory for the outputs restricted to the regions")
 
-        # Compress the output file using bgzip
-        subprocess.run(["bgzip", output_filepath])
+    builds = []
+    for genome_build in genome_builds:
+        input_directory = os.path.join(args.input_root, genome_build)
+        output_directory = args.output_dir or os.path.join(args.output_root, genome_build)
+        input_files = [os.path.join(input_directory, filename) for filename in sorted(os.listdir(input_directory)) if filename.endswith(".bed.gz")]
 
-        print(f"Output written to {output_filepath}")
+        # Several builds form one dataset partitioned by build, then motif name
+        parquet_directory = args.parquet_dir
+        if parquet_directory is not None and len(genome_builds) > 1:
+            parquet_directory = os.path.join(parquet_directory, f"build={genome_build}")
+        builds.append((genome_build, input_files, output_directory, parquet_directory))
 
-        print("Output compressed to", output_filepath + ".gz")
+    failures = process_builds(builds, args.workers, args.executor, args.chunk_mb * 1024 * 1024, args.compress_threads, args.regions,
+                              args.metrics, args.profile_dir, args.progress_interval, args.read_threads)
 
-# Process each input file using multiple threads
-with concurrent.futures.ThreadPoolExecutor() as executor:
-    input_files = [os.path.join(input_directory, filename) for filename in os.listdir(input_directory) if filename.endswith(".bed.gz")]
-    executor.map(process_file, input_files)
+    if failures:
+        print(f"{len(failures)} motif files failed: {', '.join(os.path.basename(path) for path in failures)}", file=sys.stderr)
+        sys.exit(1)
 
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,83 @@
+import argparse
 import re
 import os
+import sys
+import threading
+import time
+import concurrent.futures
 import requests
 from bs4 import BeautifulSoup
 
-def get_first_subheading(url):
-    try:
-        # Send a GET request to the URL to fetch the HTML content
-        response = requests.get(url)
+from http_cache import HttpCache
+
+homer_results_url = "http://homer.ucsd.edu/homer/motif/HomerMotifDB/homerResults"
+
+class MotifFetcher:
+    # Fetches URLs concurrently over one pooled session. Every URL is requested at
+    # most once; later requests for the same URL share the first one's result.
+    def __init__(self, max_workers=16, retries=3, backoff=0.5, timeout=30, cache=None):
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache = cache
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def _request(self, url):
+        if self.cache is not None:
+            return self.cache.get(url, self.session, self.timeout)
+
+        response = self.session.get(url, timeout=self.timeout)
         response.raise_for_status()  # Raise an exception for unsuccessful requests
+        return response.content
+
+    def _get(self, url):
+        for attempt in range(self.retries + 1):
+            try:
+                return self._request(url)
+            except requests.HTTPError as e:
+                if e.response.status_code not in (429, 500, 502, 503, 504) or attempt == self.retries:
+                    raise
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+            time.sleep(self.backoff * 2 ** attempt)
+
+    def submit(self, url):
+        with self._lock:
+            future = self._futures.get(url)
+            if future is None:
+                future = self._executor.submit(self._get, url)
+                self._futures[url] = future
+            return future
+
+    def fetch(self, url):
+        return self.submit(url).result()
+
+    def close(self):
+        self._executor.shutdown()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def get_first_subheading(url, fetcher):
+    try:
+        # Fetch the HTML content of the page
+        content = fetcher.fetch(url)
 
         # Parse the HTML content using BeautifulSoup
-        soup = BeautifulSoup(response.content, 'html.parser')
+        soup = BeautifulSoup(content, 'html.parser')
 
         # Find the first h2 element (sub-heading) in the HTML page
         h2_element = soup.find('h2')
@@ -26,125 +93,147 @@ def get_first_subheading(url):
         print(f"Error occurred while processing URL {url}: {e}")
         return None
 
-def get_motif_sequence_and_length(motif_name):
-    base_url = f'http://homer.ucsd.edu/homer/motif/HomerMotifDB/homerResults/{motif_name}.motif'
-    response = requests.get(base_url)
-
-    text_content = response.text
-    match = re.search(r">(\S+)", text_content)
-
-    if match:
-        sequence = match.group(1)
-        motif_length = len(sequence)
-    else:
-        sequence = "N/A"
-        motif_length = 0
-
-    return sequence, motif_length
+# Subheadings of the motif info pages, "Information for <name>/<experiment>/<resource> (Motif <n>)",
+# e.g. "Information for AP-1(bZIP)/ThioMac-PU.1-ChIP-Seq(GSE21512)/Homer (Motif 1)"
+SUBHEADING_RE = re.compile(r"^Information for (?P<heading>\S+) \(Motif (?P<number>\w+)\)$")
+
+# TF name and DNA binding domain, AP-1(bZIP) or FOXA1:AR(Forkhead,NR)
+NAME_RE = re.compile(r"^(?P<tf_name>[^(]*)\((?P<dna_domain>[^(]*)$")
+
+# Experiments: <cell type>-<protein>-<assay>[(<origin>)], e.g. ThioMac-LPS-Expression(GSE23622),
+# HUDEP2-KLF1-CutnRun(GSE136251) or ZebrafishEmbryos-Cdx4.Myc-ChIP-Seq(GSE48254)
+EXPERIMENT_RE = re.compile(r"^(?P<cell_type>[^-]*)-(?P<protein>[^-]*)-(?P<assay>.*)$")
+ORIGIN_RE = re.compile(r"\((?P<origin>[^(]*)")
+PARENTHESES_RE = re.compile(r"\([^)]*\)")
+CONSENSUS_RE = re.compile(r">(\S+)")
+
+# Exceptions to the patterns above: parsed fields replaced for headings whose
+# motif name contains the key. ZNF652 has no DNA binding domain in its name.
+# LHX9 is spelled LXH9, and its domain keeps the closing parenthesis, as in the
+# published parsed_subheadings.txt and the BED files built from it.
+subheading_rules = {
+    "ZNF652": {"tf_name": "ZNF652", "dna_domain": "."},
+    "LHX9": {"name": "LXH9(Homeobox)", "tf_name": "LXH9", "dna_domain": "Homeobox)", "immunoprecipitated_protein": "LXH9.V5"},
+}
+
+parsed_subheadings_header = "motif_name\tname\ttf_name\tDNA_binding_domain\tcell_type\timmunoprecipitated_protein\tassay\torigin\tresource\tconsensus_sequence\tmotif_length\n"
+
+def parse_experiment(experiment):
+    # Cell type, immunoprecipitated protein, assay and origin of an experiment
+    if "Promoter" in experiment:
+        return ".", ".", experiment, "."
+
+    origin_match = ORIGIN_RE.search(experiment)
+    # Some experiments have no origin, K562-JunD-ChIP-Seq(); Expression motifs may have one, ThioMac-LPS-Expression(GSE23622)
+    origin = origin_match.group("origin").rstrip(")") if origin_match else "."
+
+    match = EXPERIMENT_RE.match(experiment)
+    if match is None:
+        return "", "", "", origin
+    cell_type, protein, assay = match.group("cell_type", "protein", "assay")
+    if "mStart" in protein and "-" not in assay and "Expression" not in experiment:
+        # K562-mStart-Seq has no immunoprecipitated protein
+        return cell_type, ".", protein + "-" + assay, origin
+    if "Expression" in experiment or "-" not in assay:
+        # HUDEP2-KLF1-CutnRun(GSE136251) -> CutnRun
+        return cell_type, protein, PARENTHESES_RE.sub("", assay), origin
+
+    # ZebrafishEmbryos-Cdx4.Myc-ChIP-Seq(GSE48254): the assay itself contains a dash
+    assay, seq = assay.split("-", 1)
+    return cell_type, protein, assay + "-" + PARENTHESES_RE.sub("", seq), origin
 
 def parse_subheading(line):
-    parts = line.strip().split()
-    if len(parts) >= 5:
-
-        # Get the motif ID from the fifth column
-        motif_name = "motif" + parts[4].replace("(", "").replace(")", "").lower() 
-
-        # Third column (AP-1(bZIP)/ThioMac-PU.1-ChIP-Seq(GSE21512)/Homer)
-        third_column = parts[2]
-
-        # Split third_column by '/' into 3 parts
-        split_columns = third_column.split('/')
-
-        # adding name column
-        name = split_columns[0]
-
-        # Parse the first split column into TF-name and DNA-binding-domain
-        missing_DNA_binding = "ZNF652" # Dealing with missing DNA binding domain info
-        misspelled_tf_name = "LHX9" # Dealing with misspelled TF name
-
-        if missing_DNA_binding in split_columns[0]:
-            tf_name = split_columns[0]
-            dna_domain = '.'
-        elif misspelled_tf_name in split_columns[0]:
-            tf_name, dna_domain = split_columns[0].split('(')
-            tf_name = "LXH9"
-            name = "LXH9(Homeobox)"
-        else:
-            tf_name, dna_domain = split_columns[0].split('(')
-            dna_domain = dna_domain.replace(')', '').strip()
-            tf_name = tf_name.strip()
-
-        # Parse the second split column ThioMac-PU.1-ChIP-Seq(GSE21512) into ThioMac \t PU.1 \t ChIP-Seq \t GSE21512
-        cell_type, immunoprecipitated_protein, assay, seq = "", "", "", "" # Initialize variables with empty strings
-
-        tmp = split_columns[1]
-
-        # Handling Expressions
-        if 'Expression' in tmp:
-            cell_type, immunoprecipitated_protein, assay = tmp.split('-', 2)
-            assay = re.sub(r'\([^)]*\)', '', assay)  # Remove anything within parentheses, ThioMac-LPS-Expression(GSE23622)
-            # Some expression motifs have origin info, ThioMac-LPS-Expression(GSE23622)
-            if '(' in tmp:
-                origin = tmp.split('(')[1].rstrip(')')
-            else:
-                origin = "."
-
-        # Handling promoters 
-        elif 'Promoter' in tmp:
-            cell_type = "."
-            immunoprecipitated_protein = "."
-            assay = tmp
-            origin = "."
-        else:
-
-            # Some motifs do not have origin info K562-JunD-ChIP-Seq()
-            try:
-                origin = tmp.split('(')[1].rstrip(')')
-            except IndexError:
-                origin = "."
-
-            if misspelled_tf_name in tmp: # Replacing misspelled TF name with the correct name
-                tmp = "Hct116-LXH9.V5-ChIP-Seq"
-
-            # Extracting info ZebrafishEmbryos-Cdx4.Myc-ChIP-Seq(GSE48254)
-            if len(tmp.split('-')) >= 4:
-                cell_type, immunoprecipitated_protein, assay, seq = tmp.split('-', 3)
-                seq = re.sub(r'\([^)]*\)', '', seq)  # Remove anything within parentheses, mES-cMyc-ChIP-Seq(GSE11431)
-                assay = assay + '-' + seq
-
-            # Extracting info HUDEP2-KLF1-CutnRun(GSE136251)
-            if len(tmp.split('-')) == 3:
-               split_parts = tmp.split('-', 2)
-               # Handling K562-mStart-Seq (has 3 parts but no immunoprecipitated_protein)
-               if "mStart" in split_parts[1]:
-                   cell_type, assay, seq = split_parts
-                   assay = assay + '-' + seq
-                   immunoprecipitated_protein = "."
-               else:
-                   cell_type, immunoprecipitated_protein, assay = tmp.split('-', 2)
-                   assay = re.sub(r'\([^)]*\)', '', assay)  # Remove anything within parentheses, mES-cMyc-ChIP-Seq(GSE11431)
-
-        resource = split_columns[-1].strip()
-
-        consensus_sequence, motif_length = get_motif_sequence_and_length(motif_name)
-
-        # Create a list containing the parsed values in desired order
-        output_list = [ motif_name, name, tf_name, dna_domain, cell_type, immunoprecipitated_protein, assay, origin, resource, consensus_sequence, str(motif_length)]
-
-        return "\t".join(output_list)
-    else:
+    # Fields of a subheadings.txt line, without the consensus sequence and length;
+    # None for blank lines
+    line = line.strip()
+    if not line:
         return None
-
-def download_motif_file(url, save_path, file_name):
+    match = SUBHEADING_RE.match(line)
+    if match is None:
+        raise ValueError(f"Unrecognized subheading: {line}")
+
+    heading_parts = match.group("heading").split("/")
+    name = heading_parts[0]
+    rule = next((rule for key, rule in subheading_rules.items() if key in name), {})
+
+    fields = {"motif_name": "motif" + match.group("number").lower(), "name": name, "resource": heading_parts[-1]}
+    fields["cell_type"], fields["immunoprecipitated_protein"], fields["assay"], fields["origin"] = parse_experiment(heading_parts[1])
+
+    name_match = NAME_RE.match(name)
+    if name_match is not None:
+        fields["tf_name"] = name_match.group("tf_name").strip()
+        fields["dna_domain"] = name_match.group("dna_domain").replace(")", "").strip()
+    elif "tf_name" not in rule:
+        raise ValueError(f"Unrecognized motif name {name} in subheading: {line}")
+
+    fields.update(rule)
+    return fields
+
+def parse_subheadings(lines):
+    # Parse every subheading at once, without any network access
+    return [fields for fields in (parse_subheading(line) for line in lines) if fields is not None]
+
+def read_consensus(motif_file_path):
+    # Consensus sequence and length from the header of a downloaded .motif file
+    match = None
+    if os.path.exists(motif_file_path):
+        with open(motif_file_path, "r") as motif_file:
+            match = CONSENSUS_RE.search(motif_file.readline())
+    if match is None:
+        return "N/A", 0
+    return match.group(1), len(match.group(1))
+
+def format_parsed_subheadings(parsed_subheadings, motif_directory):
+    # Lines of parsed_subheadings.txt: the parsed fields joined with the consensus
+    # of each motif's local .motif file
+    lines = [parsed_subheadings_header]
+    for fields in parsed_subheadings:
+        consensus_sequence, motif_length = read_consensus(os.path.join(motif_directory, f"{fields['motif_name']}.motif"))
+        lines.append("\t".join([
+            fields["motif_name"], fields["name"], fields["tf_name"], fields["dna_domain"], fields["cell_type"], fields["immunoprecipitated_protein"],
+            fields["assay"], fields["origin"], fields["resource"], consensus_sequence, str(motif_length)
+        ]) + "\n")
+    return lines
+
+def build_parsed_subheadings(subheadings_path="subheadings.txt", motif_directory="motif_files"):
+    with open(subheadings_path, "r") as input_file:
+        return format_parsed_subheadings(parse_subheadings(input_file), motif_directory)
+
+def write_parsed_subheadings(lines, output_path="parsed_subheadings.txt"):
+    with open(output_path + ".tmp", "w") as output_file:
+        output_file.writelines(lines)
+    os.replace(output_path + ".tmp", output_path)
+
+def verify_parsed_subheadings(lines, parsed_path="parsed_subheadings.txt", motif_directory="motif_files"):
+    # Compare rebuilt lines with an existing parsed_subheadings.txt -> (list of
+    # differences, number of motifs left unchecked). Motifs without a local .motif
+    # file can't have their consensus sequence and length checked; they are
+    # compared without them and counted as unchecked.
+    with open(parsed_path, "r") as parsed_file:
+        expected = parsed_file.readlines()
+    differences = []
+    unchecked = 0
+    if len(lines) != len(expected):
+        differences.append(f"{len(lines)} lines rebuilt, {len(expected)} in {parsed_path}")
+    for line_number, (line, expected_line) in enumerate(zip(lines, expected), 1):
+        columns = line.rstrip("\n").split("\t")
+        expected_columns = expected_line.rstrip("\n").split("\t")
+        if line_number > 1 and not os.path.exists(os.path.join(motif_directory, f"{columns[0]}.motif")):
+            columns, expected_columns = columns[:9], expected_columns[:9]
+            unchecked += 1
+        if columns != expected_columns:
+            differences.append(f"line {line_number}: {line.rstrip()} != {expected_line.rstrip()}")
+    return differences, unchecked
+
+def download_motif_file(url, save_path, file_name, fetcher):
     try:
-        # Send a GET request to the URL to get the file contents
-        response = requests.get(url)
-        response.raise_for_status()  # Raise an exception for unsuccessful requests
+        # Get the file contents, already fetched if the motif was parsed before
+        content = fetcher.fetch(url)
 
         # Save the contents to a local file with the specified file name
         file_path = os.path.join(save_path, file_name)
         with open(file_path, 'wb') as f:
-            f.write(response.content)
+            f.write(content)
 
         print(f"File {file_name} downloaded and saved successfully.")
         return True
@@ -153,39 +242,74 @@ def download_motif_file(url, save_path, file_name):
         return False
 
 
-if __name__ == "__main__":
-    base_url = "http://homer.ucsd.edu/homer/motif/HomerMotifDB/homerResults/motif"
+def main():
+    parser = argparse.ArgumentParser(description="Collect HOMER motif information and matrix files")
+    parser.add_argument("--concurrency", type=int, default=16, help="maximum number of concurrent requests")
+    parser.add_argument("--retries", type=int, default=3, help="retries per request, with exponential backoff")
+    parser.add_argument("--base-url", default=homer_results_url, help="HOMER motif database URL, e.g. a local mirror")
+    parser.add_argument("--cache-dir", default=".http_cache", help="directory of the local HTTP cache")
+    parser.add_argument("--offline", action="store_true", help="serve every request from the local cache")
+    parser.add_argument("--rebuild", action="store_true", help="only rebuild parsed_subheadings.txt from subheadings.txt and motif_files/, without downloading")
+    parser.add_argument("--verify", action="store_true", help="check that subheadings.txt and motif_files/ reproduce parsed_subheadings.txt")
+    args = parser.parse_args()
+
+    save_matrix_directory = "motif_files"
+
+    if args.verify:
+        differences, unchecked = verify_parsed_subheadings(build_parsed_subheadings(motif_directory=save_matrix_directory), motif_directory=save_matrix_directory)
+        for difference in differences:
+            print(difference)
+        if differences:
+            sys.exit(1)
+        if unchecked:
+            print(f"{unchecked} motifs have no .motif file in {save_matrix_directory}/, their consensus_sequence and motif_length were not checked")
+            sys.exit(1)
+        print("parsed_subheadings.txt is reproduced exactly")
+        return
+
+    if args.rebuild:
+        start_time = time.perf_counter()
+        lines = build_parsed_subheadings(motif_directory=save_matrix_directory)
+        write_parsed_subheadings(lines)
+        print(f"Rebuilt parsed_subheadings.txt ({len(lines) - 1} motifs) in {1000 * (time.perf_counter() - start_time):.0f} ms")
+        return
+
+    base_results_url = args.base_url.rstrip("/")
+    base_url = f"{base_results_url}/motif"
     num_motifs = 436
 
-    with open("subheadings.txt", "w") as file:
+    matrix_base_url = f"{base_results_url}/motif"
+
+    cache = HttpCache(args.cache_dir, offline=args.offline)
+
+    with MotifFetcher(max_workers=args.concurrency, retries=args.retries, cache=cache) as fetcher:
+        # Queue every info page and matrix file up front; each URL is fetched once
+        info_urls = [f"{base_url}{i}.info.html" for i in range(1, num_motifs + 1)]
+        for url in info_urls:
+            fetcher.submit(url)
         for i in range(1, num_motifs + 1):
-            url = f"{base_url}{i}.info.html"
-            motif_subheading = get_first_subheading(url)
-            if motif_subheading:
-#                file.write(f"Sub-heading for {url}:\n")
-                file.write(motif_subheading + "\n")
-
-    with open("parsed_subheadings.txt", "w") as output_file:
-        header = "motif_name\tname\ttf_name\tDNA_binding_domain\tcell_type\timmunoprecipitated_protein\tassay\torigin\tresource\tconsensus_sequence\tmotif_length\n"
-        output_file.write(header)
-
-        with open("subheadings.txt", "r") as input_file:
-            for line in input_file:
-                parsed_line = parse_subheading(line)
-                if parsed_line:
-                    output_file.write(parsed_line + "\n")
-
-    # Download motif matrix files
-    matrix_base_url = "http://homer.ucsd.edu/homer/motif/HomerMotifDB/homerResults/motif"
-    save_matrix_directory = "motif_files"
+            fetcher.submit(f"{matrix_base_url}{i}.motif")
+
+        with open("subheadings.txt", "w") as file:
+            for url in info_urls:
+                motif_subheading = get_first_subheading(url, fetcher)
+                if motif_subheading:
+#                    file.write(f"Sub-heading for {url}:\n")
+                    file.write(motif_subheading + "\n")
 
-    if not os.path.exists(save_matrix_directory):
-        os.makedirs(save_matrix_directory)
+        # Save motif matrix files
+        if not os.path.exists(save_matrix_directory):
+            os.makedirs(save_matrix_directory)
 
-    num_matrix_files = num_motifs  # Same number of matrix files as motif files
+        num_matrix_files = num_motifs  # Same number of matrix files as motif files
 
-    for i in range(1, num_matrix_files + 1):
-        matrix_file_name = f"motif{i}.motif"
-        matrix_file_url = f"{matrix_base_url}{i}.motif"
-        download_motif_file(matrix_file_url, save_matrix_directory, matrix_file_name)
+        for i in range(1, num_matrix_files + 1):
+            matrix_file_name = f"motif{i}.motif"
+            matrix_file_url = f"{matrix_base_url}{i}.motif"
+            download_motif_file(matrix_file_url, save_matrix_directory, matrix_file_name, fetcher)
 
+    # The consensus sequences come from the saved matrix files
+    write_parsed_subheadings(build_parsed_subheadings(motif_directory=save_matrix_directory))
+
+if __name__ == "__main__":
+    main()
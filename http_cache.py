@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import shutil
+import requests
+
+# Local cache for the HOMER downloads. Response bodies are stored once under
+# objects/ by their SHA-256, and index/ maps each URL to its body and the
+# validators (ETag, Last-Modified) the server sent with it. Cached URLs are
+# revalidated with conditional requests, so an unchanged file costs a 304
+# response and no payload; in offline mode everything is served from disk.
+
+
+class HttpCache:
+    def __init__(self, cache_dir=".http_cache", offline=False):
+        self.cache_dir = cache_dir
+        self.offline = offline
+        os.makedirs(os.path.join(cache_dir, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(cache_dir, "index"), exist_ok=True)
+
+    def _entry_path(self, url):
+        return os.path.join(self.cache_dir, "index", hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+    def object_path(self, digest):
+        return os.path.join(self.cache_dir, "objects", digest[:2], digest)
+
+    def lookup(self, url):
+        # Cache entry for the URL, or None if it is not cached or its body is gone
+        try:
+            with open(self._entry_path(url), "r") as entry_file:
+                entry = json.load(entry_file)
+        except (OSError, ValueError):
+            return None
+
+        if not os.path.exists(self.object_path(entry["sha256"])):
+            return None
+        return entry
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry is None:
+            return headers
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def _write_entry(self, url, digest, size, response_headers):
+        entry = {
+            "url": url,
+            "sha256": digest,
+            "size": size,
+            "etag": response_headers.get("ETag"),
+            "last_modified": response_headers.get("Last-Modified"),
+        }
+        entry_path = self._entry_path(url)
+        with open(entry_path + ".tmp", "w") as entry_file:
+            json.dump(entry, entry_file)
+        os.replace(entry_path + ".tmp", entry_path)
+        return entry
+
+    def read(self, entry):
+        with open(self.object_path(entry["sha256"]), "rb") as object_file:
+            return object_file.read()
+
+    def store_bytes(self, url, body, response_headers):
+        digest = hashlib.sha256(body).hexdigest()
+        object_path = self.object_path(digest)
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            with open(object_path + ".tmp", "wb") as object_file:
+                object_file.write(body)
+            os.replace(object_path + ".tmp", object_path)
+        return self._write_entry(url, digest, len(body), response_headers)
+
+    def store_file(self, url, file_path, digest, response_headers):
+        # Large downloads are hard-linked into the cache rather than copied when possible
+        object_path = self.object_path(digest)
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            try:
+                os.link(file_path, object_path)
+            except OSError:
+                shutil.copyfile(file_path, object_path + ".tmp")
+                os.replace(object_path + ".tmp", object_path)
+        return self._write_entry(url, digest, os.path.getsize(file_path), response_headers)
+
+    def restore_file(self, entry, file_path):
+        # Make file_path hold the cached body
+        object_path = self.object_path(entry["sha256"])
+        if os.path.exists(file_path) and os.path.samefile(file_path, object_path):
+            return
+        try:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            os.link(object_path, file_path)
+        except OSError:
+            shutil.copyfile(object_path, file_path)
+
+    def validate(self, url, session=requests, timeout=60):
+        # Return the cache entry if the cached body is still current, without
+        # transferring it: a conditional HEAD request, or nothing at all offline
+        entry = self.lookup(url)
+        if self.offline or entry is None:
+            return entry
+
+        response = session.head(url, headers=self.conditional_headers(entry), timeout=timeout, allow_redirects=True)
+        if response.status_code == 304:
+            return entry
+        return None
+
+    def get(self, url, session=requests, timeout=30):
+        # Body of the URL, revalidated against the server unless offline
+        entry = self.lookup(url)
+        if self.offline:
+            if entry is None:
+                raise IOError(f"{url} is not cached, cannot fetch it in offline mode")
+            return self.read(entry)
+
+        response = session.get(url, headers=self.conditional_headers(entry), timeout=timeout)
+        if response.status_code == 304 and entry is not None:
+            return self.read(entry)
+
+        response.raise_for_status()  # Raise an exception for unsuccessful requests
+        self.store_bytes(url, response.content, response.headers)
+        return response.content
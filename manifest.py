@@ -0,0 +1,57 @@
+import hashlib
+import json
+import os
+
+# Build manifest for incremental reruns. For every output it records digests of
+# the inputs it was built from; an output is only rebuilt when it is missing or
+# one of those digests changed. File digests are memoized by size and mtime so
+# large inputs are hashed once, not on every run.
+
+
+def sha256_file(path, chunk_size=1 << 20):
+    checksum = hashlib.sha256()
+    with open(path, "rb") as input_file:
+        for chunk in iter(lambda: input_file.read(chunk_size), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def sha256_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class BuildManifest:
+    def __init__(self, path):
+        self.path = path
+        self.outputs = {}
+        self.files = {}
+        if os.path.exists(path):
+            with open(path, "r") as manifest_file:
+                data = json.load(manifest_file)
+            self.outputs = data.get("outputs", {})
+            self.files = data.get("files", {})
+
+    def file_digest(self, path):
+        # SHA-256 of a file, reused while its size and mtime are unchanged
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        known = self.files.get(key)
+        if known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+            return known["sha256"]
+
+        digest = sha256_file(path)
+        self.files[key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest}
+        return digest
+
+    def is_current(self, output_filepath, inputs):
+        return os.path.exists(output_filepath) and self.outputs.get(os.path.basename(output_filepath)) == inputs
+
+    def record(self, output_filepath, inputs):
+        self.outputs[os.path.basename(output_filepath)] = inputs
+        self.save()
+
+    def save(self):
+        # Write through a temp file so a crash never leaves a truncated manifest
+        with open(self.path + ".tmp", "w") as manifest_file:
+            json.dump({"outputs": self.outputs, "files": self.files}, manifest_file, indent=1, sort_keys=True)
+        os.replace(self.path + ".tmp", self.path)
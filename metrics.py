@@ -0,0 +1,201 @@
+import contextlib
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+# Instrumentation for long runs: per-task counters and stage timers, a progress
+# line with an ETA, JSON-lines metrics records and an optional sampling
+# profiler for the worker processes.
+
+class Metrics:
+    # Counters (records read, kept, written, skipped_<reason>) and seconds spent
+    # per stage
+    def __init__(self, counters=None, stages=None):
+        self.counters = dict(counters or {})
+        self.stages = dict(stages or {})
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[stage] = self.stages.get(stage, 0.0) + time.perf_counter() - start_time
+
+    def merge(self, other):
+        for name, value in other.counters.items():
+            self.count(name, value)
+        for stage, seconds in other.stages.items():
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def reset(self):
+        self.counters.clear()
+        self.stages.clear()
+
+    def to_dict(self):
+        return {"counters": dict(self.counters), "stages": {stage: round(seconds, 6) for stage, seconds in self.stages.items()}}
+
+# Metrics of the task running in this thread, see run_measured()
+_local = threading.local()
+
+def task_metrics():
+    if not hasattr(_local, "metrics"):
+        _local.metrics = Metrics()
+    return _local.metrics
+
+# Sampling profiler of this process and where it saves its samples, see start_profiler()
+profiler = None
+profile_path = None
+
+def run_measured(function, *args):
+    # Run a pool task with fresh metrics -> (result, metrics dict). The task's
+    # wall time is the "task" stage; whatever the other stages don't cover is
+    # reading and parsing input.
+    metrics = task_metrics()
+    metrics.reset()
+    try:
+        with metrics.timer("task"):
+            result = function(*args)
+    finally:
+        if profiler is not None:
+            profiler.write(profile_path)
+    return result, metrics.to_dict()
+
+class SamplingProfiler:
+    # Samples the main thread's Python stack every interval seconds of CPU time
+    # (SIGPROF) and counts identical stacks. write() saves them in the collapsed
+    # format of flamegraph.pl and speedscope: "file:function;file:function count".
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = {}
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        key = ";".join(reversed(stack))
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def write(self, path):
+        with open(path + ".tmp", "w") as profile_file:
+            for stack, samples in sorted(self.stacks.items()):
+                profile_file.write(f"{stack} {samples}\n")
+        os.replace(path + ".tmp", path)
+
+def start_profiler(profile_directory, interval=0.005):
+    # Profile this process into <profile_directory>/<pid>.folded
+    global profiler, profile_path
+    if profiler is None:
+        os.makedirs(profile_directory, exist_ok=True)
+        profile_path = os.path.join(profile_directory, f"{os.getpid()}.folded")
+        profiler = SamplingProfiler(interval)
+        profiler.start()
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+class Progress:
+    # Files and input bytes done out of the total, with the throughput and an ETA
+    # from it. Rewritten in place on a terminal, otherwise printed as a new line
+    # at most every interval seconds.
+    def __init__(self, total_files, total_bytes, interval=5.0, stream=sys.stderr):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.stream = stream
+        self.files = 0
+        self.bytes = 0
+        self.start_time = time.perf_counter()
+        self.last_report = None
+        self.tty = stream.isatty()
+
+    def update(self, files=0, nbytes=0):
+        self.files += files
+        self.bytes += nbytes
+        now = time.perf_counter()
+        if self.interval and (self.last_report is None or now - self.last_report >= self.interval or self.files == self.total_files):
+            self.last_report = now
+            self.report()
+
+    def line(self):
+        elapsed = time.perf_counter() - self.start_time
+        rate = self.bytes / elapsed if elapsed > 0 else 0
+        percent = 100 * self.bytes / self.total_bytes if self.total_bytes else 100
+        eta = format_duration((self.total_bytes - self.bytes) / rate) if rate > 0 else "?"
+        return f"{self.files}/{self.total_files} files, {self.bytes / 1e6:.0f}/{self.total_bytes / 1e6:.0f} MB ({percent:.1f}%), {rate / 1e6:.1f} MB/s, elapsed {format_duration(elapsed)}, ETA {eta}"
+
+    def report(self):
+        if self.tty:
+            self.stream.write("\r" + self.line() + "\033[K")
+        else:
+            self.stream.write(self.line() + "\n")
+        self.stream.flush()
+
+    def finish(self):
+        if self.interval and self.tty:
+            self.stream.write("\n")
+            self.stream.flush()
+
+# Queues between the stages of a task, as (label, depth counter, samples
+# counter): input blocks decompressed ahead of the reader and output blocks
+# waiting for compression, counted by bgzf.py in the metrics it is given
+queue_counters = [("read-ahead", "read_ahead_depth", "read_ahead_batches"), ("compression", "compress_queue_depth", "compress_queue_blocks")]
+
+class MetricsLog:
+    # One JSON object per line; the file is optional, the totals are always kept
+    def __init__(self, path=None):
+        self.totals = Metrics()
+        self.files = []
+        self._file = open(path, "w") if path else None
+
+    def write(self, record):
+        if self._file is not None:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+
+    def record_file(self, input_filepath, output_filepath, metrics, elapsed, status="done"):
+        # A finished (or failed) output and the metrics of all its tasks
+        self.totals.merge(metrics)
+        # Named with their directory, e.g. the genome build, which tells the inputs of several builds apart
+        name = os.path.join(os.path.basename(os.path.dirname(input_filepath)), os.path.basename(input_filepath))
+        self.files.append((metrics.stages.get("task", 0.0), name))
+        self.write(dict({"event": "file", "status": status, "input": input_filepath, "output": output_filepath, "elapsed": round(elapsed, 6)}, **metrics.to_dict()))
+
+    def summary(self, elapsed, stream=sys.stderr, slowest=5, file_count=None):
+        # Totals to the metrics file and a short report with the slowest files;
+        # file_count overrides the number of files recorded
+        file_count = len(self.files) if file_count is None else file_count
+        self.write(dict({"event": "summary", "files": file_count, "elapsed": round(elapsed, 6)}, **self.totals.to_dict()))
+        if self._file is not None:
+            self._file.close()
+
+        counters = self.totals.counters
+        print(f"{file_count} files in {format_duration(elapsed)}: "
+              f"{counters.get('records_read', 0)} records read, {counters.get('records_kept', 0)} kept, {counters.get('records_written', 0)} written", file=stream)
+        skipped = {name[len("skipped_"):]: value for name, value in counters.items() if name.startswith("skipped_")}
+        if skipped:
+            print("Skipped: " + ", ".join(f"{reason} {value}" for reason, value in sorted(skipped.items())), file=stream)
+        if self.totals.stages:
+            print("Worker seconds: " + ", ".join(f"{stage} {seconds:.1f}" for stage, seconds in sorted(self.totals.stages.items())), file=stream)
+        queues = [(label, counters[depth] / counters[samples]) for label, depth, samples in queue_counters if counters.get(samples)]
+        if queues:
+            print("Mean queue depth: " + ", ".join(f"{label} {depth:.1f}" for label, depth in queues), file=stream)
+        if self.files:
+            print("Slowest: " + ", ".join(f"{name} {seconds:.1f}s" for seconds, name in sorted(self.files, reverse=True)[:slowest]), file=stream)
@@ -0,0 +1,115 @@
+import json
+import os
+import sys
+
+import numpy as np
+
+from pwm import PWM, load_motif
+
+# Compiled motif catalog: the rows of parsed_subheadings.txt and the log-odds
+# tables and thresholds of every motif in motif_files/, saved as
+# motif_catalog.json (metadata) and motif_catalog.npy (all log-odds rows
+# stacked). The .npy is memory-mapped, so worker processes share one read-only
+# copy. The catalog is rebuilt whenever the size or mtime of one of its source
+# files changes.
+
+catalog_path = "motif_catalog"
+
+
+def get_source_signatures(parsed_subheadings_path, motif_directory, motif_numbers):
+    signatures = {}
+    paths = [parsed_subheadings_path] + [os.path.join(motif_directory, f"{motif_number}.motif") for motif_number in motif_numbers]
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            signatures[path] = [stat.st_size, stat.st_mtime_ns]
+        else:
+            signatures[path] = None
+    return signatures
+
+
+def read_rows(parsed_subheadings_path):
+    # Lines of parsed_subheadings.txt, without the header line
+    with open(parsed_subheadings_path, "r") as parsed_file:
+        next(parsed_file)  # Skip the header line
+        return list(parsed_file)
+
+
+def build_catalog(parsed_subheadings_path="parsed_subheadings.txt", motif_directory="motif_files", path=catalog_path):
+    lines = read_rows(parsed_subheadings_path)
+    motif_numbers = [line.strip().split("\t")[0] for line in lines]
+    sources = get_source_signatures(parsed_subheadings_path, motif_directory, motif_numbers)
+
+    motifs = {}
+    tables = []
+    offset = 0
+    for motif_number in motif_numbers:
+        motif_file_path = os.path.join(motif_directory, f"{motif_number}.motif")
+        if motif_number in motifs or not os.path.exists(motif_file_path):
+            continue
+        pwm = load_motif(motif_file_path, motif_number)
+        motifs[motif_number] = {"offset": offset, "length": len(pwm), "consensus": pwm.consensus, "name": pwm.name, "threshold": pwm.threshold}
+        tables.append(pwm.log_odds)
+        offset += len(pwm)
+
+    log_odds = np.concatenate(tables) if tables else np.zeros((0, 5))
+
+    # The metadata goes last, so it only matches the sources once both files are complete
+    with open(path + ".npy.tmp", "wb") as table_file:
+        np.save(table_file, log_odds)
+    os.replace(path + ".npy.tmp", path + ".npy")
+    with open(path + ".json.tmp", "w") as metadata_file:
+        json.dump({"sources": sources, "lines": lines, "motifs": motifs}, metadata_file)
+    os.replace(path + ".json.tmp", path + ".json")
+
+    return MotifCatalog(lines, motifs, log_odds)
+
+
+def load_catalog(parsed_subheadings_path="parsed_subheadings.txt", motif_directory="motif_files", path=catalog_path):
+    # The compiled catalog, rebuilt first if it is missing or out of date
+    if os.path.exists(path + ".json") and os.path.exists(path + ".npy"):
+        with open(path + ".json", "r") as metadata_file:
+            metadata = json.load(metadata_file)
+        motif_numbers = [line.strip().split("\t")[0] for line in metadata["lines"]]
+        if metadata["sources"] == get_source_signatures(parsed_subheadings_path, motif_directory, motif_numbers):
+            return MotifCatalog(metadata["lines"], metadata["motifs"], np.load(path + ".npy", mmap_mode="r"))
+
+    return build_catalog(parsed_subheadings_path, motif_directory, path)
+
+
+class MotifCatalog:
+    def __init__(self, lines, motifs, log_odds):
+        self.lines = lines
+        self.motifs = motifs
+        self.log_odds = log_odds
+        self.rows = [line.strip().split("\t") for line in lines]
+
+        # Metadata keyed by (name, length), by motif ID and the raw rows by name
+        self.column_mapping = {}
+        self.parsed_dict = {}
+        self.metadata_rows = {}
+        for line, columns in zip(lines, self.rows):
+            self.column_mapping[(columns[1], columns[10])] = [columns[0], columns[4], columns[3], columns[9]]
+            self.parsed_dict[columns[0]] = (columns[0], columns[4], columns[3], columns[9])
+            self.metadata_rows[columns[1]] = self.metadata_rows.get(columns[1], "") + line
+
+    def pwm(self, motif_number):
+        # PWM whose log-odds table is a view into the memory-mapped catalog
+        if motif_number not in self.motifs:
+            raise KeyError(f"{motif_number} is not in the motif catalog, is motif_files/{motif_number}.motif missing?")
+        motif = self.motifs[motif_number]
+        log_odds = self.log_odds[motif["offset"]:motif["offset"] + motif["length"]]
+        return PWM(motif_number, None, motif["consensus"], motif["name"], motif["threshold"], log_odds=log_odds)
+
+    def motif_groups(self):
+        # Motif numbers by (name, length), in file order
+        groups = {}
+        for columns in self.rows:
+            groups.setdefault((columns[1], int(columns[10])), []).append(columns[0])
+        return groups
+
+
+if __name__ == "__main__":
+    # Rebuild the catalog unconditionally
+    catalog = build_catalog(*sys.argv[1:3])
+    print(f"Compiled {len(catalog.rows)} motif rows and {len(catalog.motifs)} matrices into {catalog_path}.json/.npy")
@@ -1,84 +1,23 @@
-import math
-import subprocess
-import gzip
 import sys
 import os
 
+import bgzf
+from metrics import task_metrics
+from motif_catalog import load_catalog
+from parquet_output import write_parquet
+from pwm import encode_sequences, score_batch
+from sequence_utils import get_binding_sequences
+from tabix import TabixIndex, replace_indexed
 
-# Read command-line arguments
-input_filepath = sys.argv[1]
-output_directory = sys.argv[2]
-genome_build = sys.argv[3]
-
-input_filename = os.path.basename(sys.argv[1])
-
-# Create the output directory if it doesn't exist
-#output_directory = os.path.join("/mnt/ebs/jackal/FILER2/FILER2-production/Homer/motif/processed_bed", genome_build)
-#os.makedirs(output_directory, exist_ok=True)
-
-output_filename = input_filename.replace(".bed.gz", ".processed.bed")
-output_filepath = os.path.join(output_directory, output_filename)
-
-
-# Determine the motif numbers based on input_filename
-if input_filename == "FOXA1(Forkhead).bed.gz":
-    motif_numbers = ["motif109", "motif110"]
-    motif_length = 10
-    threshold_109 = 6.337526
-    threshold_110 = 6.568115
-elif input_filename == "Nr5a2(NR).bed.gz":
-    motif_numbers = ["motif203", "motif247"]
-    motif_length = 10
-    threshold_203 = 7.021126
-    threshold_247 = 7.613762
-elif input_filename == "OCT:OCT(POU,Homeobox).bed.gz":
-    motif_numbers = ["motif259", "motif260"]
-    motif_length = 15
-else:
-    print(f"Unsupported input file name: {input_filename}")
-    sys.exit(1)
-
-def get_reference(genome_build, sequenceID):
-    if genome_build == "hg19":
-        fa = "hg19.fa"
-    elif genome_build == "hg38":
-        fa = "hg38.fa"
-    else:
-        raise ValueError("Invalid genome build specified")
-
-    output = subprocess.check_output(["samtools", "faidx", fa, sequenceID]).decode("utf-8")
-    lines = output.split('\n')
-    ref_sequence = ''.join(lines[1:])
-    ref_sequence = ref_sequence.lower() # Convert to lowercase
-    return ref_sequence
-
-def calculate_motif_score(sequence, base_probabilities):
-    motif_score = 0.0
-    for idx, base in enumerate(sequence):
-        base_index = {'a': 0, 'c': 1, 'g': 2, 't': 3}.get(base.lower())
-        if base_index is not None:
-            probability = base_probabilities[idx][base_index]
-            score = math.log(probability / 0.25)
-            motif_score += score
-    return motif_score
-
-def get_reverse_complement(sequence):
-    complement = {'a': 't', 'c': 'g', 'g': 'c', 't': 'a'}
-    reverse_complement = ''
-    sequence = sequence.lower()  # Convert to lowercase
-    for base in reversed(sequence):
-        if base in complement:
-            reverse_complement += complement[base]
-        else:
-            reverse_complement += base
-    return reverse_complement
+# Number of BED records scored together in one vectorized pass
+batch_size = 100000
 
 def get_cellandmotif(name, parsed_dict):
-    if key in parsed_dict:
-        motif_id = parsed_dict[key][0]
-        cell_type = parsed_dict[key][1]
-        DNA_binding = parsed_dict[key][2]
-        consensus_length = parsed_dict[key][3]
+    if name in parsed_dict:
+        motif_id = parsed_dict[name][0]
+        cell_type = parsed_dict[name][1]
+        DNA_binding = parsed_dict[name][2]
+        consensus_length = parsed_dict[name][3]
     else:
         motif_id = "."
         cell_type = "."
@@ -87,113 +26,264 @@ def get_cellandmotif(name, parsed_dict):
 
     return motif_id, cell_type, DNA_binding, consensus_length
 
-#  Read base probabilities from input files based on motif_numbers
-base_probabilities = {}
-for motif_number in motif_numbers:
-    base_probabilities[motif_number] = []
-
-    motif_file_path = f"motif_files/{motif_number}.motif"
-    with open(motif_file_path, "r") as input_file:
-        next(input_file)  # Skip the header line
-        for line in input_file:
-            probabilities = [float(p) for p in line.strip().split()]
-            base_probabilities[motif_number].append(probabilities)
-
-# Create a dictionary to store the values from parsed_subheadings.txt
-parsed_dict = {}
-with open("parsed_subheadings.txt", "r") as parsed_file:
-    next(parsed_file)  # Skip the header line
-    for line in parsed_file:
-        columns = line.strip().split("\t")
-        key = columns[0]
-        value = (columns[0], columns[4], columns[3], columns[9])
-        parsed_dict[key] = value
-
-with gzip.open(input_filepath, "rt", encoding="utf-8") as bed_file, open(output_filepath, "w") as output_file:
-#    output_file.write("#chrom\tchromStart\tchromEnd\tname\tscore\tstrand\t")
-#    output_file.write("\t".join([f"motif_score_{motif_number}" for motif_number in motif_numbers]) + "\tmotif_name\n")
+class AmbiguousMotif:
+    # A motif name shared by several motifs of the same length. HOMER's BED only
+    # carries the name, so each site is scored against every candidate PWM and
+    # assigned to the motifs whose rounded score reproduces the BED score.
+    def __init__(self, name, motif_length, pwms):
+        self.name = name
+        self.motif_length = motif_length
+        self.pwms = pwms
+        self.motif_numbers = [pwm.motif_number for pwm in pwms]
+
+def load_ambiguous_motifs(catalog):
+    # Every (name, length) group of the motif catalog with more than one motif
+    # needs disambiguation
+    ambiguous_motifs = {}
+    for (name, motif_length), motif_numbers in catalog.motif_groups().items():
+        # A name is only expected to be ambiguous at one length, keep the first
+        if len(motif_numbers) < 2 or name in ambiguous_motifs:
+            continue
+        pwms = [catalog.pwm(motif_number) for motif_number in motif_numbers]
+        ambiguous_motifs[name] = AmbiguousMotif(name, motif_length, pwms)
+    return ambiguous_motifs
+
+class UnsortedInputError(ValueError):
+    pass
+
+class ProcessedIntervals:
+    # Which motifs each interval has already been written for, as a bit mask per
+    # interval. Input sorted by chromosome and start only needs the intervals at the
+    # current start position, so memory stays bounded; the rest are dropped as the
+    # input moves on. Unsorted input raises UnsortedInputError in that mode. With
+    # sorted_input=False every interval is kept, under an integer key.
+    def __init__(self, motif_numbers, sorted_input=True):
+        self.bits = {motif_number: 1 << index for index, motif_number in enumerate(motif_numbers)}
+        self.all_bits = (1 << len(motif_numbers)) - 1
+        self.sorted_input = sorted_input
+        self.masks = {}
+        self.chrom_ids = {}
+        self.chrom = None
+        self.start = None
+
+    def _key(self, chrom, start, end):
+        start = int(start)
+        if not self.sorted_input:
+            chrom_id = self.chrom_ids.setdefault(chrom, len(self.chrom_ids))
+            return chrom_id << 64 | start << 32 | int(end)
+
+        if chrom != self.chrom:
+            if chrom in self.chrom_ids:
+                raise UnsortedInputError(f"{chrom} appears again after {self.chrom}")
+            self.chrom_ids[chrom] = len(self.chrom_ids)
+            self.chrom = chrom
+            self.start = start
+            self.masks.clear()
+        elif start != self.start:
+            if start < self.start:
+                raise UnsortedInputError(f"{chrom}:{start} comes after {chrom}:{self.start}")
+            self.start = start
+            self.masks.clear()
+        return int(end)
+
+    def is_done(self, chrom, start, end):
+        # True once the interval was written for every motif
+        return self.masks.get(self._key(chrom, start, end), 0) == self.all_bits
+
+    def add(self, chrom, start, end, motif_numbers):
+        key = self._key(chrom, start, end)
+        mask = self.masks.get(key, 0)
+        for motif_number in motif_numbers:
+            mask |= self.bits[motif_number]
+        self.masks[key] = mask
+
+def score_records(records, genome_build, ambiguous_motif):
+    # Fetch the sequences of a batch of records and score them against every candidate motif at once
+    metrics = task_metrics()
+    motif_length = ambiguous_motif.motif_length
+    intervals = [(columns[0], int(columns[1]) - 1, int(columns[2])) for columns in records]
+    with metrics.timer("sequence_fetch"):
+        sequences = get_binding_sequences(genome_build, intervals, [columns[5] for columns in records])
+
+    # Sites cut short at the end of a chromosome are padded with N, which scores 0
+    with metrics.timer("scoring"):
+        codes = encode_sequences([sequence.ljust(motif_length, "n") for sequence in sequences], motif_length)
+        return sequences, score_batch(codes, ambiguous_motif.pwms)
+
+def write_records(records, output_file, processed_intervals, genome_build, ambiguous_motif, parsed_dict):
+    sequences, scores = score_records(records, genome_build, ambiguous_motif)
+    write_scored_records(records, sequences, scores, output_file, processed_intervals, ambiguous_motif, parsed_dict)
+
+def write_scored_records(records, sequences, scores, output_file, processed_intervals, ambiguous_motif, parsed_dict):
+    # Assign scored records to the motifs whose score reproduces the BED score and write them
+    motif_numbers = ambiguous_motif.motif_numbers
+    metrics = task_metrics()
+    records_written = 0
+    duplicates = 0
+    unmatched = 0
+    with metrics.timer("write"):
+        for columns, sequence, record_scores in zip(records, sequences, scores):
+            chrom = columns[0]
+            chromStart = columns[1]
+            chromEnd = columns[2]
+            name = columns[3]  # Extract motif name
+            strand = columns[5]
+            bed_score = int(columns[4])
+
+            # Check if this interval has already been processed for the same motifs
+            if processed_intervals.is_done(chrom, chromStart, chromEnd):
+                duplicates += 1
+                continue
+
+            # Motif scores for the sequence using different motif files
+            motif_scores = {}
+            for pwm, motif_score in zip(ambiguous_motif.pwms, record_scores):
+                motif_score = float(motif_score)
+
+                # Scores at or below the detection threshold from the .motif header don't count
+                if pwm.threshold is not None and motif_score <= pwm.threshold:
+                    motif_scores[pwm.motif_number] = -1  # Assign a negative value
+                else:
+                    motif_scores[pwm.motif_number] = round(motif_score)
+
+            # Determine motif names based on scores and bed score
+            motif_names = [motif_number for motif_number in motif_scores if motif_scores[motif_number] == bed_score]
+            if not motif_names:
+                unmatched += 1
+
+            if motif_names:
+                for motif_name in motif_names:
+                    key = motif_name
+
+                    if key in parsed_dict:
+                        motif_id, cell_type, DNA_binding, consensus_sequence = get_cellandmotif(motif_name, parsed_dict)
+                        binding_sequence = sequence
+
+                        # Write the line to the output file
+                        output_line = "\t".join([
+                            chrom, chromStart, chromEnd, name, str(bed_score), strand, motif_id, DNA_binding, cell_type, binding_sequence, consensus_sequence,
+                            "\t".join([str(motif_scores[motif_number]) for motif_number in motif_numbers]),
+                            motif_name, motif_id, cell_type, DNA_binding, consensus_sequence
+                        ])
+                        output_file.write(output_line + "\n")
+                        records_written += 1
+
+                        # Update processed intervals
+                        processed_intervals.add(chrom, chromStart, chromEnd, motif_names)
+
+    metrics.count("records_written", records_written)
+    metrics.count("skipped_duplicate", duplicates)
+    metrics.count("skipped_no_score_match", unmatched)
+
+def get_header_line(motif_numbers):
+    return "#chrom\tchromStart\tchromEnd\tname\tscore\tstrand\tmotifID\tDNA_binding_domain\tcell_type\tbinding_sequence\tconsensus_sequence\t" + \
+        "\t".join([f"motif_score_{motif_number}" for motif_number in motif_numbers]) + "\tmotif_name\n"
+
+def score_motif_file(input_filepath, output_directory, genome_build, ambiguous_motif, parsed_dict, compress_threads=1, read_lines=None, parquet_path=None):
+    # read_lines, when given, returns the lines to score instead of the records of
+    # input_filepath, called again for the second pass over unsorted input; with
+    # parquet_path the output is also written there as Parquet
+    input_filename = os.path.basename(input_filepath)
+    output_filename = input_filename.replace(".bed.gz", ".processed.bed")
+    output_filepath = os.path.join(output_directory, output_filename)
+
+    # Compress and index while writing, through a temp file that only replaces the
+    # output once it is complete. chromStart stays 1-based in these outputs.
+    bgzip_output_filepath = output_filepath + ".gz"
+    tmp_filepath = bgzip_output_filepath + ".tmp"
+    metrics = task_metrics()
+    counters = dict(metrics.counters)
+    try:
+        try:
+            index = write_motif_file(input_filepath, tmp_filepath, genome_build, ambiguous_motif, parsed_dict, ProcessedIntervals(ambiguous_motif.motif_numbers), compress_threads, read_lines)
+        except UnsortedInputError as error:
+            # Start over, remembering every interval
+            print(f"{input_filename} is not sorted ({error}), rescoring it without assuming sorted input")
+            # Count the records once; the time of the first pass stays in the stages
+            metrics.counters = counters
+            metrics.count("unsorted_rescored")
+            index = write_motif_file(input_filepath, tmp_filepath, genome_build, ambiguous_motif, parsed_dict, ProcessedIntervals(ambiguous_motif.motif_numbers, sorted_input=False), compress_threads, read_lines)
+
+        replace_indexed(tmp_filepath, bgzip_output_filepath, index)
+    except Exception:
+        # Don't leave the partial output behind; the previous output, if any, stays
+        for path in (tmp_filepath, tmp_filepath + ".tbi"):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+    print("Output written to", bgzip_output_filepath)
+
+    if parquet_path is not None:
+        with metrics.timer("parquet"):
+            write_parquet(bgzip_output_filepath, parquet_path, ambiguous_motif.motif_numbers, skip_rows=1, one_based=True)
+        print("Parquet written to", parquet_path)
+
+def write_motif_file(input_filepath, tmp_filepath, genome_build, ambiguous_motif, parsed_dict, processed_intervals, compress_threads=1, read_lines=None):
+    # Score every record of the input file (or of read_lines()) into tmp_filepath; returns its tabix index
+    motif_numbers = ambiguous_motif.motif_numbers
+
+    output_file = bgzf.BgzfWriter(tmp_filepath, threads=compress_threads, index=TabixIndex(zero_based=False), metrics=task_metrics())
+    with output_file:
+#        output_file.write("#chrom\tchromStart\tchromEnd\tname\tscore\tstrand\t")
+#        output_file.write("\t".join([f"motif_score_{motif_number}" for motif_number in motif_numbers]) + "\tmotif_name\n")
+
+        output_file.write(get_header_line(motif_numbers))
+
+        if read_lines is None:
+            score_lines(bgzf.read_file_lines(input_filepath, decode=True, metrics=task_metrics()), output_file, processed_intervals, genome_build, ambiguous_motif, parsed_dict)
+        else:
+            score_lines(read_lines(), output_file, processed_intervals, genome_build, ambiguous_motif, parsed_dict)
 
-    output_file.write("#chrom\tchromStart\tchromEnd\tname\tscore\tstrand\tmotifID\tDNA_binding_domain\tcell_type\tbinding_sequence\tconsensus_sequence\t")
-    output_file.write("\t".join([f"motif_score_{motif_number}" for motif_number in motif_numbers]) + "\tmotif_name\n")
+    return output_file.index
 
-    processed_intervals = set()  # To track processed intervals
+def score_lines(lines, output_file, processed_intervals, genome_build, ambiguous_motif, parsed_dict):
+    motif_length = ambiguous_motif.motif_length
 
-    for line in bed_file:
+    batch = []
+    records_read = 0
+    records_kept = 0
+    for line in lines:
         if line.startswith("#"):  # Skip comment lines
             continue
 
+        records_read += 1
         columns = line.strip().split("\t")
-        chrom = columns[0]
-        chromStart = columns[1]
-        chromEnd = columns[2]
-        name = columns[3]  # Extract motif name
-        strand = columns[5]
-        bed_score = int(columns[4])
 
         # Check if the interval length matches the motif length
-        interval_length = int(chromEnd) - int(chromStart) + 1
+        interval_length = int(columns[2]) - int(columns[1]) + 1
         if interval_length != motif_length:
             continue
 
-        # Construct sequenceID using chrom, chromStart, and chromEnd
-        sequenceID = f"{chrom}:{chromStart}-{chromEnd}"
-
-        # Check if this interval has already been processed for the same motifs
-        if all((chrom, chromStart, chromEnd, motif_number) in processed_intervals for motif_number in motif_numbers):
-            continue
-
-        if strand == '+':
-            sequence = get_reference(genome_build, sequenceID)
-        elif strand == '-':
-            ref_sequence = get_reference(genome_build, sequenceID)
-            sequence = get_reverse_complement(ref_sequence)
-
-        # Calculate motif scores for the sequence using different motif files
-        motif_scores = {}
-        for motif_number in motif_numbers:
-            motif_score = calculate_motif_score(sequence, base_probabilities[motif_number])
-
-            # Check if the motif_number should be skipped based on the threshold
-            if (motif_number == "motif203" and motif_score <= threshold_203) or (motif_number == "motif247" and motif_score <= threshold_247):
-                motif_scores[motif_number] = -1  # Assign a negative value
-            elif (motif_number == "motif109" and motif_score <= threshold_109) or (motif_number == "motif110" and motif_score <= threshold_110):
-                motif_scores[motif_number] = -1  # Assign a negative value
-            else:
-                motif_scores[motif_number] = round(motif_score)
-
-        # Determine motif names based on scores and bed score
-        motif_names = [motif_number for motif_number in motif_scores if motif_scores[motif_number] == bed_score]
-
-        if motif_names:
-            for motif_name in motif_names:
-                key = motif_name
-
-                if key in parsed_dict:
-                    motif_id, cell_type, DNA_binding, consensus_sequence = get_cellandmotif(motif_name, parsed_dict)
-                    binding_sequence = get_reference(genome_build, sequenceID)
-                    reverse_strand = get_reverse_complement(binding_sequence)
-
-                    if strand == '+':
-                        binding_sequence = get_reference(genome_build, sequenceID)
-                    elif strand == '-':
-                        ref_sequence = get_reference(genome_build, sequenceID)
-                        binding_sequence = get_reverse_complement(ref_sequence)
-
-                    # Write the line to the output file
-                    output_line = "\t".join([
-                        chrom, chromStart, chromEnd, name, str(bed_score), strand, motif_id, DNA_binding, cell_type, binding_sequence, consensus_sequence,
-                        "\t".join([str(motif_scores[motif_number]) for motif_number in motif_numbers]),
-                        motif_name, motif_id, cell_type, DNA_binding, consensus_sequence
-                    ])
-                    output_file.write(output_line + "\n")
-
-                    # Update processed intervals
-                    processed_intervals.update((chrom, chromStart, chromEnd, motif_number) for motif_number in motif_names)
-
-print("Output written to", output_filepath)
-
-# Compress the output file using bgzip
-bgzip_output_filepath = output_filepath + ".gz"
-subprocess.run(["bgzip", output_filepath])
-
-print("Output compressed to", bgzip_output_filepath)
+        records_kept += 1
+        batch.append(columns)
+        if len(batch) >= batch_size:
+            write_records(batch, output_file, processed_intervals, genome_build, ambiguous_motif, parsed_dict)
+            batch = []
+
+    if batch:
+        write_records(batch, output_file, processed_intervals, genome_build, ambiguous_motif, parsed_dict)
+
+    metrics = task_metrics()
+    metrics.count("records_read", records_read)
+    metrics.count("records_kept", records_kept)
+    metrics.count("skipped_length_mismatch", records_read - records_kept)
+
+if __name__ == "__main__":
+    # Read command-line arguments
+    input_filepath = sys.argv[1]
+    output_directory = sys.argv[2]
+    genome_build = sys.argv[3]
+    parquet_path = sys.argv[4] if len(sys.argv) > 4 else None  # Optional .parquet copy of the output
+
+    input_filename = os.path.basename(input_filepath)
+
+    # Determine the candidate motifs based on input_filename
+    catalog = load_catalog()
+    ambiguous_motifs = load_ambiguous_motifs(catalog)
+    name = input_filename.replace(".bed.gz", "")
+    if name not in ambiguous_motifs:
+        print(f"Unsupported input file name: {input_filename}")
+        sys.exit(1)
+
+    score_motif_file(input_filepath, output_directory, genome_build, ambiguous_motifs[name], catalog.parsed_dict, parquet_path=parquet_path)
@@ -0,0 +1,100 @@
+import gzip
+import os
+from urllib.parse import quote
+
+import numpy as np
+
+# Optional columnar copy of the .processed.bed outputs: one Hive-style partition
+# per motif name, <directory>/motif=<name>/part-<n>.parquet, that together form a
+# single dataset, e.g. pyarrow.dataset.dataset(directory, partitioning="hive").
+# The repeated metadata columns are dictionary-encoded, coordinates are integers
+# and chromStart is 0-based in every file (the step 3a BED outputs keep it
+# 1-based). Records are sorted by position within each file, so the row group
+# statistics let readers skip row groups by chromosome and position.
+# pyarrow is only imported when Parquet output is asked for.
+
+# Columns shared by every output; step 3a outputs add the score of each candidate motif
+columns = ["chrom", "chromStart", "chromEnd", "name", "score", "strand", "motifID", "DNA_binding_domain", "cell_type", "binding_sequence", "consensus_sequence"]
+dictionary_columns = ["chrom", "name", "strand", "motifID", "DNA_binding_domain", "cell_type", "consensus_sequence"]
+
+# Uncompressed BED bytes parsed at once, about one row group each
+block_size = 64 * 1024 * 1024
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.csv
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet output needs pyarrow, install it with: pip install pyarrow")
+    return pyarrow
+
+
+def get_schema(pa):
+    fields = []
+    for column in columns:
+        if column in ("chromStart", "chromEnd", "score"):
+            fields.append(pa.field(column, pa.int32()))
+        elif column in dictionary_columns:
+            fields.append(pa.field(column, pa.dictionary(pa.int32(), pa.string())))
+        else:
+            fields.append(pa.field(column, pa.string()))
+    # Scores of the candidate motifs listed in the candidate_motifs file metadata, null when there are none
+    fields.append(pa.field("candidate_scores", pa.list_(pa.int32())))
+    return pa.schema(fields)
+
+
+def get_partition_directory(parquet_directory, motif_name):
+    # Partition of a motif name; quoted the way pyarrow decodes Hive partition values
+    return os.path.join(parquet_directory, "motif=" + quote(motif_name, safe=""))
+
+
+def convert_batch(pa, batch, schema, candidate_motifs, one_based):
+    arrays = []
+    for field in schema:
+        if field.name == "candidate_scores":
+            continue
+        array = batch.column(field.name)
+        if field.name == "chromStart" and one_based:
+            array = pa.compute.subtract(array, 1)
+        arrays.append(array.cast(field.type))
+
+    if candidate_motifs:
+        scores = np.stack([batch.column(f"motif_score_{motif_number}").to_numpy(zero_copy_only=False) for motif_number in candidate_motifs], axis=1)
+        offsets = np.arange(0, scores.size + 1, len(candidate_motifs), dtype=np.int32)
+        arrays.append(pa.ListArray.from_arrays(pa.array(offsets), pa.array(scores.ravel(), type=pa.int32())))
+    else:
+        arrays.append(pa.nulls(batch.num_rows, type=pa.list_(pa.int32())))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def write_parquet(bed_filepath, parquet_filepath, candidate_motifs=None, skip_rows=0, one_based=False):
+    # Convert a gzip/BGZF .processed.bed (or shard) to Parquet, block by block.
+    # candidate_motifs are the motif numbers of the score columns of a step 3a
+    # output, whose starts are one_based; skip_rows skips the header line.
+    pa = import_pyarrow()
+    candidate_motifs = candidate_motifs or []
+    column_names = list(columns)
+    column_types = {"chromStart": pa.int32(), "chromEnd": pa.int32(), "score": pa.int32()}
+    if candidate_motifs:
+        column_names += [f"motif_score_{motif_number}" for motif_number in candidate_motifs]
+        column_names += ["motif_name", "motif_name_id", "motif_name_cell_type", "motif_name_DNA_binding", "motif_name_consensus"]
+        column_types.update({f"motif_score_{motif_number}": pa.int32() for motif_number in candidate_motifs})
+
+    schema = get_schema(pa).with_metadata({"candidate_motifs": ",".join(candidate_motifs), "chromStart": "0-based"})
+    os.makedirs(os.path.dirname(parquet_filepath), exist_ok=True)
+    tmp_filepath = parquet_filepath + ".tmp"
+    with gzip.open(bed_filepath, "rb") as bed_file, pa.parquet.ParquetWriter(tmp_filepath, schema, compression="zstd", use_dictionary=dictionary_columns) as writer:
+        # A chunk without records gives a part file without rows (pyarrow can't read an empty CSV)
+        if bed_file.peek(1):
+            reader = pa.csv.open_csv(
+                bed_file,
+                read_options=pa.csv.ReadOptions(column_names=column_names, skip_rows=skip_rows, block_size=block_size),
+                parse_options=pa.csv.ParseOptions(delimiter="\t", quote_char=False),
+                convert_options=pa.csv.ConvertOptions(column_types=column_types, strings_can_be_null=False),
+            )
+            for batch in reader:
+                writer.write_table(convert_batch(pa, batch, schema, candidate_motifs, one_based))
+    os.replace(tmp_filepath, parquet_filepath)
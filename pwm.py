@@ -0,0 +1,109 @@
+import math
+import numpy as np
+
+# Vectorized position weight matrix scoring. Each motif_files/motifN.motif
+# matrix is turned into a log-odds table once, with a fifth column of zeros
+# for bases other than ACGT (N and friends contribute nothing to the score).
+# Sequences are encoded as uint8 codes and a whole batch of sites is scored
+# with one gather per motif position.
+
+BACKGROUND = 0.25
+
+# Byte -> base code lookup: a/c/g/t in either case map to 0-3, anything else to 4
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for code, base in enumerate("acgt"):
+    BASE_CODES[ord(base)] = code
+    BASE_CODES[ord(base.upper())] = code
+
+
+# Code of the complementary base; N stays N
+COMPLEMENT_CODES = np.array([3, 2, 1, 0, 4], dtype=np.uint8)
+
+
+class PWM:
+    def __init__(self, motif_number, probabilities, consensus=None, name=None, threshold=None, log_odds=None):
+        self.motif_number = motif_number
+        self.consensus = consensus
+        self.name = name
+        self.threshold = threshold
+        self.probabilities = probabilities
+
+        # A precomputed table (see motif_catalog.py) is used as is
+        if log_odds is not None:
+            self.log_odds = log_odds
+            return
+
+        # math.log keeps the values identical to the per-base scoring loop
+        self.log_odds = np.zeros((len(probabilities), 5))
+        for idx, row in enumerate(probabilities):
+            self.log_odds[idx, :4] = [math.log(probability / BACKGROUND) for probability in row]
+
+    def __len__(self):
+        return self.log_odds.shape[0]
+
+
+def load_motif(motif_file_path, motif_number=None):
+    # HOMER .motif file: ">consensus<TAB>name<TAB>detection threshold..." then one row of A C G T probabilities per position
+    if motif_number is None:
+        motif_number = motif_file_path.rsplit("/", 1)[-1].replace(".motif", "")
+
+    consensus, name, threshold = None, None, None
+    probabilities = []
+    with open(motif_file_path, "r") as input_file:
+        header = next(input_file).rstrip("\n").split("\t")
+        consensus = header[0].lstrip(">")
+        if len(header) > 1:
+            name = header[1]
+        if len(header) > 2:
+            threshold = float(header[2])
+        for line in input_file:
+            if line.strip():
+                probabilities.append([float(p) for p in line.strip().split()])
+
+    return PWM(motif_number, probabilities, consensus, name, threshold)
+
+
+def encode_sequences(sequences, length):
+    # Equal-length sequences -> (n, length) array of base codes
+    if not sequences:
+        return np.zeros((0, length), dtype=np.uint8)
+    if isinstance(sequences[0], str):
+        joined = "".join(sequences).encode("ascii")
+    else:
+        joined = b"".join(sequences)
+    return BASE_CODES[np.frombuffer(joined, dtype=np.uint8)].reshape(len(sequences), length)
+
+
+def score_sequences(codes, log_odds):
+    # Sum position by position, in the same order as the per-base loop did
+    scores = np.zeros(codes.shape[0])
+    for idx in range(log_odds.shape[0]):
+        scores += log_odds[idx, codes[:, idx]]
+    return scores
+
+
+def score_batch(codes, pwms):
+    # Score every site against several equal-length PWMs at once -> (n, len(pwms))
+    stacked = np.stack([pwm.log_odds for pwm in pwms])
+    scores = np.zeros((codes.shape[0], len(pwms)))
+    for idx in range(stacked.shape[1]):
+        scores += stacked[:, idx, :][:, codes[:, idx]].T
+    return scores
+
+
+def scan_sequence(codes, log_odds):
+    # Score every window of a sequence of base codes on both strands at once ->
+    # (2, number of windows): row 0 scores the window as is, row 1 its reverse
+    # complement. Positions are summed in the same order as score_sequences, so
+    # a window scores exactly what its site would score on its own.
+    length = log_odds.shape[0]
+    count = len(codes) - length + 1
+    if count <= 0:
+        return np.zeros((2, 0))
+
+    complement = COMPLEMENT_CODES[codes]
+    scores = np.zeros((2, count))
+    for idx in range(length):
+        scores[0] += log_odds[idx, codes[idx:idx + count]]
+        scores[1] += log_odds[idx, complement[length - 1 - idx:length - 1 - idx + count]]
+    return scores
@@ -0,0 +1,49 @@
+from bisect import bisect_left
+
+# Sets of genomic regions read from a BED file (0-based, half-open), merged and
+# kept as per-chromosome sorted arrays of starts and ends so overlap checks are
+# a binary search.
+
+
+def read_regions(regions_path):
+    # Sorted, merged 0-based half-open regions by chromosome from a BED file
+    regions = {}
+    with open(regions_path, "r") as regions_file:
+        for line in regions_file:
+            if line.startswith(("#", "track", "browser")) or not line.strip():
+                continue
+            columns = line.split("\t")
+            regions.setdefault(columns[0], []).append((int(columns[1]), int(columns[2])))
+
+    for chrom, intervals in regions.items():
+        merged = []
+        for start, end in sorted(intervals):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        regions[chrom] = merged
+    return regions
+
+
+class RegionSet:
+    def __init__(self, regions):
+        self.regions = regions
+        self.starts = {chrom: [start for start, _ in intervals] for chrom, intervals in regions.items()}
+        self.ends = {chrom: [end for _, end in intervals] for chrom, intervals in regions.items()}
+
+    def overlaps(self, chrom, start, end):
+        # Does [start, end) overlap a region? Merged regions don't overlap each
+        # other, so only the last region starting before end can.
+        starts = self.starts.get(chrom)
+        if not starts:
+            return False
+        index = bisect_left(starts, end) - 1
+        return index >= 0 and self.ends[chrom][index] > start
+
+    def __len__(self):
+        return sum(len(intervals) for intervals in self.regions.values())
+
+
+def load_region_set(regions_path):
+    return RegionSet(read_regions(regions_path))
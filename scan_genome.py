@@ -0,0 +1,224 @@
+import argparse
+import concurrent.futures
+import os
+import sys
+import traceback
+
+import numpy as np
+
+import bgzf
+from fasta_reader import open_fasta
+from generate_output_bed import header_line, merge_shards
+from motif_catalog import load_catalog
+from motif_score import get_cellandmotif
+from pwm import BASE_CODES, scan_sequence
+from regions import read_regions
+from sequence_utils import get_fasta_path, get_reverse_complement_bytes
+from tabix import TabixIndex
+
+# Genome-wide scan: slide every motif_files PWM along the reference (or along
+# the regions of a BED file) and write the sites scoring above the motif's
+# detection threshold, on either strand, in the .processed.bed schema of
+# generate_output_bed.py. One output per motif name. The genome is cut into
+# tasks of about scan_task_size bases in FASTA order (a long chromosome is
+# split, short contigs are grouped); each task reads and encodes its sequence
+# once and scores it against the PWMs of every name, on a pool of worker
+# processes. Each task writes one shard per name, merged back in FASTA order.
+
+# Bases scanned at once; every window starting in a chunk is scored in that chunk
+scan_chunk_size = 1000000
+
+# Bases per task
+scan_task_size = 50 * scan_chunk_size
+
+# The motif catalog and PWM groups, loaded once per process by load_scan_metadata()
+catalog = None
+motif_names = None
+
+def load_scan_metadata():
+    # Motif numbers by name, in catalog order, for every motif with a matrix and threshold
+    global catalog, motif_names
+    if catalog is None:
+        catalog = load_catalog()
+        motif_names = {}
+        for columns in catalog.rows:
+            motif = catalog.motifs.get(columns[0])
+            if motif is None or motif["threshold"] is None:
+                continue
+            motif_numbers = motif_names.setdefault(columns[1], [])
+            if columns[0] not in motif_numbers:
+                motif_numbers.append(columns[0])
+
+def encode_chunk(sequence):
+    # Base codes of a chunk's sequence and the running count of bases other than
+    # ACGT, shared by the PWMs of every name
+    codes = BASE_CODES[np.frombuffer(sequence, dtype=np.uint8)]
+    return codes, np.concatenate([[0], np.cumsum(codes == 4)])
+
+def write_hits(output_file, name, chrom, chunk_start, chunk_end, sequence, codes, other_bases, pwms):
+    # Sites of the chunk's PWMs starting in [chunk_start, chunk_end), ordered by
+    # position; sequence starts at chunk_start and runs on past chunk_end, codes
+    # and other_bases are its encode_chunk()
+    starts, motif_indexes, strand_indexes, scores = [], [], [], []
+    for motif_index, pwm in enumerate(pwms):
+        length = len(pwm)
+        window_scores = scan_sequence(codes, pwm.log_odds)[:, :chunk_end - chunk_start]
+        count = window_scores.shape[1]
+        # Windows with a base other than ACGT are not called
+        complete = other_bases[length:length + count] == other_bases[:count]
+        strand_hits, position_hits = np.nonzero((window_scores > pwm.threshold) & complete)
+
+        starts.append(position_hits)
+        motif_indexes.append(np.full(len(position_hits), motif_index))
+        strand_indexes.append(strand_hits)
+        scores.append(window_scores[strand_hits, position_hits])
+
+    starts = np.concatenate(starts)
+    motif_indexes = np.concatenate(motif_indexes)
+    strand_indexes = np.concatenate(strand_indexes)
+    scores = np.concatenate(scores)
+
+    lines = []
+    for hit in np.lexsort((strand_indexes, motif_indexes, starts)):
+        start = int(starts[hit])
+        pwm = pwms[motif_indexes[hit]]
+        length = len(pwm)
+        motif_id, cell_type, DNA_binding, consensus_sequence = get_cellandmotif(pwm.motif_number, catalog.parsed_dict)
+
+        binding_sequence = sequence[start:start + length].lower()
+        if strand_indexes[hit]:
+            binding_sequence = get_reverse_complement_bytes(binding_sequence)
+
+        lines.append("\t".join([
+            chrom, str(chunk_start + start), str(chunk_start + start + length), name, str(round(float(scores[hit]))), "-" if strand_indexes[hit] else "+",
+            motif_id, DNA_binding, cell_type, binding_sequence.decode("ascii"), consensus_sequence
+        ]) + "\n")
+    output_file.write("".join(lines))
+
+def plan_scan_tasks(chroms, regions, task_size=None):
+    # Cut the regions of the chromosomes, in FASTA order, into tasks of about
+    # task_size bases, as lists of (chrom, start, end, region_end) pieces; windows
+    # starting in a piece may run on up to region_end
+    task_size = task_size or scan_task_size
+    tasks = [[]]
+    task_bases = 0
+    for chrom in chroms:
+        for region_start, region_end in regions[chrom]:
+            start = region_start
+            while start < region_end:
+                end = min(start + task_size - task_bases, region_end)
+                tasks[-1].append((chrom, start, end, region_end))
+                task_bases += end - start
+                start = end
+                if task_bases >= task_size:
+                    tasks.append([])
+                    task_bases = 0
+    return [task for task in tasks if task]
+
+def scan_pieces(names, pieces, shard_paths, genome_build, write_header=False):
+    # Scan the pieces of one task for every motif of every name, each name into
+    # its own BGZF shard; every chunk of sequence is read and encoded once for all
+    # names. Returns the shards' tabix indexes like generate_output_bed.process_chunk.
+    load_scan_metadata()
+    fasta = open_fasta(get_fasta_path(genome_build))
+    pwms = {name: [catalog.pwm(motif_number) for motif_number in motif_names[name]] for name in names}
+    max_length = max(len(pwm) for name in names for pwm in pwms[name])
+
+    output_files = [bgzf.BgzfWriter(shard_path, index=TabixIndex()) for shard_path in shard_paths]
+    try:
+        if write_header:
+            for output_file in output_files:
+                output_file.write(header_line)
+        for chrom, start, end, region_end in pieces:
+            for chunk_start in range(start, end, scan_chunk_size):
+                chunk_end = min(chunk_start + scan_chunk_size, end)
+                sequence = fasta.fetch_bytes(chrom, chunk_start, min(chunk_end + max_length - 1, region_end))
+                codes, other_bases = encode_chunk(sequence)
+                for name, output_file in zip(names, output_files):
+                    write_hits(output_file, name, chrom, chunk_start, chunk_end, sequence, codes, other_bases, pwms[name])
+    finally:
+        for output_file in output_files:
+            output_file.close(write_eof=False)
+    return [output_file.index for output_file in output_files]
+
+def scan_genome(genome_build, output_directory, names=None, regions_path=None, workers=None):
+    # Scan every motif name (or only names) and return the names that failed
+    load_scan_metadata()
+    os.makedirs(output_directory, exist_ok=True)
+
+    fasta_index = open_fasta(get_fasta_path(genome_build)).index
+    if regions_path is None:
+        regions = {chrom: [(0, entry[0])] for chrom, entry in fasta_index.items()}
+    else:
+        regions = read_regions(regions_path)
+        for chrom in regions:
+            if chrom not in fasta_index:
+                raise ValueError(f"Sequence {chrom} of {regions_path} not found in {get_fasta_path(genome_build)}")
+    chroms = [chrom for chrom in fasta_index if chrom in regions]
+
+    if names is None:
+        names = list(motif_names)
+    for name in names:
+        if name not in motif_names:
+            raise ValueError(f"No motif matrix with a detection threshold for {name}")
+
+    futures = {}
+    shards = {}
+    shard_indexes = {}
+    failures = set()
+
+    tasks = plan_scan_tasks(chroms, regions)
+    for name in names:
+        output_filepath = os.path.join(output_directory, f"{name}.processed.bed")
+        shards[name] = [f"{output_filepath}.shard{index}" for index in range(len(tasks))]
+        shard_indexes[name] = [None] * len(tasks)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=load_scan_metadata) as executor:
+        for shard_number, pieces in enumerate(tasks):
+            future = executor.submit(scan_pieces, names, pieces, [shards[name][shard_number] for name in names], genome_build, shard_number == 0)
+            futures[future] = shard_number
+
+        for future in concurrent.futures.as_completed(futures):
+            shard_number = futures[future]
+            try:
+                indexes = future.result()
+            except Exception:
+                pieces = tasks[shard_number]
+                print(f"Error scanning {pieces[0][0]}:{pieces[0][1]}-{pieces[-1][0]}:{pieces[-1][2]}:\n{traceback.format_exc()}", file=sys.stderr)
+                failures.update(names)
+                continue
+
+            for name, index in zip(names, indexes):
+                shard_indexes[name][shard_number] = index
+
+    # Every task covers every name, so the outputs are complete once all tasks are
+    if not failures:
+        for name in names:
+            merge_shards(os.path.join(output_directory, f"{name}.processed.bed"), shards[name], shard_indexes[name])
+
+    # Drop the shards of names that failed part way
+    for name in failures:
+        for shard_path in shards[name]:
+            if os.path.exists(shard_path):
+                os.remove(shard_path)
+
+    return sorted(failures)
+
+def main():
+    parser = argparse.ArgumentParser(description="Scan the reference genome with the HOMER motif matrices")
+    parser.add_argument("genome_build", help="hg19 or hg38")
+    parser.add_argument("--regions", help="BED file of regions to scan (default: every sequence of the FASTA)")
+    parser.add_argument("--motifs", nargs="+", help="motif names to scan, e.g. 'CTCF(Zf)' (default: all)")
+    parser.add_argument("--output-dir", help="output directory (default: genome_scan/<genome_build>)")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: number of CPUs)")
+    args = parser.parse_args()
+
+    output_directory = args.output_dir or os.path.join("genome_scan", args.genome_build)
+    failures = scan_genome(args.genome_build, output_directory, args.motifs, args.regions, args.workers)
+
+    if failures:
+        print(f"{len(failures)} motifs failed: {', '.join(failures)}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
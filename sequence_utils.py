@@ -0,0 +1,49 @@
+from fasta_reader import open_fasta
+
+# Sequence helpers shared by generate_output_bed.py and motif_score.py
+
+# Complement of a lowercase sequence; anything other than acgt is kept as is
+COMPLEMENT = str.maketrans("acgt", "tgca")
+COMPLEMENT_BYTES = bytes.maketrans(b"acgt", b"tgca")
+
+
+def get_fasta_path(genome_build):
+    if genome_build == "hg19":
+        return "hg19.fa"
+    elif genome_build == "hg38":
+        return "hg38.fa"
+    else:
+        raise ValueError("Invalid genome build specified")
+
+
+def get_reverse_complement(sequence):
+    # Lowercase reverse complement, same result as the old per-base loop
+    return sequence.lower().translate(COMPLEMENT)[::-1]
+
+
+def get_reverse_complement_bytes(sequence):
+    return sequence.lower().translate(COMPLEMENT_BYTES)[::-1]
+
+
+def get_binding_sequences(genome_build, intervals, strands):
+    # Lowercase sequences of (chrom, start, end) 0-based half-open intervals, read
+    # on their strand. Each distinct site is fetched once and reverse-complemented
+    # at most once, however many records of the batch share it.
+    sites = {}
+    for interval in intervals:
+        sites.setdefault(interval, len(sites))
+    site_intervals = list(sites)
+    ref_sequences = [sequence.lower() for sequence in open_fasta(get_fasta_path(genome_build)).fetch_many(site_intervals)]
+
+    reverse_complements = {}
+    sequences = []
+    for interval, strand in zip(intervals, strands):
+        index = sites[interval]
+        if strand == '-':
+            if index not in reverse_complements:
+                reverse_complements[index] = get_reverse_complement(ref_sequences[index])
+            sequences.append(reverse_complements[index])
+        else:
+            sequences.append(ref_sequences[index])
+    return sequences
+
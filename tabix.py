@@ -0,0 +1,255 @@
+import gzip
+import os
+import struct
+
+import bgzf
+
+# Tabix (.tbi) index of a sorted, BGZF-compressed tab-delimited file, built while
+# the file is written. Same layout as htslib's: a binning index of chunks of
+# virtual offsets per sequence, plus a linear index of the first record in every
+# 16 kb window. Virtual offsets are the block's compressed offset << 16 plus the
+# offset within the uncompressed block.
+
+# Tabix format codes; TI_FLAG_UCSC marks 0-based, half-open coordinates
+TI_PRESET_GENERIC = 0
+TI_FLAG_UCSC = 0x10000
+
+LINEAR_SHIFT = 14
+
+
+def reg2bins(beg, end):
+    # Every bin that can hold a record overlapping [beg, end)
+    end -= 1
+    bins = [0]
+    for shift, first_bin in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+        bins.extend(range(first_bin + (beg >> shift), first_bin + (end >> shift) + 1))
+    return bins
+
+
+def merge_chunks(chunks):
+    # Sorted chunks with overlapping or adjacent ones joined
+    merged = []
+    for start_offset, end_offset in sorted(chunks):
+        if merged and start_offset <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end_offset)
+        else:
+            merged.append([start_offset, end_offset])
+    return merged
+
+
+def reg2bin(beg, end):
+    # Smallest bin of the UCSC binning scheme containing [beg, end)
+    end -= 1
+    if beg >> 14 == end >> 14:
+        return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if beg >> 17 == end >> 17:
+        return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if beg >> 20 == end >> 20:
+        return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if beg >> 23 == end >> 23:
+        return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if beg >> 26 == end >> 26:
+        return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+
+class TabixIndex:
+    # Records are added in file order through add(); unsorted input raises
+    # ValueError since tabix can't index it. Offsets may be relative to where the
+    # data will end up (see BgzfWriter) and are fixed up by shifting them.
+    def __init__(self, col_seq=1, col_beg=2, col_end=3, meta="#", skip=0, zero_based=True):
+        self.col_seq = col_seq
+        self.col_beg = col_beg
+        self.col_end = col_end
+        self.meta = meta.encode("ascii")
+        self.skip = skip
+        self.zero_based = zero_based
+        self.refs = {}  # name -> (bins, linear index), in file order
+        self.first = None
+        self.last = None
+        self._lines = 0
+
+    def add(self, line, start_offset, end_offset):
+        # line is one record as bytes, spanning virtual offsets [start_offset, end_offset)
+        self._lines += 1
+        if self._lines <= self.skip or line.startswith(self.meta):
+            return
+
+        columns = line.rstrip(b"\r\n").split(b"\t")
+        name = columns[self.col_seq - 1]
+        beg = int(columns[self.col_beg - 1])
+        end = int(columns[self.col_end - 1]) if self.col_end else beg + 1
+        if not self.zero_based:
+            beg -= 1
+        if end <= beg:
+            end = beg + 1
+
+        if self.last is not None and (name, beg) != self.last:
+            if name != self.last[0] and name in self.refs:
+                raise ValueError(f"Records of {name.decode()} are not contiguous, can't index")
+            if name == self.last[0] and beg < self.last[1]:
+                raise ValueError(f"Records of {name.decode()} are not sorted by position, can't index")
+        if self.first is None:
+            self.first = (name, beg)
+        self.last = (name, beg)
+
+        bins, linear = self.refs.setdefault(name, ({}, []))
+        chunks = bins.setdefault(reg2bin(beg, end), [])
+        if chunks and chunks[-1][1] == start_offset:
+            chunks[-1][1] = end_offset
+        else:
+            chunks.append([start_offset, end_offset])
+
+        last_window = (end - 1) >> LINEAR_SHIFT
+        if len(linear) <= last_window:
+            linear.extend([None] * (last_window + 1 - len(linear)))
+        for window in range(beg >> LINEAR_SHIFT, last_window + 1):
+            if linear[window] is None:
+                linear[window] = start_offset
+
+    def map_offsets(self, convert):
+        # Rewrite every virtual offset with convert(offset)
+        for bins, linear in self.refs.values():
+            for chunks in bins.values():
+                for chunk in chunks:
+                    chunk[0] = convert(chunk[0])
+                    chunk[1] = convert(chunk[1])
+            for window, offset in enumerate(linear):
+                if offset is not None:
+                    linear[window] = convert(offset)
+
+    def extend(self, other, shift):
+        # Append the index of data that was written shift compressed bytes into this file
+        if other.first is None:
+            return
+        if self.last is not None:
+            name, beg = other.first
+            if (name != self.last[0] and name in self.refs) or (name == self.last[0] and beg < self.last[1]):
+                raise ValueError(f"Records of {name.decode()} are not sorted across chunks, can't index")
+
+        other.map_offsets(lambda offset: offset + (shift << 16))
+        for name, (other_bins, other_linear) in other.refs.items():
+            bins, linear = self.refs.setdefault(name, ({}, []))
+            for bin_number, chunks in other_bins.items():
+                bins.setdefault(bin_number, []).extend(chunks)
+            if len(linear) < len(other_linear):
+                linear.extend([None] * (len(other_linear) - len(linear)))
+            for window, offset in enumerate(other_linear):
+                if linear[window] is None:
+                    linear[window] = offset
+
+        if self.first is None:
+            self.first = other.first
+        self.last = other.last
+
+    def query_chunks(self, name, beg, end):
+        # Chunks of virtual offsets holding every record of name (bytes) overlapping
+        # [beg, end), 0-based; they may hold other records too
+        if name not in self.refs:
+            return []
+        bins, linear = self.refs[name]
+        window = beg >> LINEAR_SHIFT
+        min_offset = (linear[window] if window < len(linear) else linear[-1]) if linear else 0
+        chunks = [chunk for bin_number in reg2bins(beg, end) for chunk in bins.get(bin_number, ()) if chunk[1] > (min_offset or 0)]
+        return merge_chunks(chunks)
+
+    def write(self, path):
+        # Save as a BGZF-compressed .tbi file
+        preset = TI_PRESET_GENERIC | (TI_FLAG_UCSC if self.zero_based else 0)
+        names = b"".join(name + b"\0" for name in self.refs)
+        data = [b"TBI\x01", struct.pack("<7i", len(self.refs), preset, self.col_seq, self.col_beg, self.col_end, self.meta[0], self.skip)]
+        data.append(struct.pack("<i", len(names)) + names)
+
+        for bins, linear in self.refs.values():
+            data.append(struct.pack("<i", len(bins)))
+            for bin_number in sorted(bins):
+                chunks = bins[bin_number]
+                data.append(struct.pack("<Ii", bin_number, len(chunks)))
+                data.append(struct.pack(f"<{2 * len(chunks)}Q", *[offset for chunk in chunks for offset in chunk]))
+
+            # Empty windows point at the next record to their left, as in htslib
+            filled = []
+            previous = 0
+            for offset in linear:
+                previous = offset if offset is not None else previous
+                filled.append(previous)
+            data.append(struct.pack(f"<i{len(filled)}Q", len(filled), *filled))
+
+        with bgzf.BgzfWriter(path) as index_file:
+            index_file.write(b"".join(data))
+
+
+def read_index(path):
+    # Load a .tbi file written by tabix or by TabixIndex.write()
+    with gzip.open(path, "rb") as index_file:
+        data = index_file.read()
+    if data[:4] != b"TBI\x01":
+        raise ValueError(f"{path} is not a tabix index")
+
+    n_ref, preset, col_seq, col_beg, col_end, meta, skip, names_length = struct.unpack_from("<8i", data, 4)
+    index = TabixIndex(col_seq, col_beg, col_end, chr(meta), skip, bool(preset & TI_FLAG_UCSC))
+    position = 36
+    names = data[position:position + names_length].split(b"\0")[:n_ref]
+    position += names_length
+
+    for name in names:
+        bins = {}
+        n_bin, = struct.unpack_from("<i", data, position)
+        position += 4
+        for _ in range(n_bin):
+            bin_number, n_chunk = struct.unpack_from("<Ii", data, position)
+            position += 8
+            offsets = struct.unpack_from(f"<{2 * n_chunk}Q", data, position)
+            position += 16 * n_chunk
+            bins[bin_number] = [[offsets[i], offsets[i + 1]] for i in range(0, len(offsets), 2)]
+        n_intv, = struct.unpack_from("<i", data, position)
+        position += 4
+        linear = list(struct.unpack_from(f"<{n_intv}Q", data, position))
+        position += 8 * n_intv
+        index.refs[name] = (bins, linear)
+    return index
+
+
+def index_bgzf_file(path, index):
+    # Add every line of an existing BGZF file to index
+    with open(path, "rb") as input_file:
+        pending = b""
+        pending_offset = None
+        while True:
+            block_offset = input_file.tell()
+            data = bgzf.read_block(input_file)
+            if data is None:
+                break
+            # A line ending with its block ends where the next block starts
+            next_offset = input_file.tell()
+            position = 0
+            while position < len(data):
+                newline = data.find(b"\n", position)
+                if newline < 0:
+                    if pending_offset is None:
+                        pending_offset = block_offset << 16 | position
+                    pending += data[position:]
+                    break
+                line_end = newline + 1
+                start_offset = pending_offset if pending_offset is not None else block_offset << 16 | position
+                end_offset = next_offset << 16 if line_end == len(data) else block_offset << 16 | line_end
+                index.add(pending + data[position:line_end], start_offset, end_offset)
+                pending = b""
+                pending_offset = None
+                position = line_end
+
+        if pending:
+            index.add(pending, pending_offset, input_file.tell() << 16)
+    return index
+
+
+def replace_indexed(tmp_filepath, output_filepath, index):
+    # Move a finished BGZF file into place together with its .tbi index, or drop
+    # a stale index when there is none
+    if index is not None:
+        index.write(tmp_filepath + ".tbi")
+    os.replace(tmp_filepath, output_filepath)
+    if index is not None:
+        os.replace(tmp_filepath + ".tbi", output_filepath + ".tbi")
+    elif os.path.exists(output_filepath + ".tbi"):
+        os.remove(output_filepath + ".tbi")
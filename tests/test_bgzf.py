@@ -0,0 +1,127 @@
+import gzip
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import bgzf
+from metrics import Metrics
+from tabix import TabixIndex
+
+
+def make_lines(count=20000, seed=0):
+    # Tab-delimited lines, compressible but not too much, over several blocks
+    random.seed(seed)
+    return [f"chr1\t{i * 10}\t{i * 10 + 12}\tname{random.randrange(50)}\t{random.randrange(1000)}\t{''.join(random.choices('acgt', k=random.randrange(5, 40)))}\n".encode() for i in range(count)]
+
+
+def write_file(path, chunks, **kwargs):
+    with bgzf.BgzfWriter(path, **kwargs) as output_file:
+        for chunk in chunks:
+            output_file.write(chunk)
+    return output_file
+
+
+def read_file(path):
+    with open(path, "rb") as input_file:
+        return input_file.read()
+
+
+def test_readable_by_gzip(tmp_path):
+    # Lines plus an incompressible run that has to be stored
+    data = b"".join(make_lines()) + os.urandom(3 * bgzf.BLOCK_SIZE)
+    path = str(tmp_path / "out.gz")
+    write_file(path, [data[i:i + 10000] for i in range(0, len(data), 10000)])
+
+    assert gzip.decompress(read_file(path)) == data
+    assert read_file(path).endswith(bgzf.BGZF_EOF)
+
+    # Every block is a BGZF member of at most 64 KiB holding at most BLOCK_SIZE bytes
+    offsets = bgzf.read_block_offsets(path)
+    assert len(offsets) == -(-len(data) // bgzf.BLOCK_SIZE) + 1
+    sizes = [end - start for start, end in zip(offsets, offsets[1:] + [os.path.getsize(path)])]
+    assert max(sizes) <= bgzf.MAX_BLOCK_SIZE
+    with open(path, "rb") as input_file:
+        blocks = [bgzf.read_block(input_file) for _ in offsets]
+    assert b"".join(blocks) == data
+    assert blocks[-1] == b""
+
+
+def test_empty_file(tmp_path):
+    path = str(tmp_path / "empty.gz")
+    write_file(path, [])
+    assert read_file(path) == bgzf.BGZF_EOF
+    assert gzip.decompress(read_file(path)) == b""
+
+
+def test_threads_write_the_same_bytes(tmp_path):
+    lines = make_lines()
+    expected = write_file(str(tmp_path / "single.gz"), lines, index=TabixIndex())
+    metrics = Metrics()
+    threaded = write_file(str(tmp_path / "threaded.gz"), lines, threads=3, index=TabixIndex(), metrics=metrics)
+    with ThreadPoolExecutor(2) as executor:
+        shared = write_file(str(tmp_path / "shared.gz"), lines, index=TabixIndex(), executor=executor)
+
+    assert read_file(str(tmp_path / "threaded.gz")) == read_file(str(tmp_path / "single.gz"))
+    assert read_file(str(tmp_path / "shared.gz")) == read_file(str(tmp_path / "single.gz"))
+    assert threaded.index.refs == expected.index.refs == shared.index.refs
+
+    # The compression queue of the threaded writer holds at most 4 * threads blocks
+    # before the next one is added
+    assert metrics.counters["compress_queue_blocks"] == len(bgzf.read_block_offsets(str(tmp_path / "single.gz"))) - 1
+    assert 0 < metrics.counters["compress_queue_depth"] <= (4 * 3 + 1) * metrics.counters["compress_queue_blocks"]
+
+
+def test_shards_concatenate(tmp_path):
+    # Files closed without EOF marker can be concatenated into one BGZF file
+    lines = make_lines()
+    shard_paths = [str(tmp_path / f"shard{i}") for i in range(3)]
+    for shard_number, shard_path in enumerate(shard_paths):
+        with bgzf.BgzfWriter(shard_path) as output_file:
+            output_file.write(b"".join(lines[shard_number::3]))
+            output_file.close(write_eof=False)
+        assert not read_file(shard_path).endswith(bgzf.BGZF_EOF)
+
+    data = b"".join(read_file(shard_path) for shard_path in shard_paths) + bgzf.BGZF_EOF
+    assert gzip.decompress(data) == b"".join(b"".join(lines[i::3]) for i in range(3))
+
+
+@pytest.mark.parametrize("threads", [1, 3])
+def test_read_file_lines(tmp_path, threads):
+    lines = make_lines()
+    path = str(tmp_path / "lines.gz")
+    write_file(path, lines)
+
+    metrics = Metrics()
+    assert list(bgzf.read_file_lines(path, threads, metrics=metrics)) == lines
+    assert list(bgzf.read_file_lines(path, threads, decode=True)) == [line.decode() for line in lines]
+    # Groups of blocks, the EOF block included
+    assert metrics.counters["read_ahead_batches"] == -(-len(bgzf.read_block_offsets(path)) // bgzf.BLOCKS_PER_BATCH)
+
+    # Plain gzip, and a last line without newline
+    with gzip.open(str(tmp_path / "plain.gz"), "wb") as plain_file:
+        plain_file.write(b"".join(lines) + b"last")
+    assert list(bgzf.read_file_lines(str(tmp_path / "plain.gz"), threads)) == lines + [b"last"]
+
+
+def test_read_lines_splits_ranges_exactly_once(tmp_path):
+    lines = make_lines()
+    path = str(tmp_path / "lines.gz")
+    write_file(path, lines)
+    block_offsets = bgzf.read_block_offsets(path)
+
+    for step in (1, 2, 5):
+        ranges = [(first, min(first + step, len(block_offsets))) for first in range(0, len(block_offsets), step)]
+        assert [line for first, last in ranges for line in bgzf.read_lines(path, block_offsets, first, last)] == lines
+
+
+def test_writer_pool(tmp_path):
+    lines = make_lines()
+    with bgzf.BgzfWriterPool(lambda key: str(tmp_path / f"{key}.gz"), max_open_files=4) as writers:
+        for line in lines:
+            writers.write(line.split(b"\t")[3].decode(), line)
+
+    for key in {line.split(b"\t")[3].decode() for line in lines}:
+        expected = [line for line in lines if line.split(b"\t")[3].decode() == key]
+        assert list(bgzf.read_file_lines(str(tmp_path / f"{key}.gz"))) == expected
@@ -0,0 +1,183 @@
+import gzip
+import hashlib
+import http.server
+import os
+import random
+import threading
+
+import pytest
+
+from bgzf import read_file_lines
+from download import download_bed_file, gunzip_lines, split_bed_lines, stream_bed_file
+from http_cache import HttpCache
+
+
+class MockBedHandler(http.server.BaseHTTPRequestHandler):
+    # Serves server.body with the ETag server.etag: a 304 for a matching
+    # If-None-Match, the rest of the body for a Range request whose If-Range
+    # matches (416 past the end), else the whole body. With server.cut set, the
+    # next response stops after that many bytes and the connection is closed.
+    def do_GET(self):
+        server = self.server
+        body, etag = server.body, server.etag
+        server.requests.append(dict(self.headers))
+
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        start = 0
+        if "Range" in self.headers and self.headers.get("If-Range", etag) == etag:
+            start = int(self.headers["Range"].split("=")[1].split("-")[0])
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(body)}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+        else:
+            self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body) - start))
+        self.end_headers()
+
+        payload = body[start:]
+        if server.cut is not None:
+            payload = payload[:server.cut]
+            server.cut = None
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_bed(records=5000, seed=0):
+    # BED lines of a few motif names, as a multi-member gzip like HOMER's files
+    random.seed(seed)
+    lines = [b"# track name=motifs\n"]
+    for _ in range(records):
+        start = random.randrange(1000000)
+        lines.append(f"chr{random.choice('12X')}\t{start}\t{start + 10}\t{random.choice(['CTCF(Zf)', 'AP-1(bZIP)', 'Sox2(HMG)'])}\t{random.randrange(1000)}\t{random.choice('+-')}\n".encode())
+    members = [gzip.compress(b"".join(lines[i:i + 1000])) for i in range(0, len(lines), 1000)]
+    return lines, b"".join(members)
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), MockBedHandler)
+    server.lines, server.body = make_bed()
+    server.etag = '"v1"'
+    server.cut = None
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/homer.KnownMotifs.hg19.bed.gz"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def read_file(path):
+    with open(path, "rb") as input_file:
+        return input_file.read()
+
+
+def test_interrupted_download_resumes(server, tmp_path):
+    file_path = str(tmp_path / "homer.KnownMotifs.hg19.bed.gz")
+    server.cut = len(server.body) // 2
+    with pytest.raises(IOError):
+        for _ in stream_bed_file(server.url, file_path, chunk_size=4096):
+            pass
+    offset = os.path.getsize(file_path + ".part")
+    assert 0 < offset <= len(server.body) // 2
+    assert not os.path.exists(file_path)
+
+    # The next run asks for the rest only, conditional on the same ETag
+    chunks = list(stream_bed_file(server.url, file_path, hashlib.sha256(server.body).hexdigest()))
+    assert server.requests[-1]["Range"] == f"bytes={offset}-"
+    assert server.requests[-1]["If-Range"] == '"v1"'
+    assert b"".join(chunks) == server.body
+    assert read_file(file_path) == server.body
+    assert not os.path.exists(file_path + ".part")
+    assert not os.path.exists(file_path + ".part.validator")
+
+
+def test_changed_file_restarts(server, tmp_path):
+    file_path = str(tmp_path / "homer.KnownMotifs.hg19.bed.gz")
+    server.cut = len(server.body) // 2
+    with pytest.raises(IOError):
+        for _ in stream_bed_file(server.url, file_path, chunk_size=4096):
+            pass
+    assert os.path.getsize(file_path + ".part") > 0
+
+    # The If-Range ETag no longer matches, so the server sends the whole new file
+    server.lines, server.body = make_bed(seed=1)
+    server.etag = '"v2"'
+    assert b"".join(stream_bed_file(server.url, file_path)) == server.body
+    assert server.requests[-1]["If-Range"] == '"v1"'
+    assert read_file(file_path) == server.body
+
+
+def test_partial_download_without_validator_restarts(server, tmp_path):
+    file_path = str(tmp_path / "homer.KnownMotifs.hg19.bed.gz")
+    with open(file_path + ".part", "wb") as part_file:
+        part_file.write(b"stale bytes")
+    assert b"".join(stream_bed_file(server.url, file_path)) == server.body
+    assert "Range" not in server.requests[-1]
+
+
+def test_complete_partial_download(server, tmp_path):
+    # Everything arrived but the file was not renamed: the range is not satisfiable
+    file_path = str(tmp_path / "homer.KnownMotifs.hg19.bed.gz")
+    with open(file_path + ".part", "wb") as part_file:
+        part_file.write(server.body)
+    with open(file_path + ".part.validator", "w") as validator_file:
+        validator_file.write('"v1"\n')
+    assert b"".join(stream_bed_file(server.url, file_path)) == server.body
+    assert server.requests[-1]["Range"] == f"bytes={len(server.body)}-"
+    assert read_file(file_path) == server.body
+
+
+def test_checksum_mismatch(server, tmp_path):
+    file_path = str(tmp_path / "homer.KnownMotifs.hg19.bed.gz")
+    with pytest.raises(IOError):
+        download_bed_file(server.url, str(tmp_path), expected_sha256="0" * 64)
+    assert not os.path.exists(file_path)
+    assert not os.path.exists(file_path + ".part")
+    assert not os.path.exists(file_path + ".part.validator")
+
+
+def test_rerun_is_served_from_cache(server, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    file_path = download_bed_file(server.url, str(tmp_path / "raw"), cache=HttpCache(cache_dir))
+    assert "If-None-Match" not in server.requests[-1]
+
+    os.remove(file_path)
+    assert b"".join(stream_bed_file(server.url, file_path, cache=HttpCache(cache_dir))) == server.body
+    assert server.requests[-1]["If-None-Match"] == '"v1"'
+    assert len(server.requests) == 2
+    assert read_file(file_path) == server.body
+
+
+def test_split_while_downloading(server, tmp_path):
+    file_path = str(tmp_path / "homer.KnownMotifs.hg19.bed.gz")
+    split_directory = str(tmp_path / "split")
+    split_bed_lines(gunzip_lines(stream_bed_file(server.url, file_path)), split_directory)
+
+    expected = {}
+    for line in server.lines[1:]:
+        columns = line.split(b"\t")
+        counts = expected.setdefault(columns[3].decode(), {})
+        counts[columns[0]] = counts.get(columns[0], 0) + 1
+
+    assert sorted(os.listdir(split_directory)) == sorted(f"{name}.bed.gz" for name in expected)
+    for name, counts in expected.items():
+        split_counts = {}
+        for line in read_file_lines(os.path.join(split_directory, f"{name}.bed.gz")):
+            chrom = line.split(b"\t")[0]
+            split_counts[chrom] = split_counts.get(chrom, 0) + 1
+        assert split_counts == counts
+    assert read_file(file_path) == server.body
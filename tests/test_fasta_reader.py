@@ -0,0 +1,116 @@
+import os
+import random
+import shutil
+import subprocess
+
+import pytest
+
+from fasta_reader import IndexedFasta
+
+# tests/fixtures/small.fa holds sequences with 60, 10 and 8 bases per line, one
+# with CRLF line endings (chrM), one shorter than a line, soft-masked bases and
+# Ns; small.fa.fai is its `samtools faidx` index
+fasta_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "small.fa")
+
+
+def read_sequences(path):
+    # Sequences of a FASTA file read line by line, the reference for the slices
+    sequences = {}
+    with open(path, "rb") as fasta_file:
+        for line in fasta_file:
+            line = line.rstrip(b"\r\n").decode("ascii")
+            if line.startswith(">"):
+                name = line[1:].split()[0]
+                sequences[name] = ""
+            else:
+                sequences[name] += line
+    return sequences
+
+
+@pytest.fixture
+def fasta():
+    with IndexedFasta(fasta_path) as fasta:
+        yield fasta
+
+
+def test_fetch_every_region(fasta):
+    for chrom, sequence in read_sequences(fasta_path).items():
+        assert fasta.index[chrom][0] == len(sequence)
+        for start in range(len(sequence)):
+            for end in range(start + 1, len(sequence) + 1):
+                assert fasta.fetch(chrom, start, end) == sequence[start:end]
+                assert fasta.fetch_bytes(chrom, start, end) == sequence[start:end].encode("ascii")
+
+
+def test_fetch_clamps_to_sequence_ends(fasta):
+    sequence = read_sequences(fasta_path)["chr1"]
+    assert fasta.fetch("chr1", -5, 10) == sequence[:10]
+    assert fasta.fetch("chr1", 120, 200) == sequence[120:]
+    assert fasta.fetch("chr1", 130, 140) == ""
+    assert fasta.fetch("chr1", 10, 10) == ""
+    assert fasta.fetch("chr3", 0, 1000) == read_sequences(fasta_path)["chr3"]
+
+
+def test_unknown_sequence(fasta):
+    with pytest.raises(KeyError):
+        fasta.fetch("chrUn", 0, 10)
+    with pytest.raises(KeyError):
+        fasta.fetch_many([("chr1", 0, 10), ("chrUn", 0, 10)])
+
+
+def test_fetch_many_groups_overlapping_and_adjacent_sites(fasta, monkeypatch):
+    sequences = read_sequences(fasta_path)
+    intervals = [
+        ("chr2", 0, 10),
+        ("chr1", 50, 70),
+        ("chr1", 5, 12),
+        ("chr1", 60, 75),   # Overlaps chr1:50-70
+        ("chr1", 75, 80),   # Adjacent to chr1:60-75
+        ("chr1", 5, 12),    # Same site twice
+        ("chrM", 7, 20),    # Crosses CRLF line ends
+        ("chr1", 125, 140), # Clamped at the end
+        ("chr1", 100, 110),
+    ]
+
+    slices = []
+    fetch = fasta.fetch
+    monkeypatch.setattr(fasta, "fetch", lambda chrom, start, end: slices.append((chrom, start, end)) or fetch(chrom, start, end))
+    result = fasta.fetch_many(intervals)
+
+    assert result == [sequences[chrom][start:end] for chrom, start, end in intervals]
+    assert sorted(slices) == [("chr1", 5, 12), ("chr1", 50, 80), ("chr1", 100, 110), ("chr1", 125, 140), ("chr2", 0, 10), ("chrM", 7, 20)]
+
+    # Sites up to max_gap bases apart share a slice too
+    slices.clear()
+    assert fasta.fetch_many([("chr1", 0, 10), ("chr1", 14, 20)], max_gap=4) == [sequences["chr1"][0:10], sequences["chr1"][14:20]]
+    assert slices == [("chr1", 0, 20)]
+
+
+@pytest.mark.skipif(shutil.which("samtools") is None, reason="samtools not installed")
+def test_matches_samtools_faidx(fasta):
+    random.seed(0)
+    for _ in range(200):
+        chrom = random.choice(list(fasta.index))
+        length = fasta.index[chrom][0]
+        start = random.randrange(length)
+        end = random.randint(start + 1, length + 20)
+        output = subprocess.run(["samtools", "faidx", fasta_path, f"{chrom}:{start + 1}-{end}"], capture_output=True, check=True).stdout
+        assert fasta.fetch_bytes(chrom, start, end) == b"".join(output.splitlines()[1:])
+
+
+def test_matches_htslib(tmp_path):
+    pysam = pytest.importorskip("pysam")
+    # htslib builds the same .fai for the fixture
+    shutil.copy(fasta_path, tmp_path / "small.fa")
+    pysam.faidx(str(tmp_path / "small.fa"))
+    with open(fasta_path + ".fai", "r") as expected_file, open(tmp_path / "small.fa.fai", "r") as index_file:
+        assert index_file.read() == expected_file.read()
+
+    random.seed(0)
+    with IndexedFasta(fasta_path) as fasta, pysam.FastaFile(fasta_path) as htslib_fasta:
+        for _ in range(500):
+            chrom = random.choice(list(fasta.index))
+            length = fasta.index[chrom][0]
+            start = random.randrange(length)
+            end = random.randint(start + 1, length + 20)
+            assert fasta.fetch(chrom, start, end) == htslib_fasta.fetch(chrom, start, end)
@@ -0,0 +1,56 @@
+import os
+import random
+
+import bgzf
+from generate_output_bed import get_input_index, query_lines
+from regions import load_region_set
+
+
+def make_input(path, seed=0):
+    # A sorted split motif file, 1-based starts as HOMER writes them
+    random.seed(seed)
+    lines = []
+    for chrom in ("chr1", "chr2"):
+        start = 1
+        for _ in range(20000):
+            start += random.randrange(100)
+            lines.append(f"{chrom}\t{start}\t{start + 11}\tCTCF(Zf)\t{random.randrange(20)}\t{random.choice('+-')}\n")
+    with bgzf.BgzfWriter(path) as output_file:
+        output_file.write("".join(lines))
+    return lines
+
+
+def make_regions(path):
+    with open(path, "w") as regions_file:
+        regions_file.write("chr1\t1000\t5000\nchr1\t4000\t9000\nchr2\t500000\t500001\nchr2\t900000\t1100000\nchr3\t0\t100\n")
+    return load_region_set(path)
+
+
+def test_query_lines_match_full_filter(tmp_path):
+    input_filepath = str(tmp_path / "input" / "CTCF(Zf).bed.gz")
+    os.makedirs(os.path.dirname(input_filepath))
+    lines = make_input(input_filepath)
+    region_set = make_regions(str(tmp_path / "peaks.bed"))
+    expected = [line for line in lines if region_set.overlaps(line.split("\t")[0], int(line.split("\t")[1]) - 1, int(line.split("\t")[2]))]
+    assert expected
+
+    index_directory = str(tmp_path / "out" / ".input_index")
+    assert list(query_lines(input_filepath, region_set, index_directory)) == expected
+
+    # The index is cached under the output directory, never next to the input
+    assert os.listdir(os.path.dirname(input_filepath)) == ["CTCF(Zf).bed.gz"]
+    assert os.listdir(index_directory) == ["CTCF(Zf).bed.gz.tbi"]
+    assert list(query_lines(input_filepath, region_set, index_directory)) == expected
+
+
+def test_index_that_cant_be_saved_is_still_used(tmp_path):
+    input_filepath = str(tmp_path / "CTCF(Zf).bed.gz")
+    lines = make_input(input_filepath)
+    region_set = make_regions(str(tmp_path / "peaks.bed"))
+
+    # A file in the way of the index directory, as an unwritable location would be
+    (tmp_path / "blocked").write_text("")
+    index_directory = str(tmp_path / "blocked" / ".input_index")
+    assert get_input_index(input_filepath, index_directory) is not None
+    assert len(list(query_lines(input_filepath, region_set, index_directory))) == sum(
+        1 for line in lines if region_set.overlaps(line.split("\t")[0], int(line.split("\t")[1]) - 1, int(line.split("\t")[2])))
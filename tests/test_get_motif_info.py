@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+from get_motif_info import build_parsed_subheadings, parse_subheading, parse_subheadings, parsed_subheadings_header, read_consensus, verify_parsed_subheadings
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# tests/fixtures holds a few subheadings covering every parsing rule (Expression,
+# Promoter, mStart, dashed assays and names, the ZNF652 and LHX9 exceptions) and
+# the .motif header lines of those motifs
+
+
+def read_parsed_subheadings():
+    with open(os.path.join(repository, "parsed_subheadings.txt"), "r") as parsed_file:
+        return parsed_file.readlines()
+
+
+def test_fixtures_reproduce_parsed_subheadings():
+    lines = build_parsed_subheadings(os.path.join(fixtures, "subheadings.txt"), os.path.join(fixtures, "motif_files"))
+    with open(os.path.join(fixtures, "subheadings.txt"), "r") as subheadings_file:
+        motif_names = ["motif" + line.rsplit(" ", 1)[-1].rstrip(")\n") for line in subheadings_file]
+    expected = {line.split("\t", 1)[0]: line for line in read_parsed_subheadings()}
+
+    assert lines == [parsed_subheadings_header] + [expected[motif_name] for motif_name in motif_names]
+
+
+def test_special_rules():
+    fields = {fields["motif_name"]: fields for fields in parse_subheadings(open(os.path.join(fixtures, "subheadings.txt")))}
+
+    # ZNF652 has no DNA binding domain in its name
+    assert (fields["motif429"]["tf_name"], fields["motif429"]["dna_domain"]) == ("ZNF652", ".")
+
+    # LHX9 is published as LXH9, domain with its closing parenthesis
+    lhx9 = fields["motif200"]
+    assert (lhx9["name"], lhx9["tf_name"], lhx9["dna_domain"], lhx9["immunoprecipitated_protein"]) == ("LXH9(Homeobox)", "LXH9", "Homeobox)", "LXH9.V5")
+    assert (lhx9["cell_type"], lhx9["assay"], lhx9["origin"]) == ("Hct116", "ChIP-Seq", "GSE116822")
+
+
+def test_every_subheading_parses_like_parsed_subheadings():
+    # Without the .motif files only the parsed columns can be compared
+    with open(os.path.join(repository, "subheadings.txt"), "r") as subheadings_file:
+        parsed = parse_subheadings(subheadings_file)
+    expected = [line.rstrip("\n").split("\t")[:9] for line in read_parsed_subheadings()[1:]]
+    columns = ["motif_name", "name", "tf_name", "dna_domain", "cell_type", "immunoprecipitated_protein", "assay", "origin", "resource"]
+
+    assert [[fields[column] for column in columns] for fields in parsed] == expected
+
+
+def test_unknown_subheading_raises():
+    with pytest.raises(ValueError):
+        parse_subheading("Sub-heading without a motif number")
+    assert parse_subheading("\n") is None
+
+
+def test_missing_motif_file(tmp_path):
+    assert read_consensus(str(tmp_path / "motif1.motif")) == ("N/A", 0)
+
+
+def test_verify_counts_motifs_without_motif_files(tmp_path):
+    # Rebuilt with only some .motif files: those motifs compare on the parsed columns only
+    motif_directory = tmp_path / "motif_files"
+    motif_directory.mkdir()
+    with open(os.path.join(fixtures, "motif_files", "motif1.motif"), "r") as motif_file:
+        (motif_directory / "motif1.motif").write_text(motif_file.read())
+    subheadings_path = os.path.join(repository, "subheadings.txt")
+
+    lines = build_parsed_subheadings(subheadings_path, str(motif_directory))
+    differences, unchecked = verify_parsed_subheadings(lines, os.path.join(repository, "parsed_subheadings.txt"), str(motif_directory))
+    assert differences == []
+    assert unchecked == len(lines) - 2
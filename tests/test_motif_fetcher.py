@@ -0,0 +1,114 @@
+import http.server
+import threading
+import time
+
+import pytest
+import requests
+
+from get_motif_info import MotifFetcher
+from http_cache import HttpCache
+
+
+class MockHomerHandler(http.server.BaseHTTPRequestHandler):
+    # /flaky/<n>: 503 for the first n requests, then the body; /etag: the body
+    # with an ETag, 304 for a matching If-None-Match; /missing: 404; anything
+    # else: the body. Requests are counted by path.
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests[self.path] = server.requests.get(self.path, 0) + 1
+            count = server.requests[self.path]
+            server.headers.append((self.path, dict(self.headers)))
+
+        if self.path.startswith("/flaky/") and count <= int(self.path.split("/")[-1]):
+            self.send_response(503)
+            self.end_headers()
+            return
+        if self.path == "/missing":
+            self.send_response(404)
+            self.end_headers()
+            return
+        if self.path == "/etag" and self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        body = f"body of {self.path}".encode()
+        time.sleep(0.05)  # Long enough for concurrent requests of a URL to overlap
+        self.send_response(200)
+        if self.path == "/etag":
+            self.send_header("ETag", '"v1"')
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), MockHomerHandler)
+    server.lock = threading.Lock()
+    server.requests = {}
+    server.headers = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_retries_with_backoff(server):
+    with MotifFetcher(max_workers=2, retries=3, backoff=0.05) as fetcher:
+        start_time = time.perf_counter()
+        assert fetcher.fetch(server.url + "/flaky/2") == b"body of /flaky/2"
+        elapsed = time.perf_counter() - start_time
+    assert server.requests["/flaky/2"] == 3
+    # Waits of 0.05 and 0.1 seconds before the two retries
+    assert elapsed >= 0.15
+
+
+def test_gives_up_after_retries(server):
+    with MotifFetcher(max_workers=2, retries=2, backoff=0.01) as fetcher:
+        with pytest.raises(requests.HTTPError):
+            fetcher.fetch(server.url + "/flaky/10")
+    assert server.requests["/flaky/10"] == 3
+
+
+def test_client_errors_are_not_retried(server):
+    with MotifFetcher(max_workers=2, retries=3, backoff=0.01) as fetcher:
+        with pytest.raises(requests.HTTPError):
+            fetcher.fetch(server.url + "/missing")
+    assert server.requests["/missing"] == 1
+
+
+def test_one_request_per_url(server):
+    urls = [f"{server.url}/motif{i}.motif" for i in range(5)]
+    with MotifFetcher(max_workers=8) as fetcher:
+        futures = [fetcher.submit(url) for url in urls * 4]
+        results = [future.result() for future in futures]
+        assert fetcher.fetch(urls[0]) == b"body of /motif0.motif"
+    assert results == [f"body of /motif{i}.motif".encode() for i in range(5)] * 4
+    assert server.requests == {f"/motif{i}.motif": 1 for i in range(5)}
+
+
+def test_cache_revalidation(server, tmp_path):
+    cache = HttpCache(str(tmp_path / "cache"))
+    with MotifFetcher(max_workers=2, cache=cache) as fetcher:
+        assert fetcher.fetch(server.url + "/etag") == b"body of /etag"
+    assert "If-None-Match" not in server.headers[-1][1]
+
+    # A new run revalidates the cached body: a 304 with no payload
+    with MotifFetcher(max_workers=2, cache=HttpCache(str(tmp_path / "cache"))) as fetcher:
+        assert fetcher.fetch(server.url + "/etag") == b"body of /etag"
+    assert server.headers[-1][1]["If-None-Match"] == '"v1"'
+    assert server.requests["/etag"] == 2
+
+    # Offline, the cache answers without any request
+    with MotifFetcher(max_workers=2, cache=HttpCache(str(tmp_path / "cache"), offline=True)) as fetcher:
+        assert fetcher.fetch(server.url + "/etag") == b"body of /etag"
+        with pytest.raises(IOError):
+            fetcher.fetch(server.url + "/uncached")
+    assert server.requests["/etag"] == 2
@@ -0,0 +1,181 @@
+import os
+import random
+
+import pytest
+
+import bgzf
+import motif_score
+import sequence_utils
+from metrics import task_metrics
+from motif_score import AmbiguousMotif, ProcessedIntervals, UnsortedInputError, score_motif_file, score_records, write_motif_file
+from pwm import PWM
+
+fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+@pytest.fixture(autouse=True)
+def small_fasta(monkeypatch):
+    # Sequences come from tests/fixtures/small.fa whatever the genome build
+    monkeypatch.setattr(sequence_utils, "get_fasta_path", lambda genome_build: os.path.join(fixtures, "small.fa"))
+
+
+def make_motif(length=6):
+    # Candidate motifs of one name, as in an ambiguous split file; motif3 scores
+    # like motif1, so some sites are written for two motifs at once
+    pwms = [
+        PWM("motif1", [[0.7, 0.1, 0.1, 0.1]] * length, threshold=-100.0),
+        PWM("motif2", [[0.1, 0.1, 0.1, 0.7]] * length, threshold=-100.0),
+        PWM("motif3", [[0.7, 0.1, 0.1, 0.1]] * length, threshold=-100.0),
+    ]
+    return AmbiguousMotif("Test(Zf)", length, pwms)
+
+
+parsed_dict = {
+    "motif1": ("Test/Cell1", "Cell1", "Zf", "AAAAAA"),
+    "motif2": ("Test/Cell2", "Cell2", "Zf", "TTTTTT"),
+    "motif3": ("Test/Cell3", "Cell3", "Zf", "AAAAAA"),
+}
+
+
+class SetProcessedIntervals:
+    # The set of (chrom, start, end, motif) that ProcessedIntervals replaced, kept
+    # as the reference
+    def __init__(self, motif_numbers):
+        self.motif_numbers = motif_numbers
+        self.processed_intervals = set()
+
+    def is_done(self, chrom, start, end):
+        return all((chrom, start, end, motif_number) in self.processed_intervals for motif_number in self.motif_numbers)
+
+    def add(self, chrom, start, end, motif_names):
+        self.processed_intervals.update((chrom, start, end, motif_number) for motif_number in motif_names)
+
+
+def write_input(path, records):
+    with bgzf.BgzfWriter(path) as output_file:
+        for chrom, start, end, score, strand in records:
+            output_file.write(f"{chrom}\t{start}\t{end}\tTest(Zf)\t{score}\t{strand}\n")
+
+
+def test_failed_scoring_leaves_no_temp_file(tmp_path, monkeypatch):
+    input_filepath = str(tmp_path / "Test(Zf).bed.gz")
+    write_input(input_filepath, [("chr1", 1, 6, 0, "+")])
+    output_filepath = tmp_path / "out" / "Test(Zf).processed.bed.gz"
+    output_filepath.parent.mkdir()
+    output_filepath.write_bytes(b"previous output")
+
+    def fail(*args):
+        raise RuntimeError("scoring failed")
+    monkeypatch.setattr(motif_score, "score_records", fail)
+
+    with pytest.raises(RuntimeError):
+        score_motif_file(input_filepath, str(output_filepath.parent), "hg19", make_motif(), parsed_dict)
+    assert sorted(os.listdir(output_filepath.parent)) == ["Test(Zf).processed.bed.gz"]
+    assert output_filepath.read_bytes() == b"previous output"
+
+
+def make_records(seed=0):
+    # 1-based sites of the fixture sequences, sorted, each site up to three times
+    # with the BED score of one of its motifs (or of none), plus a few sites of
+    # the wrong length
+    random.seed(seed)
+    motif = make_motif()
+    sites = []
+    for chrom, length in (("chr1", 130), ("chr2", 25), ("chrM", 31)):
+        for start in range(1, length - 4, 2):
+            for _ in range(random.choice([1, 1, 2, 3])):
+                sites.append([chrom, str(start), str(start + 5), "Test(Zf)", "0", random.choice("+-")])
+            if random.random() < 0.1:
+                sites.append([chrom, str(start), str(start + 6), "Test(Zf)", "0", "+"])
+
+    _, scores = score_records([columns for columns in sites if int(columns[2]) - int(columns[1]) == 5], "hg19", motif)
+    scores = iter(scores)
+    for columns in sites:
+        if int(columns[2]) - int(columns[1]) == 5:
+            record_scores = next(scores)
+            columns[4] = str(random.choice([round(float(score)) for score in record_scores] + [99]))
+    return [tuple(columns) for columns in sites]
+
+
+def write_bed(path, records):
+    with bgzf.BgzfWriter(path) as output_file:
+        output_file.write("".join("\t".join(columns) + "\n" for columns in records))
+
+
+def score_with(tmp_path, records, processed_intervals):
+    input_filepath = str(tmp_path / "Test(Zf).bed.gz")
+    write_bed(input_filepath, records)
+    write_motif_file(input_filepath, str(tmp_path / "out.gz"), "hg19", make_motif(), parsed_dict, processed_intervals)
+    return list(bgzf.read_file_lines(str(tmp_path / "out.gz"), decode=True))
+
+
+def test_sorted_output_matches_set(tmp_path):
+    records = make_records()
+    motif_numbers = make_motif().motif_numbers
+    expected = score_with(tmp_path, records, SetProcessedIntervals(motif_numbers))
+    task_metrics().reset()
+    assert score_with(tmp_path, records, ProcessedIntervals(motif_numbers)) == expected
+
+    # The test data has sites skipped as duplicates and sites written for two motifs
+    assert task_metrics().counters["skipped_duplicate"] > 0
+    written = {}
+    for line in expected[1:]:
+        columns = line.split("\t")
+        written.setdefault(tuple(columns[:3]), set()).add(columns[14])
+    assert {"motif1", "motif3"} in written.values()
+
+
+def test_unsorted_output_matches_set(tmp_path):
+    records = make_records()
+    random.seed(1)
+    random.shuffle(records)
+    motif_numbers = make_motif().motif_numbers
+    expected = score_with(tmp_path, records, SetProcessedIntervals(motif_numbers))
+
+    with pytest.raises(UnsortedInputError):
+        score_with(tmp_path, records, ProcessedIntervals(motif_numbers))
+    assert score_with(tmp_path, records, ProcessedIntervals(motif_numbers, sorted_input=False)) == expected
+
+    # score_motif_file detects the unsorted input and rescores it with the exact index
+    input_filepath = str(tmp_path / "Test(Zf).bed.gz")
+    write_bed(input_filepath, records)
+    task_metrics().reset()
+    score_motif_file(input_filepath, str(tmp_path), "hg19", make_motif(), parsed_dict)
+    assert list(bgzf.read_file_lines(str(tmp_path / "Test(Zf).processed.bed.gz"), decode=True)) == expected
+    assert task_metrics().counters["unsorted_rescored"] == 1
+    assert task_metrics().counters["records_read"] == len(records)
+    assert not os.path.exists(str(tmp_path / "Test(Zf).processed.bed.gz.tbi"))
+
+
+def test_masks_are_bounded_to_the_current_start():
+    processed_intervals = ProcessedIntervals(["motif1", "motif2"])
+    processed_intervals.add("chr1", "10", "15", ["motif1"])
+    processed_intervals.add("chr1", "10", "16", ["motif1", "motif2"])
+    assert not processed_intervals.is_done("chr1", "10", "15")
+    assert processed_intervals.is_done("chr1", "10", "16")
+    processed_intervals.add("chr1", "10", "15", ["motif2"])
+    assert processed_intervals.is_done("chr1", "10", "15")
+    assert len(processed_intervals.masks) == 2
+
+    # Moving on to the next start (or sequence) drops the intervals behind it
+    assert not processed_intervals.is_done("chr1", "12", "17")
+    assert len(processed_intervals.masks) == 0
+    for start in range(20, 10000, 7):
+        processed_intervals.add("chr1", str(start), str(start + 5), ["motif1", "motif2"])
+        assert len(processed_intervals.masks) == 1
+    processed_intervals.add("chr2", "1", "6", ["motif1"])
+    assert list(processed_intervals.masks) == [6]
+
+    with pytest.raises(UnsortedInputError):
+        processed_intervals.is_done("chr2", "0", "5")
+    with pytest.raises(UnsortedInputError):
+        processed_intervals.is_done("chr1", "50000", "50005")
+
+    # Without assuming sorted input every interval is kept
+    processed_intervals = ProcessedIntervals(["motif1", "motif2"], sorted_input=False)
+    for start in (30, 10, 20, 10):
+        processed_intervals.add("chr1", str(start), str(start + 5), ["motif1", "motif2"])
+    processed_intervals.add("chr2", "10", "15", ["motif1"])
+    assert len(processed_intervals.masks) == 4
+    assert processed_intervals.is_done("chr1", "10", "15")
+    assert not processed_intervals.is_done("chr2", "10", "15")
@@ -0,0 +1,100 @@
+import math
+import random
+
+import numpy as np
+import pytest
+
+from pwm import PWM, encode_sequences, load_motif, scan_sequence, score_batch, score_sequences
+from sequence_utils import get_reverse_complement
+
+
+def calculate_motif_score(sequence, base_probabilities):
+    # The per-base scoring loop pwm.py replaced, kept as the reference
+    motif_score = 0.0
+    for idx, base in enumerate(sequence):
+        base_index = {'a': 0, 'c': 1, 'g': 2, 't': 3}.get(base.lower())
+        if base_index is not None:
+            probability = base_probabilities[idx][base_index]
+            score = math.log(probability / 0.25)
+            motif_score += score
+    return motif_score
+
+
+def random_probabilities(length):
+    rows = []
+    for _ in range(length):
+        weights = [random.random() + 0.001 for _ in range(4)]
+        rows.append([weight / sum(weights) for weight in weights])
+    return rows
+
+
+def random_sequence(length):
+    # Mixed case, with N and other IUPAC codes that add nothing to the score
+    return "".join(random.choices("ACGTacgtACGTacgtNnRY", k=length))
+
+
+@pytest.fixture(autouse=True)
+def seed():
+    random.seed(0)
+
+
+def test_score_sequences_matches_per_base_loop():
+    for length in (1, 6, 12, 20):
+        probabilities = random_probabilities(length)
+        pwm = PWM("motif1", probabilities)
+        sequences = [random_sequence(length) for _ in range(500)]
+        # Both strands, as motif_score.py scores the site read on its strand
+        sequences += [get_reverse_complement(sequence) for sequence in sequences]
+
+        scores = score_sequences(encode_sequences(sequences, length), pwm.log_odds)
+        expected = [calculate_motif_score(sequence, probabilities) for sequence in sequences]
+        assert scores.tolist() == pytest.approx(expected, rel=1e-12, abs=1e-12)
+
+        # Bytes encode like str
+        assert np.array_equal(encode_sequences([sequence.encode("ascii") for sequence in sequences], length), encode_sequences(sequences, length))
+
+
+def test_other_bases_add_nothing():
+    probabilities = random_probabilities(4)
+    pwm = PWM("motif1", probabilities)
+    scores = score_sequences(encode_sequences(["NNNN", "aNnR", "ACGT"], 4), pwm.log_odds)
+    assert scores[0] == 0.0
+    assert scores[1] == pytest.approx(math.log(probabilities[0][0] / 0.25))
+    assert scores[2] == pytest.approx(calculate_motif_score("ACGT", probabilities))
+
+
+def test_score_batch_matches_per_base_loop():
+    all_probabilities = [random_probabilities(10) for _ in range(3)]
+    pwms = [PWM(f"motif{number}", probabilities) for number, probabilities in enumerate(all_probabilities)]
+    sequences = [random_sequence(10) for _ in range(300)]
+
+    scores = score_batch(encode_sequences(sequences, 10), pwms)
+    assert scores.shape == (300, 3)
+    for column, probabilities in enumerate(all_probabilities):
+        assert scores[:, column].tolist() == pytest.approx([calculate_motif_score(sequence, probabilities) for sequence in sequences], rel=1e-12, abs=1e-12)
+
+
+def test_scan_sequence_scores_both_strands():
+    probabilities = random_probabilities(8)
+    pwm = PWM("motif1", probabilities)
+    sequence = random_sequence(400)
+
+    scores = scan_sequence(encode_sequences([sequence], len(sequence))[0], pwm.log_odds)
+    windows = [sequence[start:start + 8] for start in range(len(sequence) - 7)]
+    assert scores.shape == (2, len(windows))
+    assert scores[0].tolist() == pytest.approx([calculate_motif_score(window, probabilities) for window in windows], rel=1e-12, abs=1e-12)
+    assert scores[1].tolist() == pytest.approx([calculate_motif_score(get_reverse_complement(window), probabilities) for window in windows], rel=1e-12, abs=1e-12)
+
+    assert scan_sequence(encode_sequences(["acgt"], 4)[0], pwm.log_odds).shape == (2, 0)
+
+
+def test_load_motif(tmp_path):
+    probabilities = random_probabilities(5)
+    motif_path = tmp_path / "motif7.motif"
+    motif_path.write_text(">ACGTN\tTest(Zf)/Cell-Test-ChIP-Seq/Homer\t4.500000\n" + "".join("\t".join(f"{p:.3f}" for p in row) + "\n" for row in probabilities))
+
+    pwm = load_motif(str(motif_path))
+    assert (pwm.motif_number, pwm.consensus, pwm.name, pwm.threshold, len(pwm)) == ("motif7", "ACGTN", "Test(Zf)/Cell-Test-ChIP-Seq/Homer", 4.5, 5)
+    rounded = [[float(f"{p:.3f}") for p in row] for row in probabilities]
+    sequence = random_sequence(5)
+    assert score_sequences(encode_sequences([sequence], 5), pwm.log_odds)[0] == pytest.approx(calculate_motif_score(sequence, rounded))
@@ -0,0 +1,177 @@
+import os
+import random
+
+import pytest
+
+import bgzf
+from generate_output_bed import merge_shards
+from tabix import TabixIndex, index_bgzf_file, merge_chunks, read_index, replace_indexed
+
+
+def make_records(seed=0, zero_based=True):
+    # Sorted BED records of several sequences: short sites, some long intervals
+    # spanning several 16 kb windows and bins, and sites sharing a start
+    random.seed(seed)
+    lines = [b"#chrom\tchromStart\tchromEnd\tname\n"]
+    records = []
+    for chrom in (b"chr1", b"chr2", b"chrX"):
+        start = 0
+        for _ in range(6000):
+            start += random.choice([0, 1, 10, 200, 2000])
+            length = random.choice([8, 12, 20]) if random.random() < 0.97 else random.randrange(20000, 300000)
+            records.append((chrom, start, start + length))
+            # Starts are 1-based when zero_based=False, as in motif_score.py outputs
+            lines.append(b"%s\t%d\t%d\tsite%d\n" % (chrom, start if zero_based else start + 1, start + length, len(records)))
+    return lines, records
+
+
+def write_indexed(path, lines, zero_based=True, threads=1):
+    with bgzf.BgzfWriter(path, threads=threads, index=TabixIndex(zero_based=zero_based)) as output_file:
+        output_file.write(b"".join(lines))
+    return output_file.index
+
+
+def make_queries(seed=1):
+    random.seed(seed)
+    queries = [(b"chr1", 0, 1), (b"chr2", 0, 10 ** 9), (b"chrY", 0, 1000)]
+    for _ in range(200):
+        start = random.randrange(10 ** 7)
+        queries.append((random.choice([b"chr1", b"chr2", b"chrX"]), start, start + random.choice([1, 50, 5000, 100000])))
+    return queries
+
+
+def query(path, index, chrom, beg, end, zero_based=True):
+    # Records of the file overlapping [beg, end) through the index, as a tabix query returns them
+    found = []
+    with open(path, "rb") as input_file:
+        for start_offset, end_offset in index.query_chunks(chrom, beg, end):
+            for line in bgzf.read_range(input_file, start_offset, end_offset).splitlines():
+                if line.startswith(b"#"):
+                    continue
+                columns = line.split(b"\t")
+                start = int(columns[1]) - (0 if zero_based else 1)
+                if columns[0] == chrom and start < end and int(columns[2]) > beg:
+                    found.append((columns[0], start, int(columns[2])))
+    return found
+
+
+def overlapping(records, chrom, beg, end):
+    return [record for record in records if record[0] == chrom and record[1] < end and record[2] > beg]
+
+
+@pytest.mark.parametrize("zero_based", [True, False])
+def test_index_while_writing_matches_index_of_file(tmp_path, zero_based):
+    lines, records = make_records(zero_based=zero_based)
+    path = str(tmp_path / "sites.bed.gz")
+    index = write_indexed(path, lines, zero_based, threads=2)
+
+    assert index.refs == index_bgzf_file(path, TabixIndex(zero_based=zero_based)).refs
+    for chrom, beg, end in make_queries():
+        assert query(path, index, chrom, beg, end, zero_based) == overlapping(records, chrom, beg, end)
+
+
+def test_written_index_reads_back(tmp_path):
+    lines, records = make_records()
+    path = str(tmp_path / "sites.bed.gz")
+    index = write_indexed(path, lines)
+    index.write(path + ".tbi")
+
+    loaded = read_index(path + ".tbi")
+    assert (loaded.col_seq, loaded.col_beg, loaded.col_end, loaded.meta, loaded.skip, loaded.zero_based) == (1, 2, 3, b"#", 0, True)
+    assert list(loaded.refs) == [b"chr1", b"chr2", b"chrX"]
+    for chrom, beg, end in make_queries():
+        assert query(path, loaded, chrom, beg, end) == overlapping(records, chrom, beg, end)
+
+    # Empty windows of the linear index point at the record to their left
+    for name, (bins, linear) in loaded.refs.items():
+        assert all(offset is not None for offset in linear)
+        assert linear == sorted(linear)
+
+
+def test_unsorted_records_are_not_indexed(tmp_path):
+    index = TabixIndex()
+    index.add(b"chr1\t100\t110\n", 0, 14)
+    with pytest.raises(ValueError):
+        index.add(b"chr1\t50\t60\n", 14, 26)
+
+    index = TabixIndex()
+    index.add(b"chr1\t100\t110\n", 0, 14)
+    index.add(b"chr2\t100\t110\n", 14, 28)
+    with pytest.raises(ValueError):
+        index.add(b"chr1\t200\t210\n", 28, 42)
+
+
+def test_merge_chunks():
+    assert merge_chunks([[30, 40], [0, 10], [10, 20], [35, 50]]) == [[0, 20], [30, 50]]
+
+
+def test_query_after_merge_shards(tmp_path):
+    lines, records = make_records()
+    output_filepath = str(tmp_path / "sites.processed.bed")
+
+    # Shards cut at arbitrary lines, including in the middle of a sequence
+    cuts = [0, 1, 4000, 9000, 9001, len(lines)]
+    shard_paths, shard_indexes = [], []
+    for shard_number, (first, last) in enumerate(zip(cuts, cuts[1:])):
+        shard_path = f"{output_filepath}.shard{shard_number}"
+        with bgzf.BgzfWriter(shard_path, index=TabixIndex()) as output_file:
+            output_file.write(b"".join(lines[first:last]))
+            output_file.close(write_eof=False)
+        shard_paths.append(shard_path)
+        shard_indexes.append(output_file.index)
+
+    merge_shards(output_filepath, shard_paths, shard_indexes)
+    path = output_filepath + ".gz"
+    assert [line for line in bgzf.read_file_lines(path)] == lines
+    assert not any(os.path.exists(shard_path) for shard_path in shard_paths)
+
+    index = read_index(path + ".tbi")
+    for chrom, beg, end in make_queries():
+        assert query(path, index, chrom, beg, end) == overlapping(records, chrom, beg, end)
+
+    # Same records as indexing the merged file from scratch
+    rebuilt = index_bgzf_file(path, TabixIndex())
+    for chrom, beg, end in make_queries():
+        assert query(path, rebuilt, chrom, beg, end) == query(path, index, chrom, beg, end)
+
+
+def test_extend_rejects_unsorted_shards(tmp_path):
+    first, second = TabixIndex(), TabixIndex()
+    first.add(b"chr1\t100\t110\n", 0, 14)
+    second.add(b"chr1\t50\t60\n", 0, 12)
+    with pytest.raises(ValueError):
+        first.extend(second, 100)
+
+
+def test_replace_indexed_drops_stale_index(tmp_path):
+    path = str(tmp_path / "sites.bed.gz")
+    lines, _ = make_records()
+    index = write_indexed(path + ".tmp", lines)
+    replace_indexed(path + ".tmp", path, index)
+    assert os.path.exists(path + ".tbi")
+
+    write_indexed(path + ".tmp", lines)
+    replace_indexed(path + ".tmp", path, None)
+    assert os.path.exists(path) and not os.path.exists(path + ".tbi")
+
+
+def test_htslib_reads_the_index(tmp_path):
+    pysam = pytest.importorskip("pysam")
+    lines, records = make_records()
+    path = str(tmp_path / "sites.bed.gz")
+    write_indexed(path, lines).write(path + ".tbi")
+
+    with pysam.TabixFile(path, index=path + ".tbi") as tabix_file:
+        assert [contig.encode() for contig in tabix_file.contigs] == [b"chr1", b"chr2", b"chrX"]
+        for chrom, beg, end in make_queries():
+            if chrom.decode() not in tabix_file.contigs:
+                continue
+            found = [tuple(row.split("\t")[:3]) for row in tabix_file.fetch(chrom.decode(), beg, end)]
+            assert [(chrom_name.encode(), int(start), int(stop)) for chrom_name, start, stop in found] == overlapping(records, chrom, beg, end)
+
+    # And tabix's own index of the file answers the same
+    pysam.tabix_index(path, preset="bed", force=True)
+    with pysam.TabixFile(path) as tabix_file:
+        for chrom, beg, end in make_queries():
+            if chrom.decode() in tabix_file.contigs:
+                assert len(list(tabix_file.fetch(chrom.decode(), beg, end))) == len(overlapping(records, chrom, beg, end))